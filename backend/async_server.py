@@ -0,0 +1,275 @@
+import asyncio
+import io
+import os
+import signal
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import serving
+
+# asyncio serving mode (SERVER_MODE=async).
+#
+# The event loop owns every socket: it waits for requests on idle keep-alive connections,
+# reads request heads and bodies, and writes responses, so a slow or idle client costs a
+# coroutine rather than a thread. Once a request is complete it is handed to the ordinary
+# MarketplaceHandler on a small executor, which is where SQLite and the rest of the
+# blocking work happens. The handler sees an rfile holding exactly one request
+# and a wfile that passes its output back to the loop.
+#
+# Bodies are checked against the route's limit (MarketplaceHandler.body_limit) before any
+# of them is read. A body bigger than SPOOL_BODY is read into a temp file rather than
+# memory, so a large upload costs disk, not RAM, while it waits for a thread.
+THREADS = int(os.environ.get("ASYNC_THREADS", min(8, (os.cpu_count() or 1) * 2)))
+# Requests handed to the executor (running or waiting for a thread) before we stop reading more
+MAX_PENDING = int(os.environ.get("ASYNC_MAX_PENDING", THREADS * 16))
+IDLE_TIMEOUT = float(os.environ.get("ASYNC_IDLE_TIMEOUT", 60))
+MAX_HEAD = 64 * 1024
+SPOOL_BODY = int(os.environ.get("ASYNC_SPOOL_BODY", 1024 * 1024))
+READ_CHUNK = 64 * 1024
+# Response bytes buffered in the worker before it waits for the client to catch up
+WRITE_BUFFER = 64 * 1024
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 10))
+
+
+class LoopWriter(io.RawIOBase):
+    # wfile for a handler running on the executor. Small responses are buffered and sent
+    # by the connection coroutine once the handler returns; a handler that writes more
+    # than WRITE_BUFFER (a stream, a big file) blocks until the client drains it.
+
+    def __init__(self, loop, writer):
+        self.loop = loop
+        self.writer = writer
+        self.buffer = bytearray()
+        self.held = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= WRITE_BUFFER:
+            self.send()
+        return len(data)
+
+    def send(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result()
+
+    async def _send(self, data):
+        if self.writer.is_closing():
+            raise ConnectionResetError("client went away")
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def hold(self, stream):
+        # Hand a long-lived stream over to the event loop so it doesn't keep a worker
+        # thread. stream provides poll(heartbeat), finished(), close(), a heartbeat
+        # interval and a waker attribute called from any thread when poll() has data.
+        self.held = stream
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class AsyncServer:
+    # Stands in for the socketserver object handlers reach through self.server
+
+    def __init__(self, handler_class, port, threads=THREADS):
+        self.handler_class = type(handler_class.__name__, (handler_class,), {
+            # The loop already answered Expect: 100-continue before reading the body
+            "handle_expect_100": lambda self: True,
+        })
+        self.server_address = ("", port)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+        self.pending = None
+        # StreamWriter -> {"busy": handling a request right now}
+        self.connections = {}
+        self.stopping = False
+
+    def keep_alive(self):
+        # Responses sent while shutting down tell the client not to reuse the connection
+        return not self.stopping
+
+    async def serve(self, stop):
+        self.pending = asyncio.Semaphore(MAX_PENDING)
+        server = await asyncio.start_server(self.handle_connection, port=self.server_address[1],
+                                            reuse_address=True, backlog=1024, limit=MAX_HEAD)
+        async with server:
+            await stop.wait()
+            self.stopping = True
+            serving.run_stop_hooks()
+            server.close()
+            # Idle keep-alive connections can go straight away; busy ones get a grace period
+            for writer, state in list(self.connections.items()):
+                if not state["busy"]:
+                    writer.close()
+            deadline = asyncio.get_running_loop().time() + SHUTDOWN_TIMEOUT
+            while self.connections and asyncio.get_running_loop().time() < deadline:
+                await asyncio.sleep(0.05)
+        self.executor.shutdown(wait=True)
+
+    async def handle_connection(self, reader, writer):
+        state = self.connections[writer] = {"busy": False}
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info("peername") or ("", 0)
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(_simple_response(431, "Request header fields too large"))
+                    break
+                state["busy"] = True
+                try:
+                    length, expect_continue = _body_info(head)
+                    if length is None:
+                        writer.write(_simple_response(400, "Invalid Content-Length"))
+                        break
+                    if length > self.handler_class.body_limit(*_request_target(head)):
+                        writer.write(_simple_response(413, "Request body too large"))
+                        break
+                    if length and expect_continue:
+                        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                    request = await self.read_body(reader, head, length)
+                    out = LoopWriter(loop, writer)
+                    try:
+                        async with self.pending:
+                            close = await loop.run_in_executor(
+                                self.executor, self.run_handler, request, out, client_address)
+                    finally:
+                        request.close()
+                    writer.write(out.take())
+                    await writer.drain()
+                    if out.held is not None:
+                        await self.follow(writer, out.held)
+                        break
+                    if close or self.stopping:
+                        break
+                finally:
+                    state["busy"] = False
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            self.connections.pop(writer, None)
+            writer.close()
+
+    async def read_body(self, reader, head, length):
+        # The whole request as a file: in memory, or spooled to disk past SPOOL_BODY
+        if length <= SPOOL_BODY:
+            body = await asyncio.wait_for(reader.readexactly(length), IDLE_TIMEOUT) if length else b""
+            return io.BytesIO(head + body)
+        request = tempfile.SpooledTemporaryFile(max_size=SPOOL_BODY)
+        try:
+            request.write(head)
+            remaining = length
+            while remaining:
+                chunk = await asyncio.wait_for(reader.read(min(READ_CHUNK, remaining)), IDLE_TIMEOUT)
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                request.write(chunk)
+                remaining -= len(chunk)
+            request.seek(0)
+        except BaseException:
+            request.close()
+            raise
+        return request
+
+    async def follow(self, writer, stream):
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        stream.waker = lambda: loop.call_soon_threadsafe(wake.set)
+        try:
+            timed_out = False
+            while not stream.finished() and not self.stopping:
+                # poll() can fall back to reading SQLite, which mustn't block the loop
+                data = await loop.run_in_executor(self.executor, stream.poll, timed_out)
+                if data:
+                    writer.write(data)
+                    await writer.drain()
+                try:
+                    await asyncio.wait_for(wake.wait(), stream.heartbeat)
+                    timed_out = False
+                except asyncio.TimeoutError:
+                    timed_out = True
+                wake.clear()
+        finally:
+            stream.close()
+
+    def run_handler(self, request, wfile, client_address):
+        # Runs on the executor: one request through MarketplaceHandler. Returns True when
+        # the connection must be closed afterwards.
+        handler = self.handler_class.__new__(self.handler_class)
+        handler.server = self
+        handler.client_address = client_address
+        handler.request = handler.connection = None
+        handler.rfile = request
+        handler.wfile = wfile
+        handler.close_connection = True
+        try:
+            handler.handle_one_request()
+        except ConnectionError:
+            return True
+        except Exception as e:
+            print(f"Handler Error: {e}")
+            return True
+        return handler.close_connection
+
+
+def _body_info(head):
+    length = 0
+    expect_continue = False
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            try:
+                length = int(value.strip())
+            except ValueError:
+                return None, False
+            if length < 0:
+                return None, False
+        elif name == b"expect":
+            expect_continue = value.strip().lower() == b"100-continue"
+    return length, expect_continue
+
+
+def _request_target(head):
+    # (method, path) from the request line; junk goes to the handler, which answers 400
+    parts = head.split(b"\r\n", 1)[0].split(b" ")
+    if len(parts) != 3:
+        return "", ""
+    return parts[0].decode("latin-1"), urlsplit(parts[1].decode("latin-1")).path
+
+
+def _simple_response(status, message):
+    body = ('{"detail": "%s"}' % message).encode()
+    return (f"HTTP/1.1 {status} {message}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode() + body
+
+
+def serve(handler_class, port, threads=THREADS, on_worker_start=None):
+    server = AsyncServer(handler_class, port, threads)
+    if on_worker_start:
+        on_worker_start()
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        print(f"Serving at http://localhost:{port} (async mode, {threads} worker threads)")
+        await server.serve(stop)
+
+    try:
+        asyncio.run(main())
+    finally:
+        print("Server stopped")
@@ -0,0 +1,212 @@
+import csv
+import json
+import math
+import os
+
+import listings
+import photos
+
+# Bulk listing import (POST /listings/import) and the formats of the admin exports.
+#
+# The import body is NDJSON (one listing object per line) or CSV with a header row, picked
+# by Content-Type. It is read line by line as rows are validated, and valid rows are
+# inserted BATCH_SIZE at a time, each batch one executemany in one write transaction. A bad
+# row doesn't stop the import: it is reported with its line number and skipped.
+#
+# Columns: title, category, condition and price are required; brand, model, location,
+# description, working_parts and photos are optional. price is what the seller asks, as in
+# POST /listings/; a seller_price column (as in the listings export) takes precedence so an
+# export can be imported again. photos is a JSON list, or in CSV also a ;-separated list,
+# of /photos/<hash> URLs already in the store.
+BATCH_SIZE = int(os.environ.get("BULK_IMPORT_BATCH", 500))
+MAX_IMPORT_BYTES = int(os.environ.get("BULK_IMPORT_MAX_BYTES", 64 * 1024 * 1024))
+MAX_LINE = 1024 * 1024
+MAX_REPORTED_ERRORS = 100
+MAX_PRICE = 10_000_000
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+CONTENT_TYPES = {
+    "application/x-ndjson": "ndjson",
+    "application/ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "text/csv": "csv",
+}
+REQUIRED = ("title", "category", "condition")
+TEXT_FIELDS = {"title": 200, "category": 100, "condition": 50, "brand": 100, "model": 100,
+               "location": 200, "description": 10000, "working_parts": 2000}
+
+INSERT_SQL = '''INSERT INTO listings (seller_id, title, category, brand, model, condition, seller_price, price,
+                location, description, working_parts, photos) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+
+class BulkError(ValueError):
+    pass
+
+
+def import_format(content_type):
+    return CONTENT_TYPES.get((content_type or "").split(";")[0].strip().lower())
+
+
+def validate(raw, seller_id):
+    # One import record -> the INSERT_SQL parameters, or BulkError
+    if not isinstance(raw, dict):
+        raise BulkError("Expected an object")
+    values = {}
+    for name, max_len in TEXT_FIELDS.items():
+        value = raw.get(name)
+        value = "" if value is None else str(value).strip()
+        if name in REQUIRED and not value:
+            raise BulkError(f"Missing {name}")
+        if len(value) > max_len:
+            raise BulkError(f"{name} is longer than {max_len} characters")
+        values[name] = value
+
+    asked = raw.get("seller_price")
+    if asked in (None, ""):
+        asked = raw.get("price")
+    if asked in (None, ""):
+        raise BulkError("Missing price")
+    try:
+        seller_price = float(asked)
+    except (TypeError, ValueError):
+        raise BulkError(f"Invalid price: {asked!r}")
+    if not math.isfinite(seller_price) or seller_price <= 0 or seller_price > MAX_PRICE:
+        raise BulkError(f"Price must be between 0 and {MAX_PRICE}")
+
+    photo_list = raw.get("photos") or []
+    if isinstance(photo_list, str):
+        text = photo_list.strip()
+        if text.startswith("["):
+            try:
+                photo_list = json.loads(text)
+            except ValueError:
+                raise BulkError("Invalid photos list")
+        else:
+            photo_list = [p.strip() for p in text.split(";") if p.strip()]
+    if not isinstance(photo_list, list):
+        raise BulkError("photos must be a list")
+    if any(isinstance(p, str) and not p.startswith(photos.URL_PREFIX) for p in photo_list):
+        raise BulkError("photos must be URLs of uploaded photos")
+    try:
+        photo_urls = photos.store_uploads(photo_list)
+    except photos.PhotoError as e:
+        raise BulkError(str(e))
+
+    return (seller_id, values["title"], values["category"], values["brand"], values["model"], values["condition"],
+            seller_price, listings.display_price(seller_price), values["location"], values["description"],
+            values["working_parts"], json.dumps(photo_urls))
+
+
+def insert_batch(conn, rows):
+    # Write operation: runs inside the writer's transaction
+    conn.executemany(INSERT_SQL, rows)
+    return len(rows)
+
+
+class Importer:
+    # Collects the outcome of one import while its rows stream through
+
+    def __init__(self, seller_id, fmt, flush, batch_size=BATCH_SIZE):
+        self.seller_id = seller_id
+        self.fmt = fmt
+        self.flush = flush  # called with each batch of rows; returns how many were stored
+        self.batch_size = batch_size
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self._batch = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def run(self, lines):
+        # lines: (line number, bytes or None for a line over MAX_LINE)
+        records = self._ndjson(lines) if self.fmt == "ndjson" else self._csv(lines)
+        for line, raw in records:
+            try:
+                self._batch.append(validate(raw, self.seller_id))
+            except BulkError as e:
+                self.error(line, str(e))
+                continue
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+        self._flush()
+        return self.result()
+
+    def _flush(self):
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self.imported += self.flush(batch)
+
+    def _ndjson(self, lines):
+        for line, data in lines:
+            if data is None:
+                self.error(line, f"Line longer than {MAX_LINE} bytes")
+                continue
+            if not data.strip():
+                continue
+            try:
+                yield line, json.loads(data)
+            except ValueError as e:
+                self.error(line, f"Invalid JSON: {e}")
+
+    def _csv(self, lines):
+        def text():
+            for line, data in lines:
+                if data is None:
+                    self.error(line, f"Line longer than {MAX_LINE} bytes")
+                    yield "\n"
+                    continue
+                try:
+                    yield data.decode("utf-8-sig" if line == 1 else "utf-8")
+                except UnicodeDecodeError:
+                    self.error(line, "Not valid UTF-8")
+                    yield "\n"
+
+        reader = csv.DictReader(text())
+        try:
+            columns = set(reader.fieldnames or ())
+            missing = [c for c in REQUIRED if c not in columns]
+            if not columns & {"price", "seller_price"}:
+                missing.append("price")
+            if missing:
+                raise BulkError(f"CSV header is missing: {', '.join(missing)}")
+            # Rows are numbered by the line they end on
+            for record in reader:
+                if None in record:
+                    self.error(reader.line_num, "More fields than the header has")
+                else:
+                    yield reader.line_num, record
+        except csv.Error as e:
+            self.error(reader.line_num, f"Invalid CSV: {e}")
+
+    def result(self):
+        return {"imported": self.imported, "failed": self.failed, "errors": self.errors,
+                "errors_truncated": self.failed > len(self.errors)}
+
+
+def read_lines(rfile, length):
+    # Yield (line number, bytes) for a body of length bytes without holding more than one
+    # line; a line over MAX_LINE is skipped and yielded as None
+    remaining = length
+    number = 0
+    while remaining > 0:
+        data = rfile.readline(min(remaining, MAX_LINE + 1))
+        if not data:
+            break
+        remaining -= len(data)
+        number += 1
+        if len(data) > MAX_LINE:
+            while remaining > 0 and not data.endswith(b"\n"):
+                data = rfile.readline(min(remaining, 64 * 1024))
+                if not data:
+                    break
+                remaining -= len(data)
+            yield number, None
+            continue
+        yield number, data
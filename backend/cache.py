@@ -0,0 +1,132 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode
+
+# Response cache for the public listings feed.
+#
+# Entries are keyed by the normalised query string and remember which listing ids they
+# contain, so a change to one listing only drops the pages that show it. Inside one
+# process invalidation is precise. Pre-fork workers share an epoch counter in shared
+# memory: any invalidation bumps it, and a worker that sees someone else's bump clears
+# its whole cache before the next lookup.
+MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_ENTRIES", 512))
+MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_BYTES", 32 * 1024 * 1024))
+ENABLED = os.environ.get("RESPONSE_CACHE", "1") != "0"
+
+
+class Entry:
+    __slots__ = ("body", "gzip_body", "etag", "headers", "listing_ids", "positional")
+
+    def __init__(self, body, etag, headers, listing_ids, positional):
+        self.body = body
+        self.gzip_body = None  # filled in on the first request that accepts gzip
+        self.etag = etag
+        self.headers = headers
+        self.listing_ids = listing_ids
+        self.positional = positional
+
+
+def make_etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def cache_key(path, query):
+    # Parameter order doesn't change the response, so it shouldn't change the key
+    return path + "?" + urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+
+
+class ResponseCache:
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Bumped on every invalidation; a response computed across a bump is not stored
+        self._generation = 0
+        self._shared_epoch = multiprocessing.Value('Q', 0)
+        self._seen_epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self):
+        return self._generation
+
+    def _sync_epoch(self):
+        # Called with self._lock held
+        epoch = self._shared_epoch.value
+        if epoch != self._seen_epoch:
+            self._entries.clear()
+            self._bytes = 0
+            self._generation += 1
+            self._seen_epoch = epoch
+
+    def get(self, key):
+        with self._lock:
+            self._sync_epoch()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry, generation):
+        size = len(entry.body)
+        if size > self.max_bytes // 4:
+            return
+        with self._lock:
+            self._sync_epoch()
+            if generation != self._generation:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.body)
+            self._entries[key] = entry
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+                self.evictions += 1
+
+    def _bump(self):
+        # Called with self._lock held
+        self._generation += 1
+        self.invalidations += 1
+        with self._shared_epoch.get_lock():
+            self._shared_epoch.value += 1
+            self._seen_epoch = self._shared_epoch.value
+
+    def invalidate_all(self):
+        # A listing was created (it may belong on any page) or many changed at once
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._seen_epoch = self._shared_epoch.value
+            self._bump()
+
+    def invalidate_listings(self, listing_ids, positional=False):
+        # Drop pages showing any of listing_ids. positional=True when rows disappeared from
+        # the feed, which also shifts offset-based pages and changes total counts.
+        ids = set(listing_ids)
+        with self._lock:
+            self._sync_epoch()
+            for key in [k for k, e in self._entries.items()
+                        if (positional and e.positional) or not ids.isdisjoint(e.listing_ids)]:
+                self._bytes -= len(self._entries.pop(key).body)
+            self._bump()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations}
+
+
+listings_cache = ResponseCache()
@@ -0,0 +1,432 @@
+import bisect
+import calendar
+import json
+import math
+import os
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, deque
+from itertools import compress, islice, tee
+
+import listings
+
+# In-memory catalogue of the browse feed: answers GET /listings/ without a search (q) by
+# filtering and sorting in process, so SQLite is only asked for the rows of the page.
+# Off unless LISTINGS_CATALOGUE=1.
+#
+# Every listing has a slot, in id order, and the columns are arrays indexed by slot: id,
+# price, created_at as unix time, and a group code for the (category, condition) of a
+# listing the feed shows (0 for one it doesn't). Two arrays of slots are kept sorted by
+# (created_at, id) and (price, id) and hold only the listings the feed shows. A query
+# bisects one of them for the price range and cursor, walks it forwards or backwards
+# through itertools filters over the columns (loops in C, no Python per row) and stops
+# once it has the page.
+#
+# Triggers log the id of every listing inserted, deleted or changed in a column the
+# catalogue holds to listing_changes, the same way the FTS index and facet counts are kept
+# in step. Before a query the catalogue applies the entries it hasn't seen yet, so a write
+# from any thread or worker process is in the next response. The log keeps the last
+# CHANGE_LOG_ROWS entries; a catalogue further behind than RELOAD_AFTER reloads instead.
+ENABLED = os.environ.get("LISTINGS_CATALOGUE", "0") == "1"
+CHANGE_LOG_ROWS = 10000
+RELOAD_AFTER = 2000
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS listing_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        listing_id INTEGER NOT NULL
+    )''',
+    '''CREATE TRIGGER IF NOT EXISTS listing_changes_ai AFTER INSERT ON listings BEGIN
+        INSERT INTO listing_changes (listing_id) VALUES (new.id);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS listing_changes_ad AFTER DELETE ON listings BEGIN
+        INSERT INTO listing_changes (listing_id) VALUES (old.id);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS listing_changes_au AFTER UPDATE OF status, category, condition, price, created_at
+    ON listings WHEN (old.status, old.category, old.condition, old.price, old.created_at)
+                  IS NOT (new.status, new.category, new.condition, new.price, new.created_at) BEGIN
+        INSERT INTO listing_changes (listing_id) VALUES (new.id);
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS listing_changes_trim AFTER INSERT ON listing_changes BEGIN
+        DELETE FROM listing_changes WHERE seq <= new.seq - {CHANGE_LOG_ROWS};
+    END''',
+]
+
+NAN = float("nan")
+NEG_INF = float("-inf")
+NO_TIME = -2 ** 63  # created_at NULL: sorts first, as in SQLite
+MAX_GROUPS = 65535
+MAX_MASKS = 256
+LOAD_BATCH = 10000
+# A newest-first query whose price range holds fewer listings than this (and under a
+# quarter of the feed) sorts the matches in that range rather than walking the feed
+PRICE_ROUTE_MAX = 20000
+SORTS = ("newest", "price_low", "price_high")
+
+# One row per listing: id, price (NULL unless a number), created_at as unix time, whether
+# the feed shows it, category, condition, and whether the catalogue can order it. That is
+# comparing created_at as a number, which orders like SQLite's text comparison only for
+# canonical 'YYYY-MM-DD HH:MM:SS' values (what CURRENT_TIMESTAMP writes). A listing in the
+# feed with anything else, or a price that isn't a number, hands every query back to SQL.
+ROW_SQL = f'''SELECT id, CASE WHEN typeof(price) IN ('integer', 'real') THEN price END,
+                    IFNULL(CAST(strftime('%s', created_at) AS INTEGER), {NO_TIME}),
+                    status IN ('active', 'sold'), category, condition,
+                    status NOT IN ('active', 'sold') OR (
+                        (created_at IS NULL OR datetime(created_at) IS created_at)
+                        AND typeof(price) IN ('integer', 'real', 'null'))
+             FROM listings'''
+CHANGES_SQL = "SELECT seq, listing_id FROM listing_changes WHERE seq > ? ORDER BY seq LIMIT ?"
+
+
+def setup(conn):
+    for sql in SCHEMA:
+        conn.execute(sql)
+
+
+def rows_by_id(conn, ids):
+    # Feed rows for ids, in that order; any deleted since they were picked are left out
+    if not ids:
+        return []
+    marks = ", ".join("?" * len(ids))
+    found = {row[0]: row for row in conn.execute(
+        f"SELECT {listings.LISTING_COLUMNS} FROM listings l WHERE l.id IN ({marks})", ids)}
+    return [found[i] for i in ids if i in found]
+
+
+def _count(items):
+    # Length of an iterator without a Python loop
+    last = deque(enumerate(items, 1), maxlen=1)
+    return last[0][0] if last else 0
+
+
+def _unix_time(value):
+    # A created_at cursor value as the catalogue stores it, or None if it isn't canonical
+    try:
+        parsed = time.strptime(value, "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return None
+    if time.strftime("%Y-%m-%d %H:%M:%S", parsed) != value:
+        return None
+    return calendar.timegm(parsed)
+
+
+class Catalogue:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clear()
+        self.loaded = False
+        self.usable = True
+        self.seq = 0
+        self.reloads = 0
+        self.applied = 0
+        self.lookups = 0
+        self.fallbacks = 0
+        self.load_seconds = 0.0
+
+    def _clear(self):
+        self.ids = array("I")
+        self.prices = array("d")
+        self.created = array("q")
+        self.groups = array("H")
+        self.by_created = array("I")
+        self.by_price = array("I")
+        self.group_codes = {}
+        self.group_keys = [None]  # code -> (category, condition); 0 is "not in the feed"
+        self.group_counts = [0]  # code -> listings in the feed with it
+        self.deleted = set()
+        self._masks = {}
+
+    def _created_key(self, slot):
+        return self.created[slot], self.ids[slot]
+
+    def _price_key(self, slot):
+        # NULL prices sort first, as in SQLite
+        price = self.prices[slot]
+        return (price if price == price else NEG_INF), self.ids[slot]
+
+    def _group(self, category, condition):
+        key = (category, condition)
+        code = self.group_codes.get(key)
+        if code is None:
+            if len(self.group_keys) > MAX_GROUPS:
+                raise OverflowError("Too many category/condition pairs")
+            code = self.group_codes[key] = len(self.group_keys)
+            self.group_keys.append(key)
+            self.group_counts.append(0)
+        return code
+
+    # Loading and keeping up
+
+    def load(self, conn):
+        # Caller holds the lock (or nothing else can see this catalogue yet)
+        start = time.perf_counter()
+        # Read the log position first: a write landing in between is applied again, harmlessly
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM listing_changes").fetchone()[0]
+        self._clear()
+        self.usable = True
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(ROW_SQL + " ORDER BY id")
+        group = self._group
+        try:
+            # A batch at a time, column by column
+            while True:
+                batch = cursor.fetchmany(LOAD_BATCH)
+                if not batch:
+                    break
+                ids, prices, created, visible, categories, conditions, orderable = zip(*batch)
+                if 0 in orderable:
+                    raise ValueError(f"listing {ids[orderable.index(0)]} has a created_at or price "
+                                     "the catalogue can't order")
+                self.ids.extend(ids)
+                self.prices.extend([NAN if price is None else price for price in prices])
+                self.created.extend(created)
+                self.groups.extend([group(category, condition) if shown else 0
+                                    for shown, category, condition in zip(visible, categories, conditions)])
+        except (ValueError, TypeError, OverflowError) as e:
+            self._give_up(e)
+            return
+        for code, n in Counter(self.groups).items():
+            self.group_counts[code] = n
+        # Slots come in id order and sorted() is stable, so ties on the key stay in id order
+        shown = list(compress(range(len(self.ids)), self.groups))
+        self.by_created = array("I", sorted(shown, key=self.created.__getitem__))
+        price_keys = [p if p == p else NEG_INF for p in self.prices]
+        self.by_price = array("I", sorted(shown, key=price_keys.__getitem__))
+        self.seq = seq
+        self.loaded = True
+        self.reloads += 1
+        self.load_seconds = time.perf_counter() - start
+
+    def _give_up(self, reason):
+        print(f"Listings catalogue off, the feed uses SQL: {reason}")
+        self._clear()
+        self.usable = False
+        self.loaded = True
+
+    def sync(self, conn):
+        # Apply the change log since the last sync; reload if it has been trimmed past us
+        if not self.loaded:
+            self.load(conn)
+            return
+        if not self.usable:
+            return
+        changes = conn.execute(CHANGES_SQL, (self.seq, RELOAD_AFTER + 1)).fetchall()
+        if not changes:
+            return
+        if changes[0][0] != self.seq + 1 or len(changes) > RELOAD_AFTER:
+            self.load(conn)
+            return
+        ids = sorted({listing_id for _, listing_id in changes})
+        current = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            marks = ", ".join("?" * len(chunk))
+            for row in conn.execute(f"{ROW_SQL} WHERE id IN ({marks})", chunk):
+                current[row[0]] = tuple(row)
+        try:
+            for listing_id in ids:
+                if not self._apply(listing_id, current.get(listing_id)):
+                    # A new listing with an id below the newest one: rare enough to reload
+                    self.load(conn)
+                    return
+        except (ValueError, TypeError, OverflowError) as e:
+            self._give_up(e)
+            return
+        self.seq = changes[-1][0]
+        self.applied += len(ids)
+        if len(self.deleted) > len(self.ids) // 4 + 1000:
+            self.load(conn)
+
+    def _apply(self, listing_id, row):
+        slot = bisect.bisect_left(self.ids, listing_id)
+        exists = slot < len(self.ids) and self.ids[slot] == listing_id
+        if exists and self.groups[slot]:
+            self._unlist(slot)
+            self.group_counts[self.groups[slot]] -= 1
+        if row is None:
+            if exists:
+                self.groups[slot] = 0
+                self.deleted.add(slot)
+            return True
+
+        _, price, created, visible, category, condition, orderable = row
+        if not orderable:
+            raise ValueError(f"listing {listing_id} has a created_at or price the catalogue can't order")
+        price = NAN if price is None else price
+        group = self._group(category, condition) if visible else 0
+        if exists:
+            self.prices[slot] = price
+            self.created[slot] = created
+            self.groups[slot] = group
+            self.deleted.discard(slot)
+        elif not self.ids or listing_id > self.ids[-1]:
+            self.ids.append(listing_id)
+            self.prices.append(price)
+            self.created.append(created)
+            self.groups.append(group)
+        else:
+            return False
+        if group:
+            self.group_counts[group] += 1
+            bisect.insort(self.by_created, slot, key=self._created_key)
+            bisect.insort(self.by_price, slot, key=self._price_key)
+        return True
+
+    def _unlist(self, slot):
+        # Take a slot out of both sort orders, found by its current key
+        for order, key in ((self.by_created, self._created_key), (self.by_price, self._price_key)):
+            i = bisect.bisect_left(order, key(slot), key=key)
+            if i < len(order) and order[i] == slot:
+                del order[i]
+
+    # Queries
+
+    def _mask(self, conn, category, condition):
+        # bytes indexed by group code: 1 where the group passes the category and condition
+        # filters. Category matching is SQLite's own LIKE, run over the distinct names.
+        cache_key = (category, condition, len(self.group_keys))
+        mask = self._masks.get(cache_key)
+        if mask is None:
+            keys = self.group_keys[1:]
+            if category:
+                matched = {row[0] for row in conn.execute(
+                    "SELECT key FROM json_each(?) WHERE value LIKE ?",
+                    (json.dumps([cat for cat, _ in keys]), f"%{category}%"))}
+            else:
+                matched = range(len(keys))
+            mask = bytes([0]) + bytes(i in matched and (not condition or cond == condition)
+                                      for i, (_, cond) in enumerate(keys))
+            if len(self._masks) >= MAX_MASKS:
+                self._masks.clear()
+            self._masks[cache_key] = mask
+        return mask
+
+    def lookup(self, conn, qs, limit, sort, want_total=False):
+        # Ids of the page for a parse_qs() dict of GET /listings/ (at most limit + 1, as
+        # listings.page_query fetches) and the total count if asked; or None when the
+        # catalogue can't answer this query and SQL should
+        with self._lock:
+            self.sync(conn)
+            self.lookups += 1
+            found = self._lookup(conn, qs, limit, sort, want_total) if self.usable else None
+            if found is None:
+                self.fallbacks += 1
+            return found
+
+    def _lookup(self, conn, qs, limit, sort, want_total):
+        if 'q' in qs or sort not in SORTS:
+            return None
+        low, high = listings.price_range(qs)
+        if any(value is not None and math.isnan(value) for value in (low, high)):
+            return None
+        category = qs['category'][0] if qs.get('category') else ''
+        condition = qs['condition'][0] if qs.get('condition') else ''
+        mask = self._mask(conn, category, condition) if category or condition else None
+
+        by_price = sort != 'newest'
+        key = self._price_key if by_price else self._created_key
+        descending = sort != 'price_low'
+        total = None
+        order, start, end = self.by_price, 0, len(self.by_price)
+        if low is not None or high is not None:
+            # The price order has the range as one run; NULL prices are never in it
+            start = bisect.bisect_left(order, (NEG_INF, math.inf) if low is None else (low, NEG_INF),
+                                       key=self._price_key)
+            if high is not None:
+                end = bisect.bisect_right(order, (high, math.inf), key=self._price_key)
+        if by_price:
+            low = high = None
+        elif (low is not None or high is not None) and end - start <= min(PRICE_ROUTE_MAX, len(order) // 4):
+            # Few listings in the price range: take the matches from it and sort those
+            with memoryview(order) as view, view[start:end] as run:
+                matches = list(self._matching(run, False, mask, ()))
+            matches.sort()  # id order, so the stable sort below breaks ties on id
+            matches.sort(key=self.created.__getitem__)
+            order, start, end, total, mask, low, high = matches, 0, len(matches), len(matches), None, None, None
+        else:
+            order, start, end = self.by_created, 0, len(self.by_created)
+        tests = [bound.__le__ for bound in (low,) if bound is not None]
+        tests += [bound.__ge__ for bound in (high,) if bound is not None]
+
+        page_start, page_end, offset = start, end, 0
+        cursor = qs.get('cursor', [''])[0]
+        if cursor:
+            value, last_id = listings.decode_cursor(cursor, sort)
+            if value is None:
+                # A NULL key: the catalogue sorts those where SQLite does
+                value = NEG_INF if by_price else NO_TIME
+            elif by_price:
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                    return None
+            else:
+                value = _unix_time(value)
+                if value is None:
+                    return None
+            if descending:
+                page_end = min(page_end, bisect.bisect_left(order, (value, last_id), key=key))
+            else:
+                page_start = max(page_start, bisect.bisect_right(order, (value, last_id), key=key))
+        else:
+            offset = listings.parse_int(qs, 'offset', 0, 0, 10 ** 9)
+
+        if isinstance(order, list):
+            slots = list(islice(reversed(order[page_start:page_end]), offset, offset + limit + 1))
+            return [self.ids[slot] for slot in slots], total if want_total else None
+
+        # Views into the arrays must be released before they can change again
+        with memoryview(order) as view:
+            with view[page_start:max(page_start, page_end)] as page:
+                slots = list(islice(self._matching(page, descending, mask, tests), offset, offset + limit + 1))
+            if want_total and not tests and (start, end) == (0, len(order)):
+                # No price filter: the per-group counts have it
+                total = sum(n for code, n in enumerate(self.group_counts) if code and (mask is None or mask[code]))
+            elif want_total:
+                with view[start:end] as run:
+                    total = _count(self._matching(run, False, mask, tests))
+        return [self.ids[slot] for slot in slots], total
+
+    def _matching(self, view, descending, mask, tests):
+        # Iterator over the slots of view that pass the group mask and the price tests
+        items = reversed(view) if descending else iter(view)
+        if mask is not None:
+            probe = reversed(view) if descending else iter(view)
+            items = compress(items, map(mask.__getitem__, map(self.groups.__getitem__, probe)))
+        for test in tests:
+            items, probe = tee(items)
+            items = compress(items, map(test, map(self.prices.__getitem__, probe)))
+        return items
+
+    def stats(self):
+        with self._lock:
+            columns = (self.ids, self.prices, self.created, self.groups, self.by_created, self.by_price)
+            size = sum(len(column) * column.itemsize for column in columns)
+            return {"enabled": ENABLED, "usable": self.usable, "listings": len(self.ids),
+                    "shown": len(self.by_created), "deleted": len(self.deleted),
+                    "groups": len(self.group_keys) - 1, "bytes": size, "seq": self.seq,
+                    "reloads": self.reloads, "load_ms": round(self.load_seconds * 1000, 1),
+                    "applied": self.applied, "lookups": self.lookups, "fallbacks": self.fallbacks}
+
+
+index = Catalogue()
+
+
+def warm(conn):
+    # Load up front (before pre-fork workers are forked, so they share the pages)
+    with index._lock:
+        index.load(conn)
+    stats = index.stats()
+    print(f"Listings catalogue: {stats['listings']} listings, {stats['bytes'] / 1e6:.1f} MB in {stats['load_ms']} ms")
+
+
+if __name__ == "__main__":
+    # python backend/catalogue.py [path/to/marketplace.db]  - load and print the stats
+    import sqlite3
+    path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get(
+        "DB_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "marketplace.db"))
+    conn = sqlite3.connect(path)
+    warm(conn)
+    print(json.dumps(index.stats(), indent=2))
@@ -0,0 +1,119 @@
+import listings
+
+# Read model for GET /dashboard/: the caller's sent requests, incoming requests, own
+# listings and orders, read in one transaction so the sections agree with each other,
+# with each request's order already attached.
+#
+#   ?include=sent,incoming      only these sections (default: sent, incoming, listings)
+#   ?fields[sent]=id,status     only these keys in a section's items; fields[order]
+#                               trims the order nested in each request
+
+SECTIONS = ("sent", "incoming", "listings", "orders")
+DEFAULT_SECTIONS = ("sent", "incoming", "listings")
+
+ORDER_FIELDS = ("id", "request_id", "listing_id", "buyer_id", "seller_id", "shipping_name",
+                "shipping_address", "shipping_phone", "shipping_email", "shipping_pincode",
+                "payment_method", "payment_status", "created_at")
+REQUEST_FIELDS = ("id", "listing_id", "buyer_id", "seller_id", "status", "created_at", "updated_at",
+                  "listing_title", "listing_price", "listing_status", "order")
+FIELDS = {
+    "sent": REQUEST_FIELDS,
+    # Buyer name and city only: contact details stay hidden until there is an order
+    "incoming": REQUEST_FIELDS + ("buyer_name", "buyer_location"),
+    "listings": tuple(c.strip()[2:] for c in listings.LISTING_COLUMNS.split(",")) + ("thumbnail",),
+    "orders": ORDER_FIELDS,
+    "order": ORDER_FIELDS,
+}
+
+REQUEST_COLUMNS = ("br.id, br.listing_id, br.buyer_id, br.seller_id, br.status, br.created_at, br.updated_at, "
+                   "l.title AS listing_title, l.price AS listing_price, l.status AS listing_status")
+
+QUERIES = {
+    "sent": f'''
+        SELECT {REQUEST_COLUMNS}
+        FROM buy_requests br LEFT JOIN listings l ON l.id = br.listing_id
+        WHERE br.buyer_id=? ORDER BY br.id DESC''',
+    "incoming": f'''
+        SELECT {REQUEST_COLUMNS}, u.name AS buyer_name, u.location AS buyer_location
+        FROM buy_requests br JOIN users u ON u.id = br.buyer_id LEFT JOIN listings l ON l.id = br.listing_id
+        WHERE br.seller_id=? ORDER BY br.id DESC''',
+    "listings": f'''
+        SELECT {listings.LISTING_COLUMNS} FROM listings l
+        WHERE l.seller_id=? ORDER BY l.created_at DESC, l.id DESC''',
+}
+# Both sides of the user's orders; each half uses its own index
+ORDERS_QUERY = '''
+    SELECT * FROM orders WHERE buyer_id=?
+    UNION
+    SELECT * FROM orders WHERE seller_id=?
+    ORDER BY created_at DESC, id DESC'''
+
+
+class QueryError(ValueError):
+    pass
+
+
+def parse_include(qs):
+    raw = qs.get('include', [''])[0]
+    if not raw:
+        return DEFAULT_SECTIONS
+    wanted = tuple(s.strip() for s in raw.split(',') if s.strip())
+    unknown = [s for s in wanted if s not in SECTIONS]
+    if unknown:
+        raise QueryError(f"Unknown dashboard section: {unknown[0]}")
+    return wanted
+
+
+def parse_fields(qs):
+    selected = {}
+    for key, values in qs.items():
+        if not (key.startswith('fields[') and key.endswith(']')):
+            continue
+        section = key[len('fields['):-1]
+        if section not in FIELDS:
+            raise QueryError(f"Unknown dashboard section: {section}")
+        names = tuple(n.strip() for n in values[0].split(',') if n.strip())
+        unknown = [n for n in names if n not in FIELDS[section]]
+        if unknown:
+            raise QueryError(f"Unknown field for {section}: {unknown[0]}")
+        selected[section] = names
+    return selected
+
+
+def pick(item, names):
+    return item if names is None or item is None else {n: item.get(n) for n in names}
+
+
+def load(conn, user_id, qs):
+    include = parse_include(qs)
+    fields = parse_fields(qs)
+    result = {}
+    # A read transaction is one WAL snapshot: no section can see a write another missed
+    conn.execute("BEGIN")
+    try:
+        needs_orders = "orders" in include or any(
+            s in include and "order" in fields.get(s, ("order",)) for s in ("sent", "incoming"))
+        orders = [dict(r) for r in conn.execute(ORDERS_QUERY, (user_id, user_id))] if needs_orders else []
+        for section in include:
+            if section == "orders":
+                continue
+            rows = conn.execute(QUERIES[section], (user_id,)).fetchall()
+            if section == "listings":
+                result[section] = [listings.to_json(r) for r in rows]
+            else:
+                result[section] = [dict(r) for r in rows]
+    finally:
+        conn.rollback()
+
+    by_request = {o['request_id']: o for o in orders}
+    for section in ("sent", "incoming"):
+        if section in result:
+            for item in result[section]:
+                item['order'] = pick(by_request.get(item['id']), fields.get('order'))
+    if "orders" in include:
+        result["orders"] = orders
+    for section, items in result.items():
+        names = fields.get(section)
+        if names is not None:
+            result[section] = [pick(item, names) for item in items]
+    return result
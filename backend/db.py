@@ -0,0 +1,197 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+import profiler
+
+# Connection pool settings
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 16))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", 256))
+BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 10000))
+CACHE_SIZE_KB = int(os.environ.get("DB_CACHE_KB", 16384))
+MMAP_SIZE = int(os.environ.get("DB_MMAP_BYTES", 128 * 1024 * 1024))
+SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def open_connection(path):
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           cached_statements=STATEMENT_CACHE,
+                           factory=metrics.TimedConnection if metrics.ENABLED or profiler.ENABLED
+                           else sqlite3.Connection)
+    conn.row_factory = sqlite3.Row
+    if profiler.ENABLED:
+        profiler.attach(conn)
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.OperationalError:
+        pass
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class ConnectionPool:
+    # Fixed-size pool of SQLite connections shared by the request threads.
+    # Pragmas are applied once when a connection is opened; sqlite3 keeps a
+    # per-connection cache of prepared statements, so reusing connections also
+    # reuses compiled queries.
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._hits = 0
+        self._misses = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._checkouts = 0
+        self._checkout_time = 0.0
+        self._checkout_max = 0.0
+
+    def _open(self):
+        return open_connection(self.path)
+
+    def _checkout(self):
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get_nowait()
+            hit, waited = True, False
+        except queue.Empty:
+            conn = None
+            hit, waited = False, False
+            with self._lock:
+                can_open = self._created < self.size
+                if can_open:
+                    self._created += 1
+            if can_open:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                waited = True
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._timeouts += 1
+                    raise PoolTimeout(f"No database connection free after {self.timeout}s")
+        elapsed = time.perf_counter() - start
+        if metrics.ENABLED:
+            metrics.POOL_WAIT.observe(elapsed)
+        if profiler.ENABLED:
+            profiler.wait("pool", elapsed)
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._checkout_time += elapsed
+            self._checkout_max = max(self._checkout_max, elapsed)
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+            if waited:
+                self._waits += 1
+        return conn
+
+    def _release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Broken connection: drop it so a fresh one is opened next time
+            with self._lock:
+                self._created -= 1
+            conn.close()
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "idle": self._idle.qsize(),
+                "checkouts": self._checkouts,
+                "hits": self._hits,
+                "misses": self._misses,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "checkout_avg_ms": round(self._checkout_time / self._checkouts * 1000, 3) if self._checkouts else 0.0,
+                "checkout_max_ms": round(self._checkout_max * 1000, 3),
+            }
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = self._in_use
+
+
+_pool = None
+_pool_path = None
+_pool_lock = threading.Lock()
+
+
+def configure(path):
+    global _pool_path, _pool
+    with _pool_lock:
+        _pool_path = path
+        _pool = None
+
+
+def get_pool():
+    global _pool
+    pool = _pool
+    # A pool inherited across fork() holds the parent's connections; start fresh
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = ConnectionPool(_pool_path)
+            pool = _pool
+    return pool
+
+
+def connection():
+    return get_pool().connection()
+
+
+def database_path():
+    return _pool_path
+
+
+def pool_stats():
+    return get_pool().stats()
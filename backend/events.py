@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+import db
+import serving
+import writer
+
+# Per-user notifications pushed over Server-Sent Events (GET /events/).
+#
+# Events are rows in the events table, written in the same transaction as the change they
+# describe, so the row id is a durable SSE event id that Last-Event-ID can resume from.
+# Each process keeps the recent events of each user in a ring buffer, filled by pull():
+# right after a local commit, and once a second from a poller thread while anyone is
+# subscribed, which is how events written by other pre-fork workers arrive.
+BUFFER_SIZE = int(os.environ.get("SSE_BUFFER", 100))
+MAX_USERS = int(os.environ.get("SSE_BUFFER_USERS", 10000))
+POLL_INTERVAL = float(os.environ.get("SSE_POLL_INTERVAL", 1))
+HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", 15))
+# Streams end after this long; EventSource reconnects on its own with Last-Event-ID
+MAX_AGE = float(os.environ.get("SSE_MAX_AGE", 300))
+# Streams that hold a server thread (every mode but async) are capped, by default at half
+# the pool so streams never take the threads requests need. Clients turned away poll
+# GET /events/poll instead.
+MAX_THREAD_STREAMS = int(os.environ.get("SSE_MAX_THREAD_STREAMS", max(1, serving.THREADS // 2)))
+RETENTION = float(os.environ.get("EVENTS_RETENTION", 7 * 86400))
+RETRY_MS = 3000
+PING = b": ping\n\n"
+
+thread_streams = threading.BoundedSemaphore(MAX_THREAD_STREAMS)
+
+
+def record(conn, user_ids, event_type, data):
+    # Log an event for each user inside the caller's transaction. After committing, call
+    # bus.pull() so this process's subscribers hear about it straight away.
+    payload = json.dumps(data)
+    now = time.time()
+    conn.executemany("INSERT INTO events (user_id, type, data, created_at) VALUES (?, ?, ?, ?)",
+                     [(uid, event_type, payload, now) for uid in set(user_ids) if uid is not None])
+
+
+def _delete_before(conn, cutoff):
+    conn.execute("DELETE FROM events WHERE created_at < ?", (cutoff,))
+
+
+def format_event(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {data}\n\n".encode()
+
+
+class UserBuffer:
+    __slots__ = ("events", "floor")
+
+    def __init__(self, floor):
+        self.events = deque()
+        # Every event of this user with an id above floor is in self.events
+        self.floor = floor
+
+
+class Subscription:
+    # One client's stream: the user's events after last_id
+
+    def __init__(self, bus, user_id, last_id):
+        self.bus = bus
+        self.user_id = user_id
+        self.last_id = last_id
+        self.heartbeat = HEARTBEAT
+        self.expires_at = time.monotonic() + MAX_AGE
+        self.closed = False
+        self.waker = None  # extra wake-up callback (the async server's)
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+        waker = self.waker
+        if waker:
+            waker()
+
+    def wait(self, timeout):
+        fired = self._wake.wait(timeout)
+        self._wake.clear()
+        return fired
+
+    def finished(self):
+        return self.closed or self.bus.closed or time.monotonic() >= self.expires_at
+
+    def poll(self, heartbeat=False):
+        # Bytes to send now: pending events, else a keep-alive comment if heartbeat is set
+        events, seen = self.bus.events_after(self.user_id, self.last_id)
+        self.last_id = max(self.last_id, seen)
+        if events:
+            return b"".join(format_event(*e) for e in events)
+        return PING if heartbeat else b""
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.bus.unsubscribe(self)
+
+
+class EventBus:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pull_lock = threading.Lock()
+        self._buffers = OrderedDict()
+        self._subscribers = {}
+        # Highest event id pulled so far, and the floor for users without a buffer
+        self._last_id = None
+        self._floor = 0
+        self._poller = None
+        self._stop = threading.Event()
+        self._pruned_at = 0
+        self.closed = False
+
+    def _ensure_started(self):
+        if self._last_id is not None:
+            return
+        with db.connection() as conn:
+            last = conn.execute("SELECT MAX(id) FROM events").fetchone()[0] or 0
+        with self._lock:
+            if self._last_id is None:
+                self._last_id = self._floor = last
+
+    def last_id(self):
+        self._ensure_started()
+        return self._last_id
+
+    def subscribe(self, user_id, last_id=None):
+        # last_id=None starts from now; otherwise replay what the client missed
+        self._ensure_started()
+        sub = Subscription(self, user_id, self._last_id if last_id is None else last_id)
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(sub)
+            if self._poller is None:
+                self._poller = threading.Thread(target=self._poll_loop, name="events-poller", daemon=True)
+                self._poller.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.user_id)
+            if subs:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.user_id]
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(s) for s in self._subscribers.values())
+
+    def events_after(self, user_id, last_id):
+        # Returns (events, seen): the user's events after last_id, and the id the caller
+        # has now seen everything up to
+        with self._lock:
+            buf = self._buffers.get(user_id)
+            floor = buf.floor if buf is not None else self._floor
+            upto = self._last_id
+            if last_id >= floor:
+                events = [e for e in buf.events if e[0] > last_id] if buf is not None else []
+                return events, upto
+        # The client is further behind than this process remembers: read the table
+        with db.connection() as conn:
+            rows = conn.execute("SELECT id, type, data FROM events WHERE user_id=? AND id > ? AND id <= ? "
+                                "ORDER BY id LIMIT ?", (user_id, last_id, upto, BUFFER_SIZE)).fetchall()
+        events = [tuple(r) for r in rows]
+        return events, (events[-1][0] if len(events) == BUFFER_SIZE else upto)
+
+    def catch_up(self, user_id, last_id=None):
+        # For a client polling instead of streaming: (events, seen) as in events_after.
+        # last_id=None starts from now.
+        self.pull()
+        return self.events_after(user_id, self.last_id() if last_id is None else last_id)
+
+    def pull(self):
+        # Move events newer than the last pulled id into the user buffers and wake the
+        # subscribers they concern
+        self._ensure_started()
+        woken = set()
+        with self._pull_lock:
+            with db.connection() as conn:
+                while True:
+                    rows = conn.execute("SELECT id, user_id, type, data FROM events WHERE id > ? ORDER BY id LIMIT 1000",
+                                        (self._last_id,)).fetchall()
+                    if not rows:
+                        break
+                    with self._lock:
+                        for event_id, user_id, event_type, data in rows:
+                            buf = self._buffers.get(user_id)
+                            if buf is None:
+                                buf = self._buffers[user_id] = UserBuffer(self._floor)
+                                while len(self._buffers) > MAX_USERS:
+                                    _, evicted = self._buffers.popitem(last=False)
+                                    if evicted.events:
+                                        self._floor = max(self._floor, evicted.events[-1][0])
+                            else:
+                                self._buffers.move_to_end(user_id)
+                            if len(buf.events) >= BUFFER_SIZE:
+                                buf.floor = buf.events.popleft()[0]
+                            buf.events.append((event_id, event_type, data))
+                            woken.update(self._subscribers.get(user_id, ()))
+                        self._last_id = rows[-1][0]
+                    if len(rows) < 1000:
+                        break
+        self._prune()
+        for sub in woken:
+            sub.wake()
+
+    def _prune(self):
+        now = time.time()
+        if now - self._pruned_at < 3600:
+            return
+        self._pruned_at = now
+        # Through the write queue, without waiting for it
+        try:
+            writer.get_writer().submit(_delete_before, now - RETENTION)
+        except writer.WriterBusy:
+            self._pruned_at = 0
+
+    def _poll_loop(self):
+        while not self._stop.wait(POLL_INTERVAL):
+            with self._lock:
+                if not self._subscribers:
+                    self._poller = None
+                    return
+            try:
+                self.pull()
+            except Exception as e:
+                print(f"Event poll error: {e}")
+
+    def close(self):
+        # Server shutting down: end every open stream
+        self.closed = True
+        self._stop.set()
+        with self._lock:
+            subs = [s for group in self._subscribers.values() for s in group]
+        for sub in subs:
+            sub.wake()
+
+
+bus = EventBus()
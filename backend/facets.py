@@ -0,0 +1,264 @@
+import bisect
+import os
+import sys
+
+import listings
+
+# Facet counts for the browse filters (GET /listings/facets): how many listings match the
+# current filters in each category, condition and price bucket.
+#
+# listing_facets holds one count per (status, category, condition, price bucket). Triggers
+# on listings keep it current on every insert, delete and update of those columns, in the
+# same transaction as the change, the same way the FTS index is kept in sync. Answering a
+# request reads the few hundred cube rows instead of grouping the listings table.
+#
+# Counts are disjunctive: each facet is counted with every filter applied except its own,
+# so the category list still shows the other categories while one is selected.
+#
+# A price range that doesn't fall on bucket edges is answered from the cube for the buckets
+# it covers whole, plus indexed range scans of idx_listings_price for the (at most two)
+# buckets it cuts. With a search term (q) the matches are grouped directly instead.
+
+# Bucket b holds PRICE_EDGES[b-1] <= price < PRICE_EDGES[b]; the first and last buckets
+# are open-ended. Prices without a value go in bucket -1, which no price range includes.
+# Finer buckets mean fewer rows to scan in the buckets a price filter cuts, and a bigger
+# cube; the response merges them into the coarser PRICE_FACETS ranges, whose edges must
+# all be in PRICE_EDGES.
+PRICE_EDGES = (10, 15, 20, 25, 30, 40, 50, 60, 75, 100, 125, 150, 200, 250, 300, 400, 500, 750,
+               1000, 1500, 2000, 3000, 5000, 10000)
+PRICE_FACETS = (25, 50, 100, 250, 500, 1000, 2000, 5000)
+MAX_VALUES = 50  # categories are free text; only the biggest are returned
+
+STATUSES = "('active', 'sold')"  # what the browse feed shows, as in listings.build_filters
+
+
+def bucket_sql(column):
+    whens = " ".join(f"WHEN {column} < {edge} THEN {i}" for i, edge in enumerate(PRICE_EDGES))
+    return f"CASE WHEN {column} IS NULL THEN -1 {whens} ELSE {len(PRICE_EDGES)} END"
+
+
+def bucket_bounds(bucket, edges=PRICE_EDGES):
+    # (lower, upper) of a bucket; None for an open end
+    lower = edges[bucket - 1] if bucket > 0 else None
+    upper = edges[bucket] if bucket < len(edges) else None
+    return lower, upper
+
+
+def facet_range(bucket):
+    # The PRICE_FACETS range a cube bucket belongs to
+    lower = bucket_bounds(bucket)[0]
+    return 0 if lower is None else bisect.bisect_right(PRICE_FACETS, lower)
+
+
+def _key(prefix):
+    return (f"COALESCE({prefix}.status, ''), COALESCE({prefix}.category, ''), "
+            f"COALESCE({prefix}.condition, ''), {bucket_sql(prefix + '.price')}")
+
+
+_ADD = f'''
+        INSERT INTO listing_facets (status, category, condition, bucket, n) VALUES ({_key("new")}, 1)
+        ON CONFLICT (status, category, condition, bucket) DO UPDATE SET n = n + 1;'''
+_REMOVE = f'''
+        UPDATE listing_facets SET n = n - 1 WHERE (status, category, condition, bucket) = ({_key("old")});'''
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS listing_facets (
+        status TEXT NOT NULL,
+        category TEXT NOT NULL,
+        condition TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (status, category, condition, bucket)
+    ) WITHOUT ROWID''',
+    f"CREATE TRIGGER IF NOT EXISTS listing_facets_ai AFTER INSERT ON listings BEGIN {_ADD}\n    END",
+    f"CREATE TRIGGER IF NOT EXISTS listing_facets_ad AFTER DELETE ON listings BEGIN {_REMOVE}\n    END",
+    f'''CREATE TRIGGER IF NOT EXISTS listing_facets_au AFTER UPDATE OF status, category, condition, price ON listings
+    WHEN ({_key("old")}) IS NOT ({_key("new")}) BEGIN {_REMOVE} {_ADD}
+    END''',
+]
+
+COMPUTE_SQL = f"SELECT {_key('l')}, COUNT(*) FROM listings l GROUP BY 1, 2, 3, 4"
+
+
+def setup(conn):
+    # One statement at a time: executescript() would commit the caller's transaction
+    for sql in SCHEMA:
+        conn.execute(sql)
+
+
+def compute(conn):
+    # Every cube row recomputed from listings: {(status, category, condition, bucket): n}
+    return {tuple(r[:4]): r[4] for r in conn.execute(COMPUTE_SQL)}
+
+
+def stored(conn):
+    return {tuple(r[:4]): r[4] for r in conn.execute(
+        "SELECT status, category, condition, bucket, n FROM listing_facets WHERE n != 0")}
+
+
+def rebuild(conn):
+    # Caller commits
+    conn.execute("DELETE FROM listing_facets")
+    conn.executemany("INSERT INTO listing_facets (status, category, condition, bucket, n) VALUES (?, ?, ?, ?, ?)",
+                     [(*key, n) for key, n in compute(conn).items()])
+
+
+def verify(conn):
+    # Returns a list of (key, stored count, expected count) that disagree
+    expected, actual = compute(conn), stored(conn)
+    return [(key, actual.get(key, 0), expected.get(key, 0))
+            for key in sorted(set(expected) | set(actual)) if actual.get(key, 0) != expected.get(key, 0)]
+
+
+def _covered(bucket, low, high):
+    # Whether every price in the bucket is inside [low, high]
+    if bucket < 0:
+        return low is None and high is None
+    lower, upper = bucket_bounds(bucket)
+    return ((low is None or (lower is not None and lower >= low)) and
+            (high is None or (upper is not None and upper <= high)))
+
+
+def _cut(bucket, low, high):
+    # (from, below, up to) bounds of the part of a bucket inside [low, high], when the
+    # range covers some but not all of it; else None
+    if bucket < 0 or _covered(bucket, low, high):
+        return None
+    lower, upper = bucket_bounds(bucket)
+    start = low if lower is None else lower if low is None else max(lower, low)
+    if start is not None and ((upper is not None and start >= upper) or (high is not None and start > high)):
+        return None
+    return start, upper, high
+
+
+def _category_flag(prefix, category, params):
+    # SELECT column telling whether a row passes the category filter (same LIKE as the feed)
+    if not category:
+        return "1"
+    params.append(f"%{category}%")
+    return f"{prefix}.category LIKE ?"
+
+
+def _scan(conn, category, bounds, bucket, sign):
+    # Cube-shaped rows for the listings with a price within bounds [(op, value)], counted
+    # sign times; they count toward the other facets only
+    params = []
+    flag = _category_flag("l", category, params)
+    where = [f"l.status IN {STATUSES}"]
+    for op, value in bounds:
+        if value is not None:
+            where.append(f"l.price {op} ?")
+            params.append(value)
+    return [(r[0], r[1], bucket, sign * r[2], r[3], True, False) for r in conn.execute(
+        f"SELECT COALESCE(l.category, ''), COALESCE(l.condition, ''), COUNT(*), {flag} FROM listings l "
+        f"WHERE {' AND '.join(where)} GROUP BY 1, 2", params)]
+
+
+def _from_cube(conn, category, low, high):
+    # Rows: (category, condition, bucket, n, category matches, in price range, counts for price)
+    params = []
+    flag = _category_flag("f", category, params)
+    cube = [(r[0], r[1], r[2], r[3], r[4], _covered(r[2], low, high), True) for r in conn.execute(
+        f"SELECT f.category, f.condition, f.bucket, SUM(f.n), {flag} FROM listing_facets f "
+        f"WHERE f.status IN {STATUSES} GROUP BY f.category, f.condition, f.bucket HAVING SUM(f.n) > 0", params)]
+    rows = list(cube)
+
+    # Buckets the range only partly covers: count the rows inside it through the price
+    # index, or when it covers most of a closed bucket, take the bucket's cube rows and
+    # subtract the rows outside
+    if low is not None or high is not None:
+        for bucket in range(len(PRICE_EDGES) + 1):
+            cut = _cut(bucket, low, high)
+            if cut is None:
+                continue
+            start, upper, end = cut
+            lower = bucket_bounds(bucket)[0]
+            top = upper if end is None else min(end, upper or end)
+            if lower is None or upper is None or (top - start) * 2 <= upper - lower:
+                rows.extend(_scan(conn, category, ((">=", start), ("<", upper), ("<=", end)), bucket, 1))
+                continue
+            rows.extend((c, d, b, n, ok, True, False) for c, d, b, n, ok, _, _ in cube if b == bucket)
+            if start > lower:
+                rows.extend(_scan(conn, category, ((">=", lower), ("<", start)), bucket, -1))
+            if end is not None and end < upper:
+                rows.extend(_scan(conn, category, ((">", end), ("<", upper)), bucket, -1))
+    return rows
+
+
+def _from_scan(conn, source, where, params, category, low, high):
+    # Same rows as _from_cube, grouped straight from the listings matching a search
+    select_params = []
+    flag = _category_flag("l", category, select_params)
+    in_range = ["1"]
+    for value, op in ((low, ">="), (high, "<=")):
+        if value is not None:
+            in_range.append(f"l.price {op} ?")
+            select_params.append(value)
+    return [(r[0], r[1], r[2], r[3], r[4], bool(r[5]), True) for r in conn.execute(
+        f"SELECT COALESCE(l.category, ''), COALESCE(l.condition, ''), {bucket_sql('l.price')}, COUNT(*), {flag}, "
+        f"{' AND '.join(in_range)} FROM {source} WHERE {' AND '.join(where)} GROUP BY 1, 2, 3, 5, 6", select_params + params)]
+
+
+def counts(conn, qs):
+    # Facet counts for a parse_qs() dict of GET /listings/ filters
+    category = qs['category'][0] if qs.get('category') else ''
+    condition = qs['condition'][0] if qs.get('condition') else ''
+    low, high = listings.price_range(qs)
+
+    # Only the search narrows the rows the cube can't see; filter on it by grouping the matches
+    source, where, params = listings.build_filters({'q': qs['q']} if 'q' in qs else {})
+    if len(where) > 1:
+        rows, origin = _from_scan(conn, source, where, params, category, low, high), "scan"
+    else:
+        rows, origin = _from_cube(conn, category, low, high), "index"
+
+    total = 0
+    by_category, by_condition, by_price = {}, {}, {}
+    for cat, cond, bucket, n, category_ok, in_range, priced in rows:
+        condition_ok = not condition or cond == condition
+        if in_range and category_ok and condition_ok:
+            total += n
+        if in_range and condition_ok:
+            by_category[cat] = by_category.get(cat, 0) + n
+        if in_range and category_ok:
+            by_condition[cond] = by_condition.get(cond, 0) + n
+        if priced and category_ok and condition_ok and bucket >= 0:
+            price_range = facet_range(bucket)
+            by_price[price_range] = by_price.get(price_range, 0) + n
+
+    def ranked(totals):
+        items = sorted(((v, n) for v, n in totals.items() if n > 0 and v), key=lambda item: (-item[1], item[0]))
+        return [{"value": v, "count": n} for v, n in items[:MAX_VALUES]]
+
+    return {
+        "total": total,
+        "category": ranked(by_category),
+        "condition": ranked(by_condition),
+        "price": [dict(zip(("min", "max"), bucket_bounds(r, PRICE_FACETS)), count=n)
+                  for r, n in sorted(by_price.items()) if n > 0],
+        "source": origin,
+    }
+
+
+if __name__ == "__main__":
+    # python backend/facets.py [rebuild|verify] [path/to/marketplace.db]
+    import db
+    import migrations
+    command = sys.argv[1] if len(sys.argv) > 1 else "verify"
+    path = sys.argv[2] if len(sys.argv) > 2 else os.environ.get(
+        "DB_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "marketplace.db"))
+    db.configure(path)
+    with db.connection() as conn:
+        migrations.migrate(conn)
+        if command == "rebuild":
+            conn.execute("BEGIN IMMEDIATE")
+            rebuild(conn)
+            conn.commit()
+            print(f"Rebuilt {len(stored(conn))} facet rows")
+        elif command != "verify":
+            sys.exit("usage: facets.py [rebuild|verify] [db]")
+        problems = verify(conn)
+        for key, have, want in problems:
+            print(f"Mismatch {key!r}: stored {have}, expected {want}")
+        print("Facets OK" if not problems else f"{len(problems)} facet rows differ")
+        sys.exit(1 if problems else 0)
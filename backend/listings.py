@@ -0,0 +1,221 @@
+import base64
+import json
+import re
+
+import photos
+
+# Query building for GET /listings/
+
+LISTING_COLUMNS = "l.id, l.seller_id, l.title, l.category, l.brand, l.model, l.condition, l.seller_price, l.price, l.location, l.description, l.status, l.working_parts, l.photos, l.created_at"
+
+DEFAULT_LIMIT = 60
+MAX_LIMIT = 200
+
+# sort name -> (sort key, SQL expression, direction). Every order is made total by breaking
+# ties on id in the same direction, which is what lets a (key, id) pair act as a keyset cursor.
+# SQLite sorts NULL keys (a listing without a price or created_at) first, so they come at the
+# start of an ascending order and the end of a descending one; cursors follow them there.
+SORTS = {
+    'newest': ('created_at', 'l.created_at', 'DESC'),
+    'price_low': ('price', 'l.price', 'ASC'),
+    'price_high': ('price', 'l.price', 'DESC'),
+    # Only with an FTS search; bm25() is negative, lower means a better match
+    'relevance': ('rank', 'bm25(listings_fts)', 'ASC'),
+}
+
+# Full-text search over title/brand/model/description. Set by init_db once it knows
+# whether this SQLite build has FTS5; otherwise q falls back to LIKE scans.
+FTS_ENABLED = False
+
+FTS_SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+        title, brand, model, description,
+        content='listings', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    );
+    CREATE TRIGGER IF NOT EXISTS listings_fts_ai AFTER INSERT ON listings BEGIN
+        INSERT INTO listings_fts(rowid, title, brand, model, description)
+        VALUES (new.id, new.title, new.brand, new.model, new.description);
+    END;
+    CREATE TRIGGER IF NOT EXISTS listings_fts_ad AFTER DELETE ON listings BEGIN
+        INSERT INTO listings_fts(listings_fts, rowid, title, brand, model, description)
+        VALUES ('delete', old.id, old.title, old.brand, old.model, old.description);
+    END;
+    CREATE TRIGGER IF NOT EXISTS listings_fts_au AFTER UPDATE OF title, brand, model, description ON listings BEGIN
+        INSERT INTO listings_fts(listings_fts, rowid, title, brand, model, description)
+        VALUES ('delete', old.id, old.title, old.brand, old.model, old.description);
+        INSERT INTO listings_fts(rowid, title, brand, model, description)
+        VALUES (new.id, new.title, new.brand, new.model, new.description);
+    END;
+'''
+
+SNIPPET = "snippet(listings_fts, -1, '<mark>', '</mark>', '…', 12) AS snippet"
+
+
+class QueryError(ValueError):
+    pass
+
+
+def setup_fts(conn):
+    # Create the index and its sync triggers. Returns False if FTS5 isn't compiled in.
+    try:
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='listings_fts'").fetchone()
+        conn.executescript(FTS_SCHEMA)
+    except Exception as e:
+        print(f"FTS5 unavailable, search falls back to LIKE: {e}")
+        return False
+    if not exists:
+        conn.execute("INSERT INTO listings_fts(listings_fts) VALUES ('rebuild')")
+    return True
+
+
+def fts_query(text):
+    # Each word becomes a quoted prefix term, so user input can't inject FTS syntax
+    terms = re.findall(r"\w+", text)
+    return " ".join(f'"{t}"*' for t in terms)
+
+
+def search_text(qs):
+    return qs['q'][0] if 'q' in qs else ''
+
+
+def build_filters(qs):
+    # (FROM clause, WHERE list, params) for the browse filters in a parse_qs() dict
+    source = "listings l"
+    where = ["l.status IN ('active', 'sold')"]
+    params = []
+
+    # 1. Search (q)
+    if 'q' in qs:
+        if FTS_ENABLED:
+            match = fts_query(search_text(qs))
+            if match:
+                source = "listings_fts JOIN listings l ON l.id = listings_fts.rowid"
+                where.append("listings_fts MATCH ?")
+                params.append(match)
+        else:
+            search_term = f"%{search_text(qs)}%"
+            where.append("(l.title LIKE ? OR l.brand LIKE ? OR l.model LIKE ? OR l.description LIKE ?)")
+            params.extend([search_term, search_term, search_term, search_term])
+
+    # 2. Category
+    if 'category' in qs and qs['category'][0]:
+        where.append("l.category LIKE ?")
+        params.append(f"%{qs['category'][0]}%")
+
+    # 3. Condition
+    if 'condition' in qs and qs['condition'][0]:
+        where.append("l.condition=?")
+        params.append(qs['condition'][0])
+
+    # 4. Price Range
+    for value, op in zip(price_range(qs), ('>=', '<=')):
+        if value is not None:
+            where.append(f"l.price {op} ?")
+            params.append(value)
+
+    return source, where, params
+
+
+def price_range(qs):
+    # (min_price, max_price) as floats; None where missing or not a number
+    bounds = []
+    for name in ('min_price', 'max_price'):
+        try:
+            bounds.append(float(qs[name][0]) if name in qs and qs[name][0] else None)
+        except ValueError:
+            bounds.append(None)
+    return tuple(bounds)
+
+
+def sort_order(qs, searching):
+    sort = qs.get('sort', ['newest'])[0]
+    if sort == 'relevance' and not searching:
+        return 'newest'
+    return sort if sort in SORTS else 'newest'
+
+
+def encode_cursor(sort, row):
+    key = SORTS[sort][0]
+    raw = json.dumps([sort, row[key], row['id']], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key, last_id = json.loads(raw)
+        last_id = int(last_id)
+    except (ValueError, TypeError):
+        raise QueryError("Invalid cursor")
+    if cursor_sort != sort:
+        raise QueryError("Cursor does not match sort order")
+    return key, last_id
+
+
+def parse_int(qs, name, default, minimum, maximum):
+    if name not in qs or qs[name][0] == '':
+        return default
+    try:
+        value = int(qs[name][0])
+    except ValueError:
+        raise QueryError(f"Invalid {name}")
+    return max(minimum, min(value, maximum))
+
+
+def page_query(qs):
+    # Returns (sql, params, limit, sort). The SQL fetches limit + 1 rows so the caller
+    # can tell whether another page exists without a COUNT.
+    source, where, params = build_filters(qs)
+    searching = source.startswith("listings_fts")
+    sort = sort_order(qs, searching)
+    key, expr, direction = SORTS[sort]
+    limit = parse_int(qs, 'limit', DEFAULT_LIMIT, 1, MAX_LIMIT)
+
+    columns = LISTING_COLUMNS
+    if searching:
+        columns += f", bm25(listings_fts) AS rank, {SNIPPET}"
+
+    offset = 0
+    cursor = qs.get('cursor', [''])[0]
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort)
+        op = '<' if direction == 'DESC' else '>'
+        if value is None:
+            # Ascending: the rest of the NULLs, then every other key. Descending: NULLs are last.
+            rest = f" OR {expr} IS NOT NULL" if direction == 'ASC' else ""
+            where.append(f"(({expr} IS NULL AND l.id {op} ?){rest})")
+            params.append(last_id)
+        else:
+            nulls = f" OR {expr} IS NULL" if direction == 'DESC' else ""
+            where.append(f"({expr} {op} ? OR ({expr} = ? AND l.id {op} ?){nulls})")
+            params.extend([value, value, last_id])
+    else:
+        offset = parse_int(qs, 'offset', 0, 0, 10 ** 9)
+
+    query = (f"SELECT {columns} FROM {source} WHERE {' AND '.join(where)} "
+             f"ORDER BY {expr} {direction}, l.id {direction} LIMIT ? OFFSET ?")
+    return query, params + [limit + 1, offset], limit, sort
+
+
+def count_query(qs):
+    source, where, params = build_filters(qs)
+    return f"SELECT COUNT(*) FROM {source} WHERE {' AND '.join(where)}", params
+
+
+def to_json(row):
+    # API shape of a listing row: photos decoded, plus the grid thumbnail
+    item = dict(row)
+    item.pop('rank', None)
+    item['photos'] = json.loads(item['photos']) if item['photos'] else []
+    item['thumbnail'] = photos.thumb_url(item['photos'][0]) if item['photos'] else None
+    return item
+
+
+def display_price(seller_price):
+    # What buyers pay for what the seller asks: +10% and a flat 20
+    return round(seller_price * 1.10 + 20, 2)
+
+
+def wants_total(qs):
+    return qs.get('count', [''])[0].lower() in ('1', 'true', 'yes')
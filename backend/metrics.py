@@ -0,0 +1,208 @@
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+
+# Request and database instrumentation, served in the Prometheus text format on the
+# admin-only GET /metrics.
+#
+# With METRICS=0 nothing is wrapped or recorded: the handler and the connection pool each
+# check ENABLED once and take their plain paths. Counters live in this process only, so
+# in pre-fork mode a scrape sees the worker that answered it (process_info names it).
+ENABLED = os.environ.get("METRICS", "1") != "0"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join('{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                     for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=(), kind="counter"):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.kind = kind
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in items]
+        return lines
+
+
+class Gauge(Counter):
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels, kind="gauge")
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # label values -> [per-bucket counts..., +Inf count], sum
+        self._lock = threading.Lock()
+
+    def observe(self, value, *values):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(values)
+            if entry is None:
+                entry = self._values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def render(self):
+        with self._lock:
+            items = sorted((k, (list(v[0]), v[1])) for k, v in self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for key, (counts, total) in items:
+            running = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                running += n
+                lines.append(f"{self.name}_bucket{_labels(names, key + (bound,))} {running}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {round(total, 6)}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {running}")
+        return lines
+
+
+REQUESTS = Counter("http_requests_total", "Requests handled, by route pattern, method and status",
+                   ("route", "method", "status"))
+LATENCY = Histogram("http_request_duration_seconds", "Time from dispatch to the end of the response",
+                    ("route", "method"))
+BYTES_SENT = Counter("http_response_bytes_total", "Response bytes written, headers included",
+                     ("route", "method"))
+IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being handled right now")
+QUERY_TIME = Histogram("sqlite_query_duration_seconds",
+                       "Time in sqlite3 execute and fetch calls, by statement kind", ("op",))
+POOL_WAIT = Histogram("sqlite_pool_wait_seconds", "Time spent checking a connection out of the pool")
+LOCK_WAIT = Histogram("sqlite_write_lock_wait_seconds", "Time the writer waited in BEGIN IMMEDIATE")
+QUEUE_WAIT = Histogram("sqlite_write_queue_wait_seconds", "Time a write waited in the writer's queue")
+COMMIT_TIME = Histogram("sqlite_write_batch_duration_seconds", "Time to run and commit one batch of writes")
+BATCH_SIZE = Histogram("sqlite_write_batch_size", "Writes per group commit", buckets=SIZE_BUCKETS)
+WRITE_RESULTS = Counter("sqlite_writes_total", "Queued writes by outcome: ok, error, failed_commit, rejected",
+                        ("outcome",))
+
+REGISTRY = (REQUESTS, LATENCY, BYTES_SENT, IN_FLIGHT, QUERY_TIME, POOL_WAIT, LOCK_WAIT, QUEUE_WAIT,
+            COMMIT_TIME, BATCH_SIZE, WRITE_RESULTS)
+
+
+def render(gauges=()):
+    # Exposition text. gauges: extra (name, help, value) read at scrape time
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    for name, help, value in gauges:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+    lines += ["# HELP process_info The process that answered this scrape", "# TYPE process_info gauge",
+              f"process_info{_labels(('pid',), (os.getpid(),))} 1"]
+    return ("\n".join(lines) + "\n").encode()
+
+
+class CountingWriter:
+    # Wraps a handler's wfile for one request to count what goes out through it
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.sent = 0
+
+    def write(self, data):
+        self.sent += len(data)
+        return self.raw.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+def _op(sql):
+    word = sql.lstrip().split(None, 1)
+    return word[0].lower() if word else ""
+
+
+# Set by profiler.py while request tracing is on: called as query_hook(sql, kind, seconds)
+# after every timed call, on the thread that made it
+query_hook = None
+
+
+def _timed(sql, kind, start):
+    elapsed = time.perf_counter() - start
+    if ENABLED:
+        QUERY_TIME.observe(elapsed, kind)
+    if query_hook is not None:
+        query_hook(sql, kind, elapsed)
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Row iteration (for row in cursor) isn't timed: only execute and the fetch calls are
+    sql = None
+
+    def execute(self, sql, parameters=()):
+        self.sql = sql
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _timed(sql, _op(sql), start)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.sql = sql
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _timed(sql, _op(sql), start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            _timed(self.sql, "fetch", start)
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            _timed(self.sql, "fetch", start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            _timed(self.sql, "fetch", start)
+
+
+class TimedConnection(sqlite3.Connection):
+    # Connection factory for db.open_connection() while metrics or profiling are on
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
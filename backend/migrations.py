@@ -0,0 +1,316 @@
+import os
+import sqlite3
+import sys
+
+import catalogue
+import facets
+import photos
+import rollups
+
+# Versioned schema migrations. Each entry runs once, in its own transaction, and is
+# recorded in schema_version. Append new migrations to the end; never edit applied ones.
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _base_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            role TEXT DEFAULT 'buyer',
+            location TEXT,
+            phone TEXT
+        )''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS listings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            seller_id INTEGER,
+            title TEXT,
+            category TEXT,
+            brand TEXT,
+            model TEXT,
+            condition TEXT,
+            seller_price REAL, -- Amount seller receives
+            price REAL, -- Amount buyer pays (Display Price)
+            location TEXT,
+            description TEXT,
+            status TEXT DEFAULT 'active',
+            working_parts TEXT,
+            photos TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(seller_id) REFERENCES users(id)
+        )''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS buy_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            listing_id INTEGER,
+            buyer_id INTEGER,
+            seller_id INTEGER,
+            status TEXT DEFAULT 'pending',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(listing_id) REFERENCES listings(id)
+        )''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id INTEGER,
+            listing_id INTEGER,
+            buyer_id INTEGER,
+            seller_id INTEGER,
+            shipping_name TEXT,
+            shipping_address TEXT,
+            shipping_phone TEXT,
+            shipping_email TEXT,
+            shipping_pincode TEXT,
+            payment_method TEXT,
+            payment_status TEXT DEFAULT 'paid',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(request_id) REFERENCES buy_requests(id)
+        )''')
+
+
+def _users_phone(conn):
+    if 'phone' not in _columns(conn, 'users'):
+        conn.execute("ALTER TABLE users ADD COLUMN phone TEXT")
+
+
+def _listings_seller_price(conn):
+    if 'seller_price' not in _columns(conn, 'listings'):
+        conn.execute("ALTER TABLE listings ADD COLUMN seller_price REAL")
+    # Backfill existing listings: seller_price = price
+    conn.execute("UPDATE listings SET seller_price = price WHERE seller_price IS NULL")
+
+
+def _buy_requests_updated_at(conn):
+    # Used by the accept path and /admin/sold_items but was never created
+    if 'updated_at' not in _columns(conn, 'buy_requests'):
+        conn.execute("ALTER TABLE buy_requests ADD COLUMN updated_at DATETIME")
+    conn.execute("UPDATE buy_requests SET updated_at = created_at WHERE updated_at IS NULL")
+
+
+def _externalize_photos(conn):
+    converted = photos.externalize_legacy(conn)
+    if converted:
+        print(f"Moved photos of {converted} listings to {photos.PHOTO_DIR}")
+
+
+INDEXES = [
+    # Browse feed: one index per sort order, walked in order so a page stops after LIMIT rows
+    # (keyset cursors compare (key, id)). Nearly every listing is active or sold, so a
+    # status index would only tempt the planner into sorting the whole table.
+    "CREATE INDEX IF NOT EXISTS idx_listings_created ON listings(created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_listings_price ON listings(price, id)",
+    "CREATE INDEX IF NOT EXISTS idx_listings_seller ON listings(seller_id, status)",
+    # Buyer / seller dashboards, duplicate-request check, accept and admin deletes
+    "CREATE INDEX IF NOT EXISTS idx_buy_requests_buyer ON buy_requests(buyer_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_buy_requests_seller ON buy_requests(seller_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_buy_requests_listing ON buy_requests(listing_id, buyer_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_buy_requests_status_updated ON buy_requests(status, updated_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_buyer ON orders(buyer_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_seller ON orders(seller_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_request ON orders(request_id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)",
+]
+
+
+def _indexes(conn):
+    for sql in INDEXES:
+        conn.execute(sql)
+
+
+def _sessions(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            token_hash TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at REAL,
+            expires_at REAL,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id, expires_at)")
+
+
+def _events(conn):
+    # Notification log behind the /events/ stream; the id doubles as the SSE event id
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT,
+            created_at REAL
+        )''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_user ON events(user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_events_created ON events(created_at)")
+
+
+def _sales_rollup(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS sales_rollup (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            sold INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            payout REAL NOT NULL DEFAULT 0,
+            profit REAL NOT NULL DEFAULT 0,
+            orders INTEGER NOT NULL DEFAULT 0,
+            paid REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key)
+        ) WITHOUT ROWID''')
+    rollups.rebuild(conn)
+
+
+def _listing_facets(conn):
+    # The price index also carries the facet columns, so counting the rows of a price
+    # bucket a filter only partly covers never reads the table. (price, id) still leads,
+    # so it serves the price sorts and keyset cursors as before.
+    conn.execute("DROP INDEX IF EXISTS idx_listings_price")
+    conn.execute("CREATE INDEX idx_listings_price ON listings(price, id, status, category, condition)")
+    facets.setup(conn)
+    facets.rebuild(conn)
+
+
+def _listing_changes(conn):
+    # Change log the in-memory feed catalogue follows (see catalogue.py)
+    catalogue.setup(conn)
+
+
+MIGRATIONS = [
+    (1, "base schema", _base_schema),
+    (2, "users.phone", _users_phone),
+    (3, "listings.seller_price", _listings_seller_price),
+    (4, "buy_requests.updated_at", _buy_requests_updated_at),
+    (5, "move inline listing photos to the blob store", _externalize_photos),
+    (6, "secondary indexes for hot queries", _indexes),
+    (7, "sessions table", _sessions),
+    (8, "events table", _events),
+    (9, "sales rollups", _sales_rollup),
+    (10, "listing facet counts", _listing_facets),
+    (11, "listing change log", _listing_changes),
+]
+
+
+def current_version(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )''')
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate(conn):
+    # Apply pending migrations. Returns the list of versions applied.
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        if version <= current_version(conn):
+            continue
+        # BEGIN IMMEDIATE takes the write lock up front, so two processes booting at once
+        # can't both apply the same migration
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]:
+                conn.rollback()
+                continue
+            fn(conn)
+            conn.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+# Queries on the request path, with representative parameters. check_query_plans() runs
+# EXPLAIN QUERY PLAN on each and reports any that scan a whole table.
+HOT_QUERIES = [
+    ("listings newest",
+     "SELECT l.id FROM listings l WHERE l.status IN ('active', 'sold') ORDER BY l.created_at DESC, l.id DESC LIMIT 61", ()),
+    ("listings price_low",
+     "SELECT l.id FROM listings l WHERE l.status IN ('active', 'sold') ORDER BY l.price ASC, l.id ASC LIMIT 61", ()),
+    ("listings price_high",
+     "SELECT l.id FROM listings l WHERE l.status IN ('active', 'sold') ORDER BY l.price DESC, l.id DESC LIMIT 61", ()),
+    ("listings condition+price",
+     "SELECT l.id FROM listings l WHERE l.status IN ('active', 'sold') AND l.condition=? AND l.price >= ? "
+     "ORDER BY l.created_at DESC, l.id DESC LIMIT 61", ("Broken", 10)),
+    ("facet cube",
+     "SELECT f.category, f.condition, f.bucket, SUM(f.n) FROM listing_facets f WHERE f.status IN ('active', 'sold') "
+     "GROUP BY f.category, f.condition, f.bucket", ()),
+    ("facet partial price bucket",
+     "SELECT l.category, l.condition, COUNT(*) FROM listings l WHERE l.status IN ('active', 'sold') "
+     "AND l.price >= ? AND l.price < ? GROUP BY 1, 2", (60, 75)),
+    ("catalogue changes", "SELECT seq, listing_id FROM listing_changes WHERE seq > ? ORDER BY seq LIMIT 2001", (0,)),
+    ("session lookup",
+     "SELECT u.id, s.expires_at FROM sessions s JOIN users u ON u.id = s.user_id "
+     "WHERE s.token_hash=? AND s.expires_at > ?", ("x", 0)),
+    ("user by id", "SELECT * FROM users WHERE id=?", (1,)),
+    ("login", "SELECT * FROM users WHERE email=?", ("a@b.c",)),
+    ("my requests", "SELECT * FROM buy_requests WHERE buyer_id=?", (1,)),
+    ("incoming requests",
+     "SELECT br.*, u.name FROM buy_requests br JOIN users u ON br.buyer_id = u.id WHERE br.seller_id=?", (1,)),
+    ("pending duplicate check",
+     "SELECT id FROM buy_requests WHERE listing_id=? AND buyer_id=? AND status='pending'", (1, 1)),
+    ("accepted request",
+     "SELECT * FROM buy_requests WHERE id=? AND buyer_id=? AND status='accepted'", (1, 1)),
+    ("buyer orders", "SELECT * FROM orders WHERE buyer_id=? ORDER BY created_at DESC", (1,)),
+    ("seller orders", "SELECT * FROM orders WHERE seller_id=? ORDER BY created_at DESC", (1,)),
+    ("sold items", rollups.SOLD_ITEMS_SQL + " ORDER BY br.updated_at DESC", ()),
+    ("delete requests of listing", "SELECT id FROM buy_requests WHERE listing_id=?", (1,)),
+    ("delete listings of seller", "SELECT id FROM listings WHERE seller_id=?", (1,)),
+    ("dashboard own listings",
+     "SELECT l.id FROM listings l WHERE l.seller_id=? ORDER BY l.created_at DESC, l.id DESC", (1,)),
+    ("dashboard orders",
+     "SELECT * FROM orders WHERE buyer_id=? UNION SELECT * FROM orders WHERE seller_id=? ORDER BY created_at DESC, id DESC",
+     (1, 1)),
+    ("event resume", "SELECT id, type, data FROM events WHERE user_id=? AND id > ? ORDER BY id LIMIT 100", (1, 0)),
+]
+
+
+def check_query_plans(conn):
+    # Returns [(name, plan detail)] for every hot query step that is a full table scan,
+    # or a sort of the full result for a paged query.
+    # Plans are taken on an empty in-memory copy of the schema: without sqlite_stat1 the
+    # planner assumes big tables, so this checks the indexes rather than today's row counts.
+    schema = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND type IN ('table', 'index') "
+        "AND name NOT LIKE 'sqlite_%' AND name NOT LIKE 'listings_fts%'").fetchall()
+    scratch = sqlite3.connect(":memory:")
+    try:
+        for (sql,) in schema:
+            scratch.execute(sql)
+        problems = []
+        for name, sql, params in HOT_QUERIES:
+            for row in scratch.execute("EXPLAIN QUERY PLAN " + sql, params):
+                detail = row[3]
+                if detail.startswith("SCAN") and "USING" not in detail:
+                    problems.append((name, detail))
+                # A paged query that sorts its whole result before applying LIMIT
+                elif "LIMIT" in sql and detail.startswith("USE TEMP B-TREE FOR ORDER BY"):
+                    problems.append((name, detail))
+        return problems
+    finally:
+        scratch.close()
+
+
+if __name__ == "__main__":
+    # python backend/migrations.py [db file]  - migrate and check query plans
+    path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get(
+        "DB_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "marketplace.db"))
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    print(f"Schema version {current_version(conn)}")
+    problems = check_query_plans(conn)
+    for name, detail in problems:
+        print(f"FULL SCAN  {name}: {detail}")
+    if not problems:
+        print(f"All {len(HOT_QUERIES)} hot queries use an index")
+    conn.close()
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,228 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import profiler
+
+# Password hashing and login throttling.
+#
+# Hashes are salted scrypt (pbkdf2-sha256 where this Python's OpenSSL has no scrypt),
+# stored as "scheme$params$salt$hash". Accounts from before this still have an unsalted
+# sha256 hex digest; it is accepted once and replaced on the next successful login.
+#
+# A KDF costs tens of milliseconds of CPU on purpose, so hashing runs on its own small
+# thread pool with a bounded queue rather than on the request threads. When the pool is
+# full, callers get PasswordBusy (503) straight away instead of queueing, so a login
+# flood uses up the hashing threads and nothing else. hashlib releases the GIL while it
+# hashes, so the request threads keep serving meanwhile. In front of that, token buckets
+# per client IP and per email turn most of a flood away before it costs a hash.
+HASH_THREADS = int(os.environ.get("PASSWORD_HASH_THREADS", max(1, (os.cpu_count() or 2) // 2)))
+HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", HASH_THREADS * 4))
+HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))
+
+SCRYPT_N = int(os.environ.get("SCRYPT_N", 2 ** 14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = int(os.environ.get("PBKDF2_ITERATIONS", 600_000))
+SALT_BYTES = 16
+SCHEME = "scrypt" if hasattr(hashlib, "scrypt") else "pbkdf2_sha256"
+
+# Token buckets: burst size, and tokens added back per second. 0 turns a limit off.
+LOGIN_IP_BURST = float(os.environ.get("LOGIN_IP_BURST", 20))
+LOGIN_IP_RATE = float(os.environ.get("LOGIN_IP_RATE", 1))
+LOGIN_EMAIL_BURST = float(os.environ.get("LOGIN_EMAIL_BURST", 5))
+LOGIN_EMAIL_RATE = float(os.environ.get("LOGIN_EMAIL_RATE", 0.1))
+LIMITER_MAX_KEYS = 100_000
+
+
+class PasswordBusy(Exception):
+    pass
+
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+
+def _derive(scheme, params, password, salt):
+    if scheme == "scrypt":
+        n, r, p = params
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r)
+    if scheme == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, params[0])
+    raise ValueError(f"Unknown password scheme {scheme}")
+
+
+def _current_params():
+    return (SCRYPT_N, SCRYPT_R, SCRYPT_P) if SCHEME == "scrypt" else (PBKDF2_ITERATIONS,)
+
+
+def hash_password(password):
+    # Runs on the calling thread; request handlers go through hash_async()/verify_async()
+    salt = os.urandom(SALT_BYTES)
+    params = _current_params()
+    digest = _derive(SCHEME, params, password, salt)
+    return "$".join([SCHEME, *map(str, params), _b64(salt), _b64(digest)])
+
+
+def verify(password, stored):
+    # Returns (matches, needs rehash)
+    if not stored:
+        return False, False
+    if "$" not in stored:
+        # Legacy unsalted sha256
+        legacy = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored), True
+    try:
+        scheme, *params, salt, digest = stored.split("$")
+        params = tuple(int(v) for v in params)
+        expected = base64.b64decode(digest)
+        actual = _derive(scheme, params, password, base64.b64decode(salt))
+    except ValueError:
+        return False, False
+    return hmac.compare_digest(actual, expected), (scheme, params) != (SCHEME, _current_params())
+
+
+# Checked against when the email is unknown, so that costs the same as a wrong password
+_DUMMY = None
+
+
+def dummy_hash():
+    global _DUMMY
+    if _DUMMY is None:
+        _DUMMY = hash_password(_b64(os.urandom(12)))
+    return _DUMMY
+
+
+class HashPool:
+    # A thread pool that refuses work instead of queueing more than max_pending jobs
+
+    def __init__(self, threads=HASH_THREADS, max_queue=HASH_QUEUE):
+        self.threads = threads
+        self.max_pending = threads + max_queue
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="password-hash")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.done = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+
+    def run(self, fn, *args):
+        # Run fn(*args) on the pool and wait for it; PasswordBusy if the pool is full
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PasswordBusy("Too many logins in progress, try again shortly")
+            self.pending += 1
+        start = time.perf_counter()
+        try:
+            future = self._executor.submit(self._timed, fn, args)
+        except BaseException:
+            self._finished(None)
+            raise
+        # A job that outlives its caller's timeout still holds a thread, so it counts as
+        # pending until it is actually done
+        future.add_done_callback(self._finished)
+        try:
+            return future.result(timeout=HASH_TIMEOUT)
+        except FutureTimeout:
+            raise PasswordBusy("Password check timed out, try again shortly")
+        finally:
+            if profiler.ENABLED:
+                profiler.wait("hash", time.perf_counter() - start)
+
+    def _finished(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def _timed(self, fn, args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.done += 1
+                self.busy_seconds += elapsed
+
+    def stats(self):
+        with self._lock:
+            return {"scheme": SCHEME, "threads": self.threads, "max_pending": self.max_pending,
+                    "pending": self.pending, "hashed": self.done, "rejected": self.rejected,
+                    "avg_ms": round(self.busy_seconds / self.done * 1000, 1) if self.done else 0.0}
+
+
+pool = HashPool()
+
+
+def hash_async(password):
+    return pool.run(hash_password, password)
+
+
+def verify_async(password, stored):
+    return pool.run(verify, password, stored or dummy_hash())
+
+
+class RateLimiter:
+    # Token bucket per key: up to burst attempts at once, refilled at rate per second
+
+    def __init__(self, burst, rate, max_keys=LIMITER_MAX_KEYS):
+        self.burst = burst
+        self.rate = rate
+        self.max_keys = max_keys
+        self._buckets = {}  # key -> (tokens, last refill)
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def take(self, key):
+        # Spend a token. Returns 0 if allowed, else seconds until the next token.
+        if not self.burst or not self.rate:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                self.limited += 1
+                return (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return 0
+
+    def _prune(self, now):
+        # Buckets that have refilled are the same as no bucket
+        full = [k for k, (tokens, last) in self._buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for key in full:
+            del self._buckets[key]
+        # Still too many keys: drop the least recently used half
+        if len(self._buckets) > self.max_keys:
+            for key, _ in sorted(self._buckets.items(), key=lambda item: item[1][1])[:len(self._buckets) // 2]:
+                del self._buckets[key]
+
+    def stats(self):
+        with self._lock:
+            return {"keys": len(self._buckets), "limited": self.limited}
+
+
+# Buckets live in each process, so with prefork workers the limits are per worker
+ip_limiter = RateLimiter(LOGIN_IP_BURST, LOGIN_IP_RATE)
+email_limiter = RateLimiter(LOGIN_EMAIL_BURST, LOGIN_EMAIL_RATE)
+
+
+def throttle(ip, email=None):
+    # Seconds the caller should wait before trying again, or 0 to go ahead
+    wait = ip_limiter.take(ip)
+    if not wait and email:
+        wait = email_limiter.take(email.strip().lower())
+    return wait
+
+
+def stats():
+    return {**pool.stats(), "ip_limiter": ip_limiter.stats(), "email_limiter": email_limiter.stats()}
@@ -0,0 +1,326 @@
+import base64
+import binascii
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+
+try:
+    from PIL import Image  # Optional: only used to build thumbnails server-side
+except ImportError:
+    Image = None
+
+# Content-addressed photo store. Each upload is decoded once and written to
+# PHOTO_DIR/<first two hex chars>/<sha256>, so identical images are stored once.
+# A downscaled variant lives next to it as <sha256>.thumb.
+#
+# Digests are public (they are the URLs), so a thumbnail made by a client is only taken
+# from the user who first uploaded the photo, recorded as <sha256>.owner when the upload
+# created the blob. Anyone else re-sending the same bytes gets the photo, not a say in
+# its thumbnail; photos with no owner on record (older, imported) never take one.
+PHOTO_DIR = os.environ.get("PHOTO_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "photos"))
+MAX_PHOTOS = 5
+MAX_PHOTO_BYTES = int(os.environ.get("MAX_PHOTO_BYTES", 8 * 1024 * 1024))
+MAX_THUMB_BYTES = 512 * 1024
+THUMB_SIZE = (480, 480)
+URL_PREFIX = "/photos/"
+# Largest POST /listings/ body with inline photos: every photo and thumbnail at its cap,
+# base64 encoded, plus room for the other fields
+MAX_INLINE_BODY = (MAX_PHOTO_BYTES + MAX_THUMB_BYTES) * MAX_PHOTOS * 4 // 3 + 64 * 1024
+
+# Raw uploads (POST /photos/) are read UPLOAD_CHUNK bytes at a time and hashed as they
+# arrive. The first UPLOAD_SPOOL_BYTES are kept in memory; past that the upload spills to
+# a temp file in PHOTO_DIR, which is renamed into place once the hash is known. An upload
+# therefore never holds more than UPLOAD_SPOOL_BYTES of memory, whatever its size.
+UPLOAD_CHUNK = 64 * 1024
+UPLOAD_SPOOL_BYTES = int(os.environ.get("UPLOAD_SPOOL_BYTES", 1024 * 1024))
+
+HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+DATA_URL_RE = re.compile(r"^data:(image/[\w.+-]+);base64,", re.I)
+
+# Magic bytes -> MIME type, used when serving since we don't keep the upload's filename
+SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"RIFF", "image/webp"),
+    (b"BM", "image/bmp"),
+]
+
+
+class PhotoError(ValueError):
+    pass
+
+
+class NotOwner(PhotoError):
+    pass
+
+
+def sniff_type(head):
+    for magic, mime in SIGNATURES:
+        if head.startswith(magic):
+            if mime == "image/webp" and head[8:12] != b"WEBP":
+                continue
+            return mime
+    return None
+
+
+def blob_path(digest, thumb=False):
+    return os.path.join(PHOTO_DIR, digest[:2], digest + (".thumb" if thumb else ""))
+
+
+def photo_url(digest):
+    return URL_PREFIX + digest
+
+
+def thumb_url(photo):
+    # Thumbnail URL for a stored photo URL; anything else (legacy inline data) is returned as is
+    if photo.startswith(URL_PREFIX) and "/" not in photo[len(URL_PREFIX):]:
+        return photo + "/thumb"
+    return photo
+
+
+def decode_data_url(data_url, max_bytes):
+    m = DATA_URL_RE.match(data_url)
+    if not m:
+        raise PhotoError("Photos must be base64 image data URLs")
+    encoded = data_url[m.end():]
+    if len(encoded) * 3 // 4 > max_bytes:
+        raise PhotoError(f"Photo exceeds {max_bytes // (1024 * 1024) or 1} MB")
+    try:
+        data = base64.b64decode(encoded, validate=True)
+    except (binascii.Error, ValueError):
+        raise PhotoError("Photo is not valid base64")
+    if not sniff_type(data[:16]):
+        raise PhotoError("Unsupported image format")
+    return data
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _drop_cache(f):
+    # A spilled upload is written once and read rarely. Write it out and drop it from the
+    # page cache, so a big upload doesn't push out pages other requests are using (the
+    # database's above all).
+    f.flush()
+    if hasattr(os, "posix_fadvise"):
+        os.fdatasync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def _make_thumbnail(source):
+    # source is the image bytes or the path of a stored image
+    if Image is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+        img.thumbnail(THUMB_SIZE)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=80, optimize=True)
+        return out.getvalue()
+    except Exception:
+        return None
+
+
+def _record_owner(digest, owner):
+    # First writer wins: linking the temp file in place fails if a record exists
+    path = blob_path(digest) + ".owner"
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".owner-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(str(owner))
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(tmp)
+
+
+def is_owner(digest, owner):
+    try:
+        with open(blob_path(digest) + ".owner") as f:
+            return owner is not None and f.read() == str(owner)
+    except FileNotFoundError:
+        return False
+
+
+def store(data, thumbnail=None, owner=None):
+    # Store raw image bytes and return the photo's hash. Re-uploading an existing image is a
+    # no-op. thumbnail (the caller's own) is used only if this call stored the photo or
+    # owner uploaded it first; with owner None the caller is the server itself.
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    created = not os.path.exists(path)
+    if created:
+        _write_atomic(path, data)
+        if owner is not None:
+            _record_owner(digest, owner)
+    thumb_path = blob_path(digest, thumb=True)
+    if not os.path.exists(thumb_path):
+        if thumbnail is not None and not (created and owner is None) and not is_owner(digest, owner):
+            thumbnail = None
+        if thumbnail is None:
+            thumbnail = _make_thumbnail(data)
+        if thumbnail is not None and len(thumbnail) < len(data):
+            _write_atomic(thumb_path, thumbnail)
+    return digest
+
+
+def receive(rfile, length, owner):
+    # Stream a raw upload of length bytes from rfile into the store and return its hash.
+    # Raises PhotoError before reading further once the first bytes aren't an image.
+    # owner is recorded as the uploader if this upload stored the photo.
+    if length > MAX_PHOTO_BYTES:
+        raise PhotoError(f"Photo exceeds {MAX_PHOTO_BYTES // (1024 * 1024) or 1} MB")
+    hasher = hashlib.sha256()
+    buf = bytearray()
+    spill = tmp = None
+    remaining = length
+    try:
+        while remaining:
+            chunk = rfile.read(min(UPLOAD_CHUNK, remaining))
+            if not chunk:
+                raise PhotoError("Upload ended early")
+            remaining -= len(chunk)
+            hasher.update(chunk)
+            if spill is not None:
+                spill.write(chunk)
+                continue
+            checked = len(buf) >= 16
+            buf += chunk
+            if not checked and (len(buf) >= 16 or not remaining) and not sniff_type(bytes(buf[:16])):
+                raise PhotoError("Unsupported image format")
+            if len(buf) > UPLOAD_SPOOL_BYTES:
+                os.makedirs(PHOTO_DIR, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=PHOTO_DIR, prefix=".upload-")
+                spill = os.fdopen(fd, "wb")
+                spill.write(buf)
+                buf = None
+
+        digest = hasher.hexdigest()
+        path = blob_path(digest)
+        created = not os.path.exists(path)
+        if not created:
+            pass
+        elif spill is None:
+            _write_atomic(path, bytes(buf))
+        else:
+            _drop_cache(spill)
+            spill.close()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+            tmp = None
+        if created:
+            _record_owner(digest, owner)
+    finally:
+        if spill is not None:
+            spill.close()
+        if tmp is not None:
+            os.unlink(tmp)
+
+    thumb_path = blob_path(digest, thumb=True)
+    if not os.path.exists(thumb_path):
+        thumbnail = _make_thumbnail(path)
+        if thumbnail is not None and len(thumbnail) < length:
+            _write_atomic(thumb_path, thumbnail)
+    return digest
+
+
+def has_thumbnail(digest):
+    return os.path.exists(blob_path(digest, thumb=True))
+
+
+def store_thumbnail(digest, data, owner):
+    # Keep a client-made thumbnail for a stored photo that has none (the server can only
+    # make them with PIL). Returns False when the photo isn't in the store; NotOwner
+    # unless owner uploaded it.
+    path = blob_path(digest)
+    if not HASH_RE.match(digest) or not os.path.exists(path):
+        return False
+    if not is_owner(digest, owner):
+        raise NotOwner("Only the photo's uploader can set its thumbnail")
+    if not sniff_type(data[:16]):
+        raise PhotoError("Unsupported image format")
+    if not has_thumbnail(digest) and len(data) < os.path.getsize(path):
+        _write_atomic(blob_path(digest, thumb=True), data)
+    return True
+
+
+def store_uploads(photos, thumbnails=None, owner=None):
+    # Turn the photos list of a listing payload into stored photo URLs.
+    # Entries may be data URLs (new uploads) or URLs of photos already in the store.
+    # thumbnails only count for photos owner uploaded (see store()).
+    if not isinstance(photos, list):
+        raise PhotoError("photos must be a list")
+    if len(photos) > MAX_PHOTOS:
+        raise PhotoError(f"You can only upload up to {MAX_PHOTOS} photos.")
+    thumbnails = thumbnails if isinstance(thumbnails, list) else []
+    urls = []
+    for i, photo in enumerate(photos):
+        if not isinstance(photo, str):
+            raise PhotoError("Invalid photo")
+        if photo.startswith(URL_PREFIX):
+            digest = photo[len(URL_PREFIX):]
+            if not HASH_RE.match(digest) or not os.path.exists(blob_path(digest)):
+                raise PhotoError("Unknown photo")
+            urls.append(photo)
+            continue
+        data = decode_data_url(photo, MAX_PHOTO_BYTES)
+        thumb = None
+        if i < len(thumbnails) and isinstance(thumbnails[i], str):
+            try:
+                thumb = decode_data_url(thumbnails[i], MAX_THUMB_BYTES)
+            except PhotoError:
+                thumb = None
+        urls.append(photo_url(store(data, thumb, owner)))
+    return urls
+
+
+def open_blob(digest, thumb=False):
+    # Returns (file, size, mime, is_thumb) for a stored photo, or None. A missing
+    # thumbnail falls back to the original image (is_thumb False).
+    if not HASH_RE.match(digest):
+        return None
+    for is_thumb in ([True] if thumb else []) + [False]:
+        try:
+            f = open(blob_path(digest, is_thumb), "rb")
+        except FileNotFoundError:
+            continue
+        size = os.fstat(f.fileno()).st_size
+        mime = sniff_type(f.read(16)) or "application/octet-stream"
+        f.seek(0)
+        return f, size, mime, is_thumb
+    return None
+
+
+def externalize_legacy(conn):
+    # Move inline data-URL photos of older listings into the store. Returns rows converted.
+    converted = 0
+    rows = conn.execute("SELECT id, photos FROM listings WHERE photos LIKE '%data:image/%'").fetchall()
+    for row_id, photos_json in rows:
+        try:
+            photos = json.loads(photos_json)
+            urls = [p if p.startswith(URL_PREFIX) else photo_url(store(decode_data_url(p, 1 << 31)))
+                    for p in photos]
+        except (ValueError, TypeError, PhotoError) as e:
+            print(f"Skipping photos of listing {row_id}: {e}")
+            continue
+        conn.execute("UPDATE listings SET photos=? WHERE id=?", (json.dumps(urls), row_id))
+        converted += 1
+    return converted
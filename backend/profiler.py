@@ -0,0 +1,418 @@
+import cProfile
+import json
+import os
+import pstats
+import queue
+import re
+import sys
+import tempfile
+import threading
+import time
+from itertools import count
+
+import metrics
+
+# Slow-request profiling. Off unless PROFILE_EVERY or PROFILE_SLOW_MS is set.
+#
+# While it is on, every request carries a trace on its thread: the time each SQL statement
+# took (from metrics.TimedCursor, with the statement SQLite actually ran from the trace
+# callback and its VM work from the progress handler), and the time spent waiting rather
+# than working - for a pooled connection, in the writer's queue, for the write lock
+# (BEGIN IMMEDIATE), for the rest of the write batch, and for the password hashing pool.
+# A write carries the trace of the request waiting for it onto the writer thread.
+#
+# Every PROFILE_EVERY-th request in a process also runs under cProfile, which covers
+# what the trace can't see: JSON encoding, photo decoding, Python time between queries.
+# A request slower than PROFILE_SLOW_MS keeps its trace, and the next request on the same
+# route runs under cProfile too (kept if it is also slow), so the cost of profiling is
+# paid where the time is going. cProfile sees the request's own thread only; work on the
+# writer thread shows up in the trace instead. Only one profile runs at a time in a process
+# (Python 3.12+ allows a single active profiler): a request due one while another is
+# running is traced without it, and an armed route stays armed for its next request.
+#
+# Kept requests are dumped to PROFILE_DIR/<route>/ by a background thread: a .json trace
+# and, when profiled, a .prof file in the pstats format (python -m pstats, snakeviz).
+# Dumps from every process land there, so GET /admin/profiles and
+# python backend/profiler.py aggregate across pre-fork workers. Each route keeps its
+# newest PROFILE_KEEP dumps.
+PROFILE_EVERY = int(os.environ.get("PROFILE_EVERY", 0))
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", 0))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "marketplace-profiles"))
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 50))
+ENABLED = PROFILE_EVERY > 0 or PROFILE_SLOW_MS > 0
+# The progress handler runs once per this many SQLite VM instructions
+VM_STEP = 1000
+DUMP_QUEUE = 64
+TOP = 20
+
+WAITS = ("pool", "write_queue", "write_lock", "write_batch", "hash")
+STRING_RE = re.compile(r"[xX]?'(?:[^']|'')*'")
+TOKEN_RE = re.compile(r"(token=)[^&]*")
+ADDRESS_RE = re.compile(r" at 0x[0-9a-f]+")
+
+_local = threading.local()
+_requests = count(1)
+_armed = {}  # route -> True: profile its next request
+_stats_lock = threading.Lock()
+_stats = {"traced": 0, "profiled": 0, "busy": 0, "slow": 0, "dumped": 0, "dropped": 0, "failed": 0}
+_profiling = threading.Lock()  # held by the request whose cProfile is enabled
+
+
+class Trace:
+    # One request's record. Written by its own thread and, while that thread waits for a
+    # write, by the writer thread; read only once the request is over.
+    __slots__ = ("route", "path", "started", "profile", "sampled", "waits", "statements", "sql", "ticks")
+
+    def __init__(self, route, path, profile, sampled):
+        self.route = route
+        self.path = path
+        self.started = time.perf_counter()
+        self.profile = profile
+        self.sampled = sampled
+        self.waits = dict.fromkeys(WAITS, 0.0)
+        self.statements = {}  # sql -> [calls, seconds, vm ticks, expanded sql]
+        self.sql = None  # last statement the trace callback reported
+        self.ticks = 0
+
+
+def current():
+    return getattr(_local, "trace", None)
+
+
+def begin(method, route, path):
+    # Start tracing the current thread's request; end() finishes it
+    name = f"{method} {route}"
+    sampled = PROFILE_EVERY > 0 and next(_requests) % PROFILE_EVERY == 0
+    armed = _armed.pop(name, False)
+    profile = None
+    if sampled or armed:
+        if _profiling.acquire(blocking=False):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler (a debugger, coverage) owns the interpreter's hook
+                _profiling.release()
+                profile = None
+        if profile is None:
+            if armed:
+                _armed[name] = True
+            with _stats_lock:
+                _stats["busy"] += 1
+    trace = _local.trace = Trace(name, TOKEN_RE.sub(r"\1-", path), profile, sampled)
+    return trace
+
+
+def _stop_profile(trace):
+    if trace.profile is not None:
+        trace.profile.disable()
+        _profiling.release()
+
+
+def end(trace, status):
+    _stop_profile(trace)
+    elapsed = time.perf_counter() - trace.started
+    if current() is trace:
+        _local.trace = None
+    slow = PROFILE_SLOW_MS > 0 and elapsed * 1000 >= PROFILE_SLOW_MS
+    profiled = trace.profile is not None
+    with _stats_lock:
+        _stats["traced"] += 1
+        _stats["profiled"] += profiled
+        _stats["slow"] += slow
+    if slow and not profiled:
+        _armed[trace.route] = True
+    # A sampled request is kept whatever its time; one profiled because its route was
+    # slow, only if it was slow again
+    if not (slow or trace.sampled):
+        return
+    record = {
+        "route": trace.route, "path": trace.path, "status": status, "pid": os.getpid(),
+        "at": round(time.time(), 3), "ms": round(elapsed * 1000, 3),
+        "reason": "slow" if slow else "sample",
+        "sql_ms": round(sum(s[1] for s in trace.statements.values()) * 1000, 3),
+        "waits_ms": {k: round(v * 1000, 3) for k, v in trace.waits.items()},
+        "statements": [{"sql": sql, "calls": calls, "ms": round(seconds * 1000, 3),
+                        "vm_steps": ticks * VM_STEP, "example": example}
+                       for sql, (calls, seconds, ticks, example) in trace.statements.items()],
+        "profile": None,
+    }
+    dumper.put(record, trace.profile)
+
+
+def discard():
+    # Stop tracing the current request and don't keep it (long-lived event streams)
+    trace = current()
+    if trace is not None:
+        _stop_profile(trace)
+        trace.profile = None
+        _local.trace = None
+
+
+def wait(kind, seconds):
+    # Time the current request spent waiting for kind (one of WAITS)
+    trace = current()
+    if trace is not None:
+        trace.waits[kind] += seconds
+
+
+def add_waits(trace, **waits):
+    for kind, seconds in waits.items():
+        trace.waits[kind] += seconds
+
+
+def call(trace, fn, *args):
+    # Run fn on this thread as part of trace's request (the writer running a queued write)
+    _local.trace = trace
+    try:
+        return fn(*args)
+    finally:
+        _local.trace = None
+
+
+def _on_query(sql, kind, seconds):
+    # metrics.TimedCursor calls this after each execute and fetch
+    trace = current()
+    if trace is None or sql is None:
+        return
+    key = " ".join(sql.split())
+    entry = trace.statements.get(key)
+    if entry is None:
+        entry = trace.statements[key] = [0, 0.0, 0, None]
+    entry[1] += seconds
+    entry[2] += trace.ticks
+    trace.ticks = 0
+    if kind != "fetch":
+        entry[0] += 1
+        if entry[3] is None and trace.sql is not None:
+            # With the bound values in: ready for EXPLAIN QUERY PLAN. Strings are masked,
+            # they can be emails and password hashes.
+            entry[3] = STRING_RE.sub("'?'", trace.sql)
+        trace.sql = None
+
+
+def _on_statement(sql):
+    # Statements run by triggers and virtual tables come through as "-- ..." and the
+    # statement that fired them is the one worth keeping
+    trace = current()
+    if trace is not None and trace.sql is None and not sql.startswith("--"):
+        trace.sql = sql
+
+
+def _on_progress():
+    trace = current()
+    if trace is not None:
+        trace.ticks += 1
+    return 0  # anything else aborts the statement
+
+
+def attach(conn):
+    # Called by db.open_connection for every connection while profiling is on
+    conn.set_trace_callback(_on_statement)
+    conn.set_progress_handler(_on_progress, VM_STEP)
+
+
+def route_dir(route, base=None):
+    return os.path.join(base or PROFILE_DIR, re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root")
+
+
+class Dumper:
+    # Writes kept requests to disk off the request path. A full queue drops the dump.
+
+    def __init__(self):
+        self.pid = None
+        self._queue = None
+        self._lock = threading.Lock()
+        self._seq = count(1)
+
+    def put(self, record, profile):
+        # The thread doesn't survive fork(); each pre-fork worker starts its own
+        if self.pid != os.getpid():
+            with self._lock:
+                if self.pid != os.getpid():
+                    self._queue = queue.Queue(maxsize=DUMP_QUEUE)
+                    threading.Thread(target=self._run, args=(self._queue,), name="profile-dump",
+                                     daemon=True).start()
+                    self.pid = os.getpid()
+        try:
+            self._queue.put_nowait((record, profile))
+        except queue.Full:
+            with _stats_lock:
+                _stats["dropped"] += 1
+
+    def _run(self, jobs):
+        while True:
+            record, profile = jobs.get()
+            try:
+                self.write(record, profile)
+            except Exception as e:
+                print(f"Profile dump failed: {e}")
+                with _stats_lock:
+                    _stats["failed"] += 1
+            else:
+                with _stats_lock:
+                    _stats["dumped"] += 1
+
+    def write(self, record, profile):
+        directory = route_dir(record["route"])
+        os.makedirs(directory, exist_ok=True)
+        # Named to sort oldest first
+        name = f"{int(record['at'] * 1000):013d}-{record['pid']}-{next(self._seq)}"
+        if profile is not None:
+            record["profile"] = name + ".prof"
+            profile.dump_stats(os.path.join(directory, name + ".prof.tmp"))
+            os.replace(os.path.join(directory, name + ".prof.tmp"), os.path.join(directory, name + ".prof"))
+        # The .json goes last: a reader that finds it finds the .prof too
+        with open(os.path.join(directory, name + ".json.tmp"), "w") as f:
+            json.dump(record, f)
+        os.replace(os.path.join(directory, name + ".json.tmp"), os.path.join(directory, name + ".json"))
+        dumps = sorted(n for n in os.listdir(directory) if n.endswith(".json"))
+        for old in dumps[:-PROFILE_KEEP]:
+            for suffix in (".json", ".prof"):
+                try:
+                    os.remove(os.path.join(directory, old[:-len(".json")] + suffix))
+                except FileNotFoundError:
+                    pass
+
+
+dumper = Dumper()
+
+
+def stats():
+    # This process's counters
+    with _stats_lock:
+        counters = dict(_stats)
+    return {"enabled": ENABLED, "every": PROFILE_EVERY, "slow_ms": PROFILE_SLOW_MS, "dir": PROFILE_DIR,
+            "keep": PROFILE_KEEP, "armed": sorted(_armed), **counters}
+
+
+def _load(base, route=None):
+    # Every dump under base, oldest first; route filters by substring
+    records = []
+    try:
+        names = sorted(os.listdir(base))
+    except FileNotFoundError:
+        return records
+    for name in names:
+        directory = os.path.join(base, name)
+        if not os.path.isdir(directory):
+            continue
+        for dump in sorted(os.listdir(directory)):
+            if not dump.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, dump)) as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                continue  # pruned while we were listing
+            if route and route not in record["route"]:
+                continue
+            record["dir"] = directory
+            records.append(record)
+    records.sort(key=lambda r: r["at"])
+    return records
+
+
+def _function_name(key):
+    filename, line, name = key
+    if filename == "~":
+        # A builtin, e.g. <method 'execute' of 'sqlite3.Cursor' objects>; without the
+        # address so the same function from two processes adds up
+        return ADDRESS_RE.sub("", name)
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+def report(base=None, route=None, top=TOP):
+    # Hotspots across every dump: per-route times and waits, the statements with the most
+    # total time, and the functions with the most own time in the merged cProfile data
+    records = _load(base or PROFILE_DIR, route)
+    routes = {}
+    statements = {}
+    merged = None
+    for record in records:
+        summary = routes.get(record["route"])
+        if summary is None:
+            summary = routes[record["route"]] = {"dumps": 0, "profiled": 0, "slow": 0, "ms": 0.0,
+                                                 "max_ms": 0.0, "sql_ms": 0.0,
+                                                 "waits_ms": dict.fromkeys(WAITS, 0.0)}
+        summary["dumps"] += 1
+        summary["slow"] += record["reason"] == "slow"
+        summary["ms"] += record["ms"]
+        summary["max_ms"] = max(summary["max_ms"], record["ms"])
+        summary["sql_ms"] += record["sql_ms"]
+        for kind, ms in record["waits_ms"].items():
+            summary["waits_ms"][kind] = summary["waits_ms"].get(kind, 0.0) + ms
+        for statement in record["statements"]:
+            entry = statements.get(statement["sql"])
+            if entry is None:
+                entry = statements[statement["sql"]] = {"sql": statement["sql"], "calls": 0, "ms": 0.0,
+                                                        "vm_steps": 0, "max_ms": 0.0, "routes": set(),
+                                                        "example": statement["example"]}
+            entry["calls"] += statement["calls"]
+            entry["ms"] += statement["ms"]
+            entry["vm_steps"] += statement["vm_steps"]
+            entry["routes"].add(record["route"])
+            if statement["ms"] > entry["max_ms"]:
+                entry["max_ms"], entry["example"] = statement["ms"], statement["example"] or entry["example"]
+        if record.get("profile"):
+            try:
+                if merged is None:
+                    merged = pstats.Stats(os.path.join(record["dir"], record["profile"]))
+                else:
+                    merged.add(os.path.join(record["dir"], record["profile"]))
+            except (OSError, EOFError, ValueError):
+                continue
+            summary["profiled"] += 1
+    # Averages per dump
+    for summary in routes.values():
+        n = summary["dumps"]
+        summary["avg_ms"] = round(summary.pop("ms") / n, 3)
+        summary["avg_sql_ms"] = round(summary.pop("sql_ms") / n, 3)
+        summary["avg_waits_ms"] = {k: round(v / n, 3) for k, v in summary.pop("waits_ms").items()}
+        summary["max_ms"] = round(summary["max_ms"], 3)
+    hot_sql = sorted(statements.values(), key=lambda s: s["ms"], reverse=True)[:top]
+    for entry in hot_sql:
+        entry["routes"] = sorted(entry["routes"])
+        entry["ms"] = round(entry["ms"], 3)
+    functions = {}
+    if merged is not None:
+        for key, (_, calls, own, cumulative, _) in merged.stats.items():
+            entry = functions.setdefault(_function_name(key), [0, 0.0, 0.0])
+            entry[0] += calls
+            entry[1] += own
+            entry[2] += cumulative
+    functions = [{"function": name, "calls": calls, "own_ms": round(own * 1000, 3),
+                  "cumulative_ms": round(cumulative * 1000, 3)}
+                 for name, (calls, own, cumulative) in sorted(functions.items(), key=lambda item: item[1][1],
+                                                              reverse=True)[:top]]
+    recent = [{k: r[k] for k in ("route", "path", "status", "ms", "reason", "at", "pid")}
+              for r in records[-top:][::-1]]
+    return {"dumps": len(records), "routes": routes, "statements": hot_sql, "functions": functions,
+            "recent": recent}
+
+
+def print_report(result):
+    print(f"{result['dumps']} dumps")
+    print(f"\n{'route':<40} {'dumps':>5} {'prof':>5} {'avg ms':>9} {'max ms':>9} {'sql ms':>8}  waits (avg ms)")
+    for route, s in sorted(result["routes"].items(), key=lambda item: item[1]["avg_ms"], reverse=True):
+        waits = " ".join(f"{k}={v}" for k, v in s["avg_waits_ms"].items() if v)
+        print(f"{route:<40} {s['dumps']:>5} {s['profiled']:>5} {s['avg_ms']:>9.2f} {s['max_ms']:>9.2f} "
+              f"{s['avg_sql_ms']:>8.2f}  {waits or '-'}")
+    print(f"\n{'total ms':>10} {'max ms':>9} {'calls':>7} {'vm steps':>10}  statement")
+    for s in result["statements"]:
+        print(f"{s['ms']:>10.2f} {s['max_ms']:>9.2f} {s['calls']:>7} {s['vm_steps']:>10}  {s['sql'][:100]}")
+    if result["functions"]:
+        print(f"\n{'own ms':>10} {'cum ms':>10} {'calls':>8}  function")
+        for f in result["functions"]:
+            print(f"{f['own_ms']:>10.2f} {f['cumulative_ms']:>10.2f} {f['calls']:>8}  {f['function']}")
+
+
+if ENABLED:
+    metrics.query_hook = _on_query
+
+
+if __name__ == "__main__":
+    # python backend/profiler.py [route substring] [path/to/profiles]  - print the hotspots
+    route = sys.argv[1] if len(sys.argv) > 1 else None
+    base = sys.argv[2] if len(sys.argv) > 2 else PROFILE_DIR
+    print_report(report(base, route))
@@ -0,0 +1,176 @@
+import os
+import sys
+
+# Sales and profit totals for the admin panel, kept in the sales_rollup table and updated
+# in the same transaction as the writes that change them, so /admin/stats never has to
+# scan requests or listings.
+#
+# One row per (dimension, key): ('total', ''), ('day', 'YYYY-MM-DD'), ('category', name),
+# ('seller', seller id). What is counted is defined by the two queries below; rebuild()
+# recomputes everything from them and verify() checks the incremental totals against it.
+#
+#   sale  - a buy request that is accepted or completed, dated by the request's updated_at
+#   order - a checkout, dated by the order's created_at, worth the listing's price
+
+SOLD_STATUSES = ('accepted', 'completed')
+MEASURES = ("sold", "revenue", "payout", "profit", "orders", "paid")
+# Amounts of money are REAL columns, rounded to cents on every update so that adding and
+# removing the same sale many times doesn't leave float residue behind
+MONEY = ("revenue", "payout", "profit", "paid")
+DIMENSIONS = ("total", "day", "category", "seller")
+
+# Seller payout falls back to the full price for listings from before seller_price existed
+# (zero profit), matching what /admin/listings_full reports
+SALES_QUERY = f'''
+    SELECT date(br.updated_at) AS day, l.category AS category, l.seller_id AS seller,
+           COALESCE(l.price, 0) AS price, COALESCE(l.seller_price, l.price, 0) AS payout
+    FROM buy_requests br JOIN listings l ON l.id = br.listing_id
+    WHERE br.status IN {SOLD_STATUSES!r} AND ({{where}})'''
+# Platform margin on a listing; rows from before seller_price existed count as zero
+PROFIT_SQL = "COALESCE({t}price, 0) - COALESCE({t}seller_price, {t}price, 0)"
+
+# The sales themselves, for /admin/sold_items and its export; callers add the ORDER BY
+SOLD_ITEMS_SQL = f'''
+    SELECT 
+        l.id, l.title, l.price, l.seller_price, l.category, {PROFIT_SQL.format(t='l.')} AS profit,
+        br.updated_at as sold_date,
+        b.name as buyer_name, b.email as buyer_email, b.phone as buyer_phone,
+        s.name as seller_name, s.email as seller_email, s.phone as seller_phone
+    FROM buy_requests br
+    JOIN listings l ON br.listing_id = l.id
+    JOIN users b ON br.buyer_id = b.id
+    JOIN users s ON l.seller_id = s.id
+    WHERE br.status IN {SOLD_STATUSES!r}'''
+ORDERS_QUERY = '''
+    SELECT date(o.created_at) AS day, l.category AS category, l.seller_id AS seller,
+           COALESCE(l.price, 0) AS price
+    FROM orders o JOIN listings l ON l.id = o.listing_id
+    WHERE {where}'''
+
+
+def sales(conn, where, params=()):
+    # Contributions of the sales matching where (aliases br, l). Take one before and one
+    # after changing requests, then apply(before, -1) and apply(after, +1).
+    return [dict(day=r['day'], category=r['category'], seller=r['seller'], sold=1, revenue=r['price'],
+                 payout=r['payout'], profit=r['price'] - r['payout'])
+            for r in conn.execute(SALES_QUERY.format(where=where), params)]
+
+
+def orders(conn, where, params=()):
+    # Contributions of the orders matching where (aliases o, l)
+    return [dict(day=r['day'], category=r['category'], seller=r['seller'], orders=1, paid=r['price'])
+            for r in conn.execute(ORDERS_QUERY.format(where=where), params)]
+
+
+def _keys(item):
+    return (("total", ""), ("day", item['day'] or ""), ("category", item['category'] or ""),
+            ("seller", str(item['seller'] or "")))
+
+
+def _total(contributions, sign=1):
+    totals = {}
+    for item in contributions:
+        for key in _keys(item):
+            row = totals.setdefault(key, dict.fromkeys(MEASURES, 0))
+            for m in MEASURES:
+                row[m] += sign * item.get(m, 0)
+                if m in MONEY:
+                    row[m] = round(row[m], 2)
+    return totals
+
+
+def _sum(m):
+    return f"ROUND({m} + excluded.{m}, 2)" if m in MONEY else f"{m} + excluded.{m}"
+
+
+def apply(conn, contributions, sign=1):
+    # Add (sign=1) or remove (sign=-1) contributions. Must run inside the write transaction
+    # that changed the rows they were read from.
+    totals = _total(contributions, sign)
+    if not totals:
+        return
+    conn.executemany(f'''
+        INSERT INTO sales_rollup (dimension, key, {", ".join(MEASURES)}) VALUES (?, ?, {", ".join("?" * len(MEASURES))})
+        ON CONFLICT(dimension, key) DO UPDATE SET {", ".join(f"{m} = {_sum(m)}" for m in MEASURES)}
+    ''', [(dim, key, *(row[m] for m in MEASURES)) for (dim, key), row in totals.items()])
+
+
+def compute(conn):
+    # Every rollup row recomputed from the base tables: {(dimension, key): {measure: value}}
+    return _total(sales(conn, "1") + orders(conn, "1"))
+
+
+def stored(conn):
+    return {(r['dimension'], r['key']): {m: r[m] for m in MEASURES}
+            for r in conn.execute("SELECT * FROM sales_rollup")}
+
+
+def rebuild(conn):
+    # Caller commits
+    conn.execute("DELETE FROM sales_rollup")
+    conn.executemany(f"INSERT INTO sales_rollup (dimension, key, {', '.join(MEASURES)}) VALUES (?, ?, {', '.join('?' * len(MEASURES))})",
+                     [(dim, key, *(row[m] for m in MEASURES)) for (dim, key), row in compute(conn).items()])
+
+
+def verify(conn):
+    # Returns a list of (dimension, key, stored row, expected row) that disagree
+    expected = compute(conn)
+    actual = stored(conn)
+    zero = dict.fromkeys(MEASURES, 0)
+    problems = []
+    for key in sorted(set(expected) | set(actual)):
+        want, have = expected.get(key, zero), actual.get(key, zero)
+        # Incremental and recomputed totals are both rounded to cents, but along different
+        # paths: anything under half a cent is the same amount
+        if any(abs(want[m] - have[m]) >= 0.005 for m in MEASURES):
+            problems.append((key[0], key[1], have, want))
+    return problems
+
+
+def summary(conn, days=30, top=10):
+    # What /admin/stats shows: indexed point and range reads on sales_rollup only
+    columns = ", ".join(f"ROUND({m}, 2) AS {m}" if m in MONEY else m for m in MEASURES)
+
+    def rows(dimension, order, limit):
+        return [dict(r) for r in conn.execute(
+            f"SELECT key, {columns} FROM sales_rollup WHERE dimension=? AND sold + orders != 0 "
+            f"ORDER BY {order} LIMIT ?", (dimension, limit))]
+    total = conn.execute(f"SELECT {columns} FROM sales_rollup WHERE dimension='total' AND key=''").fetchone()
+    by_seller = rows("seller", "profit DESC, key", top)
+    names = {}
+    if by_seller:
+        ids = [int(r['key']) for r in by_seller if r['key'].isdigit()]
+        names = {str(r[0]): r[1] for r in conn.execute(
+            f"SELECT id, name FROM users WHERE id IN ({', '.join('?' * len(ids))})", ids)} if ids else {}
+    for r in by_seller:
+        r['seller_name'] = names.get(r['key'])
+    return {
+        "total": dict(total) if total else dict.fromkeys(MEASURES, 0),
+        "by_day": rows("day", "key DESC", days),
+        "by_category": rows("category", "revenue DESC, key", top),
+        "by_seller": by_seller,
+    }
+
+
+if __name__ == "__main__":
+    # python backend/rollups.py [rebuild|verify] [path/to/marketplace.db]
+    import db
+    import migrations
+    command = sys.argv[1] if len(sys.argv) > 1 else "verify"
+    path = sys.argv[2] if len(sys.argv) > 2 else os.environ.get(
+        "DB_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "marketplace.db"))
+    db.configure(path)
+    with db.connection() as conn:
+        migrations.migrate(conn)
+        if command == "rebuild":
+            conn.execute("BEGIN IMMEDIATE")
+            rebuild(conn)
+            conn.commit()
+            print(f"Rebuilt {len(stored(conn))} rollup rows")
+        elif command != "verify":
+            sys.exit("usage: rollups.py [rebuild|verify] [db]")
+        problems = verify(conn)
+        for dimension, key, have, want in problems:
+            print(f"Mismatch {dimension}={key!r}: stored {have}, expected {want}")
+        print("Rollups OK" if not problems else f"{len(problems)} rollup rows differ")
+        sys.exit(1 if problems else 0)
@@ -0,0 +1,113 @@
+import re
+
+# Declarative routing for MarketplaceHandler. Routes are registered with the @route
+# decorator on handler methods and compiled once: literal paths go into a dict, paths
+# with parameters into one regex per route.
+#
+# Path parameters: {name} matches one segment, {name:int} an integer, {name:path} the
+# rest of the path, and {name:a|b} one of the listed literals.
+#
+# max_body caps the request body a route accepts, in bytes; None means the handler's
+# default. Bodies over the cap are refused with 413 before they are read.
+
+PARAM_RE = re.compile(r"\{(\w+)(?::([^}]+))?\}")
+
+CONVERTERS = {
+    None: (r"[^/]+", str),
+    "str": (r"[^/]+", str),
+    "int": (r"\d+", int),
+    "path": (r".+", str),
+}
+
+
+class HTTPError(Exception):
+    # Raised from a route to answer with an error status and {"detail": message}
+
+    def __init__(self, status, message=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Route:
+    __slots__ = ("method", "pattern", "handler", "auth", "max_body", "regex", "converters", "name")
+
+    def __init__(self, method, pattern, handler, auth, max_body=None):
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.auth = auth  # None, 'user' or 'admin'
+        self.max_body = max_body
+        self.name = f"{method} {pattern}"
+        self.regex = None
+        self.converters = {}
+
+    def compile(self):
+        parts = []
+        pos = 0
+        for m in PARAM_RE.finditer(self.pattern):
+            parts.append(re.escape(self.pattern[pos:m.start()]))
+            name, kind = m.group(1), m.group(2)
+            if kind in CONVERTERS:
+                regex, convert = CONVERTERS[kind]
+            else:
+                regex, convert = "|".join(re.escape(choice) for choice in kind.split("|")), str
+            parts.append(f"(?P<{name}>{regex})")
+            self.converters[name] = convert
+            pos = m.end()
+        parts.append(re.escape(self.pattern[pos:]))
+        self.regex = re.compile("".join(parts) + r"\Z")
+
+    @property
+    def is_static(self):
+        return not PARAM_RE.search(self.pattern)
+
+
+class Router:
+
+    def __init__(self):
+        self.routes = []
+        self._static = {}
+        self._dynamic = []
+        self._compiled = False
+
+    def route(self, method, pattern, auth=None, max_body=None):
+        def decorator(fn):
+            for m in method.split(","):
+                self.routes.append(Route(m.strip(), pattern, fn, auth, max_body))
+            self._compiled = False
+            return fn
+        return decorator
+
+    def compile(self):
+        self._static = {}
+        self._dynamic = []
+        for r in self.routes:
+            if r.is_static:
+                self._static[(r.method, r.pattern)] = r
+            else:
+                r.compile()
+                self._dynamic.append(r)
+        self._compiled = True
+
+    def match(self, method, path):
+        # Returns (route, params). On a miss route is None and params is the set of
+        # methods the path does accept (empty for an unknown path -> 404, else 405).
+        if not self._compiled:
+            self.compile()
+        r = self._static.get((method, path))
+        if r is not None:
+            return r, {}
+        allowed = set()
+        for r in self._dynamic:
+            m = r.regex.match(path)
+            if m is None:
+                continue
+            if r.method != method:
+                allowed.add(r.method)
+                continue
+            return r, {k: r.converters[k](v) for k, v in m.groupdict().items()}
+        for (m_, p), r in self._static.items():
+            if p == path:
+                allowed.add(m_)
+        return None, allowed
@@ -0,0 +1,215 @@
+import os
+import signal
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Serving modes for MarketplaceHandler:
+#   single  - one connection at a time (the old TCPServer behaviour)
+#   thread  - bounded thread pool in one process
+#   prefork - several processes sharing one listening socket, each with its own thread pool
+#   async   - asyncio event loop owning the sockets, handlers on a small executor (async_server.py)
+SERVER_MODE = os.environ.get("SERVER_MODE", "thread").lower()
+WORKERS = int(os.environ.get("WORKERS", os.cpu_count() or 1))
+THREADS = int(os.environ.get("THREADS", 16))
+# Connections accepted but waiting for a free thread. Past this the accept loop blocks
+# and new clients queue in the kernel backlog instead of in our memory.
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", THREADS * 4))
+SHUTDOWN_TIMEOUT = float(os.environ.get("SHUTDOWN_TIMEOUT", 10))
+
+# Callbacks run when this process is asked to stop, e.g. to end long-lived streams that
+# would otherwise hold up the graceful shutdown
+_stop_hooks = []
+
+
+def on_stop(callback):
+    _stop_hooks.append(callback)
+
+
+def run_stop_hooks():
+    for callback in _stop_hooks:
+        try:
+            callback()
+        except Exception as e:
+            print(f"Stop hook failed: {e}")
+
+
+class SingleServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def keep_alive(self):
+        # A persistent connection would lock every other client out
+        return False
+
+
+class ThreadPoolServer(socketserver.TCPServer):
+    # TCPServer that hands each accepted connection to a fixed-size thread pool
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, threads=THREADS, queue_size=QUEUE_SIZE,
+                 bind_and_activate=True):
+        super().__init__(server_address, handler_class, bind_and_activate)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+        self.slots = threading.BoundedSemaphore(threads + queue_size)
+        # Connections accepted but not yet picked up by a thread
+        self.waiting = 0
+        self._waiting_lock = threading.Lock()
+
+    def keep_alive(self):
+        # While connections are queued for a thread, finish each response with
+        # Connection: close rather than let an idle client hold its thread
+        return self.waiting == 0
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        with self._waiting_lock:
+            self.waiting += 1
+        try:
+            self.executor.submit(self._process, request, client_address)
+        except RuntimeError:
+            # Executor already shut down
+            with self._waiting_lock:
+                self.waiting -= 1
+            self.slots.release()
+            self.shutdown_request(request)
+
+    def _process(self, request, client_address):
+        with self._waiting_lock:
+            self.waiting -= 1
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        # Let in-flight requests finish before the process exits
+        self.executor.shutdown(wait=True)
+
+
+def _install_stop_handlers(server):
+    # serve_forever() runs on the main thread, so shutdown() has to come from another one
+    def stop(signum, frame):
+        run_stop_hooks()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+
+def make_server(handler_class, port, mode=SERVER_MODE, threads=THREADS, bind_and_activate=True):
+    if mode == "single":
+        return SingleServer(("", port), handler_class, bind_and_activate)
+    return ThreadPoolServer(("", port), handler_class, threads=threads, bind_and_activate=bind_and_activate)
+
+
+def serve(handler_class, port, mode=SERVER_MODE, workers=WORKERS, threads=THREADS, on_worker_start=None):
+    if mode == "prefork" and not hasattr(os, "fork"):
+        print("Pre-fork mode needs os.fork(); falling back to thread mode")
+        mode = "thread"
+    if mode == "prefork":
+        _serve_prefork(handler_class, port, workers, threads, on_worker_start)
+        return
+    if mode == "async":
+        import async_server
+        async_server.serve(handler_class, port, on_worker_start=on_worker_start)
+        return
+
+    server = make_server(handler_class, port, mode, threads)
+    _install_stop_handlers(server)
+    if on_worker_start:
+        on_worker_start()
+    print(f"Serving at http://localhost:{port} ({mode} mode, {threads if mode == 'thread' else 1} threads)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        print("Server stopped")
+
+
+def _serve_prefork(handler_class, port, workers, threads, on_worker_start):
+    # Bind once in the parent; every child inherits the listening socket and accepts on it,
+    # so the kernel spreads connections across processes.
+    server = make_server(handler_class, port, "thread", threads, bind_and_activate=False)
+    server.server_bind()
+    server.server_activate()
+    server.executor.shutdown(wait=False)  # the parent never serves requests itself
+
+    children = {}
+    stopping = threading.Event()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent turns ^C into SIGTERM
+            child = make_server(handler_class, port, "thread", threads, bind_and_activate=False)
+            child.socket.close()
+            child.socket = server.socket
+            _install_stop_handlers(child)
+            code = 0
+            try:
+                if on_worker_start:
+                    on_worker_start()
+                child.serve_forever()
+            except Exception as e:
+                print(f"Worker {os.getpid()} crashed: {e}")
+                code = 1
+            finally:
+                child.server_close()
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        stopping.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+    print(f"Serving at http://localhost:{port} (prefork mode, {workers} workers x {threads} threads)")
+
+    try:
+        while not stopping.is_set():
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                stopping.wait(0.5)
+                continue
+            started = children.pop(pid, None)
+            if started is not None and not stopping.is_set():
+                # Respawn, but don't spin if a worker dies right after starting
+                if time.monotonic() - started < 1:
+                    time.sleep(1)
+                print(f"Worker {pid} exited ({status}); restarting")
+                spawn()
+    finally:
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                children.pop(pid, None)
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        while children and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                children.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        server.socket.close()
+        print("Server stopped")
+
@@ -0,0 +1,155 @@
+import hashlib
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# Server-side sessions. Tokens keep their "<user_id>:<random hex>" shape, but the whole
+# token is now checked: its SHA-256 is stored in the sessions table, and validated
+# sessions are cached in memory so the common case never touches SQLite. Pre-fork workers
+# share an epoch counter, as the listings response cache does: a logout, password change,
+# deletion or profile update in any worker bumps it, and every other worker drops its
+# cached sessions before its next lookup.
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 30 * 24 * 3600))
+CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+# How long a cached session is trusted before it is re-read from the database
+CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 60))
+
+USER_COLUMNS = "u.id, u.name, u.email, u.role, u.location, u.phone"
+
+
+def token_hash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class SessionCache:
+    # LRU of token hash -> (user dict, cached until, session expires at)
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every discard: a lookup that read the database before one doesn't cache
+        self.generation = 0
+        self._shared_epoch = multiprocessing.Value('Q', 0)
+        self._seen_epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _sync_epoch(self):
+        # Called with self._lock held
+        epoch = self._shared_epoch.value
+        if epoch != self._seen_epoch:
+            self._entries.clear()
+            self.generation += 1
+            self._seen_epoch = epoch
+
+    def _bump(self):
+        # Called with self._lock held
+        self.generation += 1
+        with self._shared_epoch.get_lock():
+            self._shared_epoch.value += 1
+            self._seen_epoch = self._shared_epoch.value
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            self._sync_epoch()
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < now or entry[2] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, user, expires_at, generation):
+        with self._lock:
+            self._sync_epoch()
+            if generation != self.generation:
+                return
+            self._entries[key] = (user, time.time() + self.ttl, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._sync_epoch()
+            self._entries.pop(key, None)
+            self._bump()
+
+    def discard_user(self, user_id):
+        with self._lock:
+            self._sync_epoch()
+            for key in [k for k, v in self._entries.items() if v[0]['id'] == user_id]:
+                del self._entries[key]
+            self._bump()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+cache = SessionCache()
+
+
+def create(conn, user_id):
+    # Start a session for user_id and return its bearer token. Caller commits.
+    token = f"{user_id}:{secrets.token_hex(16)}"
+    now = time.time()
+    conn.execute("INSERT INTO sessions (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                 (token_hash(token), user_id, now, now + SESSION_TTL))
+    # Opportunistic cleanup of this user's expired sessions
+    conn.execute("DELETE FROM sessions WHERE user_id=? AND expires_at < ?", (user_id, now))
+    return token
+
+
+def lookup(conn_factory, token):
+    # Returns the user dict for a valid token, or None. conn_factory is only called on a cache miss.
+    key = token_hash(token)
+    user = cache.get(key)
+    if user is not None:
+        return dict(user)
+    generation = cache.generation
+    with conn_factory() as conn:
+        row = conn.execute(f'''
+            SELECT {USER_COLUMNS}, s.expires_at FROM sessions s JOIN users u ON u.id = s.user_id
+            WHERE s.token_hash=? AND s.expires_at > ?
+        ''', (key, time.time())).fetchone()
+    if not row:
+        return None
+    user = dict(row)
+    expires_at = user.pop('expires_at')
+    cache.put(key, user, expires_at, generation)
+    return dict(user)
+
+
+# revoke and revoke_user are write operations. The cache is only cleared once they have
+# committed (forget / forget_user, after writer.run returns): cleared any earlier, a lookup
+# in between would still read the session from its snapshot and cache it again.
+
+def revoke(conn, token):
+    conn.execute("DELETE FROM sessions WHERE token_hash=?", (token_hash(token),))
+
+
+def revoke_user(conn, user_id, keep_token=None):
+    # Drop every session of a user (password change, deletion), optionally keeping the caller's
+    if keep_token:
+        conn.execute("DELETE FROM sessions WHERE user_id=? AND token_hash != ?", (user_id, token_hash(keep_token)))
+    else:
+        conn.execute("DELETE FROM sessions WHERE user_id=?", (user_id,))
+
+
+def forget(token):
+    cache.discard(token_hash(token))
+
+
+def forget_user(user_id):
+    # Sessions revoked or profile changed: make the next lookup reload from the database
+    cache.discard_user(user_id)
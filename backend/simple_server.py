@@ -1,687 +1,1175 @@
 import http.server
-import socketserver
 import json
+import math
 import sqlite3
 import os
-import secrets
+import shutil
 from urllib.parse import urlparse, parse_qs
-import hashlib
+import re
+import time
+
+import bulk
+import cache
+import catalogue
+import dashboard
+import db
+import events
+import facets
+import listings
+import metrics
+import migrations
+import passwords
+import photos
+import profiler
+import rollups
+import serving
+import sessions
+import static_files
+import streaming
+import writer
+from router import HTTPError, Router
 
 # Configuration
 PORT = int(os.environ.get("PORT", 8000))
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_FILE = os.path.join(BASE_DIR, "marketplace.db")
+DB_FILE = os.environ.get("DB_FILE", os.path.join(BASE_DIR, "marketplace.db"))
 STATIC_DIR = os.path.join(os.path.dirname(BASE_DIR), "frontend")
+# Each idle keep-alive connection holds a pool thread, so don't wait long for the next request
+KEEPALIVE_TIMEOUT = float(os.environ.get("KEEPALIVE_TIMEOUT", 5))
+# Unread request bodies up to this size are drained to keep the connection usable
+DRAIN_MAX = int(os.environ.get("DRAIN_MAX", 64 * 1024))
+# Request body limit for routes that don't set their own max_body
+MAX_BODY = int(os.environ.get("MAX_BODY", 1024 * 1024))
+# Reverse proxies in front of the server whose X-Forwarded-For entries are trusted. On
+# Render (which sets RENDER) every request comes through its one proxy.
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", 1 if os.environ.get("RENDER") else 0))
+db.configure(DB_FILE)
+static = static_files.StaticFiles(STATIC_DIR)
 
 # Database Init
 def init_db():
-    conn = sqlite3.connect(DB_FILE, timeout=10)
-    try:
-        # Enable WAL (Write-Ahead Logging) for better concurrency
-        try:
-            conn.execute("PRAGMA journal_mode=WAL;")
-        except:
-            pass
-            
+    # Connections come from the pool, which sets WAL and the other pragmas when it opens them
+    with db.connection() as conn:
         c = conn.cursor()
-        c.executescript('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                role TEXT DEFAULT 'buyer',
-                location TEXT,
-                phone TEXT
-            );
-            CREATE TABLE IF NOT EXISTS listings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                seller_id INTEGER,
-                title TEXT,
-                category TEXT,
-                brand TEXT,
-                model TEXT,
-                condition TEXT,
-                seller_price REAL, -- Amount seller receives
-                price REAL, -- Amount buyer pays (Display Price)
-                location TEXT,
-                description TEXT,
-                status TEXT DEFAULT 'active',
-                working_parts TEXT,
-                photos TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(seller_id) REFERENCES users(id)
-            );
-            CREATE TABLE IF NOT EXISTS buy_requests (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                listing_id INTEGER,
-                buyer_id INTEGER,
-                seller_id INTEGER,
-                status TEXT DEFAULT 'pending',
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(listing_id) REFERENCES listings(id)
-            );
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                request_id INTEGER,
-                listing_id INTEGER,
-                buyer_id INTEGER,
-                seller_id INTEGER,
-                shipping_name TEXT,
-                shipping_address TEXT,
-                shipping_phone TEXT,
-                shipping_email TEXT,
-                shipping_pincode TEXT,
-                payment_method TEXT,
-                payment_status TEXT DEFAULT 'paid',
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(request_id) REFERENCES buy_requests(id)
-            );
-        ''')
-        
-        # Migration: Add columns if they don't exist
-        try:
-            c.execute("ALTER TABLE users ADD COLUMN phone TEXT")
-        except sqlite3.OperationalError:
-            pass
-        try:
-            c.execute("ALTER TABLE listings ADD COLUMN seller_price REAL")
-            # Backfill existing listings: seller_price = price
-            c.execute("UPDATE listings SET seller_price = price WHERE seller_price IS NULL")
-        except sqlite3.OperationalError:
-            pass
+        migrations.migrate(conn)
+
+        # Full-text search index over listings (kept in sync by triggers). Not a versioned
+        # migration because it depends on whether this SQLite build has FTS5.
+        listings.FTS_ENABLED = listings.setup_fts(conn)
+
+        for name, detail in migrations.check_query_plans(conn):
+            print(f"Warning: hot query '{name}' does a full scan: {detail}")
 
         # Check if admin exists
         c.execute("SELECT id FROM users WHERE role='admin'")
         if not c.fetchone():
             print("Creating default admin user...")
-            pwd_hash = hashlib.sha256("admin123".encode()).hexdigest()
+            pwd_hash = passwords.hash_password("admin123")
             c.execute("INSERT INTO users (name, email, password_hash, role, location, phone) VALUES (?, ?, ?, ?, ?, ?)",
                       ("Administrator", "admin@example.com", pwd_hash, "admin", "HQ", "0000000000"))
             print("Default admin created: admin@example.com / admin123")
         
         conn.commit()
-    finally:
-        conn.close()
 
-class MarketplaceHandler(http.server.SimpleHTTPRequestHandler):
+# Admin exports walk their table in rowid order, which needs no sort and so no memory
+# proportional to the table
+EXPORT_QUERIES = {
+    "listings": f"SELECT *, {rollups.PROFIT_SQL.format(t='')} AS profit FROM listings ORDER BY id",
+    "sold_items": rollups.SOLD_ITEMS_SQL + " ORDER BY br.id",
+    "orders": "SELECT * FROM orders ORDER BY id",
+}
+
+router = Router()
+route = router.route
+
+def request_event(c, request_id):
+    # Payload of request.* events: the row as the dashboard's incoming section returns it
+    row = c.execute(f'''
+        SELECT {dashboard.REQUEST_COLUMNS}, u.name as buyer_name, u.location as buyer_location
+        FROM buy_requests br JOIN users u ON br.buyer_id = u.id LEFT JOIN listings l ON l.id = br.listing_id
+        WHERE br.id=?
+    ''', (request_id,)).fetchone()
+    return dict(row) if row else None
+
+class JSONBody(dict):
+    # A decoded request body. A missing field is the client's mistake: 400, not a KeyError (500).
+
+    def __missing__(self, key):
+        raise HTTPError(400, f"Missing field: {key}")
+
+# Bearer tokens passed in the query string (EventSource can't send headers) stay out of the log
+TOKEN_PARAM_RE = re.compile(r"([?&]token=)[^&\s]+")
+
+class MarketplaceHandler(http.server.BaseHTTPRequestHandler):
+    # Persistent connections: the dashboard fires several API calls back to back
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections are dropped after this many seconds
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body go out as separate writes; with Nagle on, the body of every
+    # response on a reused connection waits ~40ms for the client's delayed ACK
+    disable_nagle_algorithm = True
+
     def end_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.send_header('Access-Control-Expose-Headers', 'X-Next-Cursor, X-Total-Count, ETag')
+        if not self.close_connection and not self.server_keeps_alive():
+            self.send_header('Connection', 'close')
+            self.close_connection = True
         super().end_headers()
 
+    def server_keeps_alive(self):
+        keep_alive = getattr(self.server, 'keep_alive', None)
+        return keep_alive() if keep_alive else True
+
+    def log_request(self, code='-', size='-'):
+        if isinstance(code, http.HTTPStatus):
+            code = code.value
+        self.log_message('"%s" %s %s', TOKEN_PARAM_RE.sub(r"\1***", self.requestline), str(code), str(size))
+
+    @staticmethod
+    def body_limit(method, path):
+        # Largest request body the route for method and path accepts
+        route, _ = router.match(method, path)
+        return route.max_body if route is not None and route.max_body is not None else MAX_BODY
+
+    def check_body_size(self, limit):
+        if self.content_length() > limit:
+            # Not worth reading just to throw away
+            self.close_connection = True
+            raise HTTPError(413, f"Request body is limited to {limit} bytes")
+
+    def handle_expect_100(self):
+        # The client waits for "100 Continue" before sending the body, so a body that is
+        # too big (or a bad Content-Length) is refused before any of it is sent
+        try:
+            self.check_body_size(self.body_limit(self.command, urlparse(self.path).path))
+        except HTTPError as e:
+            self.close_connection = True
+            self.send_error(e.status, e.message)
+            return False
+        return super().handle_expect_100()
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
     def do_OPTIONS(self):
+        self._body_read = False
         self.send_response(200)
+        self.send_header('Content-Length', '0')
         self.end_headers()
+        self.finish_body()
 
-    def send_error(self, code, message=None, explain=None):
+    def send_error(self, code, message=None, explain=None, headers=None):
+        body = json.dumps({'detail': message}).encode()
         self.send_response(code)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            # E.g. an unread body was left behind: the client mustn't send another request here
+            self.send_header('Connection', 'close')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(json.dumps({'detail': message}).encode())
+        if self.command != 'HEAD':
+            self.wfile.write(body)
 
-    def do_GET(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
-        
-        # Static Files serving
-        if path.startswith("/static/"):
-            relative_path = path.replace("/static/", "")
-            file_path = os.path.join(STATIC_DIR, relative_path)
-            if os.path.exists(file_path):
-                self.send_response(200)
-                if file_path.endswith(".html"): self.send_header('Content-type', 'text/html')
-                elif file_path.endswith(".js"): self.send_header('Content-type', 'application/javascript')
-                elif file_path.endswith(".css"): self.send_header('Content-type', 'text/css')
-                self.end_headers()
-                with open(file_path, 'rb') as f:
-                    self.wfile.write(f.read())
-                return
-            else:
-                self.send_error(404, "File not found")
-                return
-        
-        # Root -> Index
-        if path == "/":
-            self.send_response(301)
-            self.send_header('Location', '/static/index.html')
-            self.end_headers()
+    def dispatch(self):
+        self.parsed = urlparse(self.path)
+        self.user = None
+        self.status = None
+        self._body = None
+        self._body_read = False
+        route, params = router.match(self.command, self.parsed.path)
+        if not metrics.ENABLED and not profiler.ENABLED:
+            self.handle_route(route, params)
             return
-
-        # API: Get Listings
-        if path == "/listings/":
-            conn = sqlite3.connect(DB_FILE, timeout=10)
+        # Label by pattern, not path, so ids don't multiply the series
+        name = route.pattern if route else "unmatched"
+        trace = None
+        if not metrics.ENABLED:
             try:
-                conn.row_factory = sqlite3.Row
-                c = conn.cursor()
-                
-                # Base Query
-                query = "SELECT id, seller_id, title, category, brand, model, condition, seller_price, price, location, description, status, working_parts, photos, created_at FROM listings WHERE status IN ('active', 'sold')"
-                params = []
-
-                # Query Params
-                qs = parse_qs(parsed.query)
-                
-                # 1. Search (q)
-                if 'q' in qs:
-                    search_term = f"%{qs['q'][0]}%"
-                    query += " AND (title LIKE ? OR brand LIKE ? OR model LIKE ? OR description LIKE ?)"
-                    params.extend([search_term, search_term, search_term, search_term])
-                
-                # 2. Category
-                if 'category' in qs and qs['category'][0]:
-                    query += " AND category LIKE ?"
-                    params.append(f"%{qs['category'][0]}%")
-                
-                # 3. Condition
-                if 'condition' in qs and qs['condition'][0]:
-                    query += " AND condition=?"
-                    params.append(qs['condition'][0])
-
-                # 4. Price Range
-                if 'min_price' in qs and qs['min_price'][0]:
-                    try:
-                        query += " AND price >= ?"
-                        params.append(float(qs['min_price'][0]))
-                    except: pass
-                if 'max_price' in qs and qs['max_price'][0]:
-                    try:
-                        query += " AND price <= ?"
-                        params.append(float(qs['max_price'][0]))
-                    except: pass
-
-                # 5. Sorting
-                sort = qs.get('sort', ['newest'])[0]
-                if sort == 'price_low':
-                    query += " ORDER BY price ASC"
-                elif sort == 'price_high':
-                    query += " ORDER BY price DESC"
-                else: # newest
-                    query += " ORDER BY created_at DESC"
-
-                c.execute(query, params)
-                listings = [dict(row) for row in c.fetchall()]
-                for l in listings:
-                    l['photos'] = json.loads(l['photos']) if l['photos'] else []
+                trace = profiler.begin(self.command, name, self.path)
+                self.handle_route(route, params)
             finally:
-                conn.close()
-            self.send_json(listings)
+                if trace is not None:
+                    profiler.end(trace, self.status)
             return
+        start = time.perf_counter()
+        metrics.IN_FLIGHT.inc()
+        self.wfile = out = metrics.CountingWriter(self.wfile)
+        try:
+            if profiler.ENABLED:
+                trace = profiler.begin(self.command, name, self.path)
+            self.handle_route(route, params)
+        finally:
+            if trace is not None:
+                profiler.end(trace, self.status)
+            self.wfile = out.raw
+            metrics.IN_FLIGHT.inc(amount=-1)
+            metrics.REQUESTS.inc(name, self.command, self.status or 0)
+            metrics.LATENCY.observe(time.perf_counter() - start, name, self.command)
+            metrics.BYTES_SENT.inc(name, self.command, amount=out.sent)
 
-        # API: My Requests (As Buyer)
-        if path == "/requests/my-requests":
-            user, error = self.get_user_from_token()
-            if error:
-                self.send_error(401, error)
+    def handle_route(self, route, params):
+        try:
+            if route is None:
+                if params:
+                    self.send_error(405, "Method not allowed", headers={'Allow': ', '.join(sorted(params | {'OPTIONS'}))})
+                else:
+                    self.send_error(404, "Endpoint not found")
                 return
-            conn = sqlite3.connect(DB_FILE, timeout=10)
+            self.check_body_size(route.max_body if route.max_body is not None else MAX_BODY)
+            if route.auth:
+                user, error = self.get_user_from_token()
+                if error:
+                    self.send_error(401, error)
+                    return
+                if route.auth == 'admin' and user['role'] != 'admin':
+                    self.send_error(403, "Admin access required")
+                    return
+                self.user = user
+            route.handler(self, **params)
+        except HTTPError as e:
+            if self.status is None:
+                self.send_error(e.status, e.message)
+            else:
+                self.close_connection = True
+        except (writer.WriterBusy, passwords.PasswordBusy) as e:
+            self.send_error(503, str(e), headers={'Retry-After': '1'})
+        except Exception as e:
+            print(f"Server Error ({self.command} {self.parsed.path}): {e}")
+            if self.status is None:
+                self.send_error(500, str(e))
+            else:
+                # Headers already went out; dropping the connection is the only signal left
+                self.close_connection = True
+        finally:
+            self.finish_body()
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = dispatch
+
+    def content_length(self):
+        if self.headers.get('Transfer-Encoding'):
+            raise HTTPError(411, "Chunked request bodies are not supported")
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length < 0:
+            raise HTTPError(400, "Invalid Content-Length")
+        return length
+
+    def read_json(self):
+        # The request body, read and decoded on first use
+        if not self._body_read:
+            self._body_read = True
+            length = self.content_length()
+            raw = self.rfile.read(length) if length else b''
+            if len(raw) < length:
+                self.close_connection = True
+                raise HTTPError(400, "Request body ended early")
             try:
-                conn.row_factory = sqlite3.Row
-                c = conn.cursor()
-                c.execute("SELECT * FROM buy_requests WHERE buyer_id=?", (user['id'],))
-                requests = [dict(row) for row in c.fetchall()]
-            finally:
-                conn.close()
-            self.send_json(requests)
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                raise HTTPError(400, "Invalid JSON body")
+            if not isinstance(body, dict):
+                raise HTTPError(400, "Request body must be a JSON object")
+            self._body = JSONBody(body)
+        return self._body
+
+    def read_bytes(self):
+        # The raw request body, for small binary bodies
+        self._body_read = True
+        length = self.content_length()
+        data = self.rfile.read(length) if length else b''
+        if len(data) < length:
+            self.close_connection = True
+            raise HTTPError(400, "Request body ended early")
+        return data
+
+    def finish_body(self):
+        # Consume a body the route never read, so the next request on this connection
+        # starts at the right byte. Big or unsized bodies aren't worth it: just close.
+        if self._body_read or self.close_connection:
+            return
+        self._body_read = True
+        try:
+            length = self.content_length()
+        except HTTPError:
+            self.close_connection = True
             return
+        if length > DRAIN_MAX:
+            self.close_connection = True
+        elif length:
+            self.rfile.read(length)
 
-        # API: Incoming Requests (As Seller)
-        if path == "/requests/incoming":
-            user, error = self.get_user_from_token()
-            if error:
-                self.send_error(401, error)
+    @route('GET,HEAD', '/static/{path:path}')
+    def serve_static(self, path):
+        entry = static.lookup(path)
+        if entry is None:
+            self.send_error(404, "File not found")
+            return
+        # Validators are compared against the variant this client gets
+        encoding = static.choose_encoding(entry, self.headers.get('Accept-Encoding'))
+        etag = static_files.variant_etag(entry, encoding)
+        common = [('ETag', etag), ('Last-Modified', entry.last_modified),
+                  ('Cache-Control', entry.cache_control), ('Accept-Ranges', 'bytes')]
+        if entry.variants:
+            common.append(('Vary', 'Accept-Encoding'))
+        if static_files.not_modified(entry, self.headers, etag):
+            self.send_response(304)
+            for name, value in common:
+                self.send_header(name, value)
+            self.end_headers()
+            return
+
+        if encoding:
+            data, disk_path = entry.variants[encoding]
+            size = len(data) if data is not None else os.path.getsize(disk_path)
+            start, end, status = 0, size - 1, 200
+        else:
+            data, disk_path, size = entry.content, entry.path, entry.size
+            if_range = self.headers.get('If-Range')
+            rng = static_files.parse_range(self.headers.get('Range'), size) if if_range in (None, etag) else None
+            if rng is False:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
                 return
-            conn = sqlite3.connect(DB_FILE, timeout=10)
-            try:
-                conn.row_factory = sqlite3.Row
-                c = conn.cursor()
-                c.execute('''
-                    SELECT br.*, u.name as buyer_name, u.location as buyer_location
-                    FROM buy_requests br
-                    JOIN users u ON br.buyer_id = u.id
-                    WHERE br.seller_id=?
-                ''', (user['id'],))
-                # Note: REMOVED u.email, u.phone from SELECT to enforce privacy
-                requests = [dict(row) for row in c.fetchall()]
-            finally:
-                conn.close()
-            self.send_json(requests)
+            start, end = rng or (0, size - 1)
+            status = 206 if rng else 200
+
+        self.send_response(status)
+        self.send_header('Content-Type', entry.mime)
+        self.send_header('Content-Length', str(end - start + 1 if size else 0))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        for name, value in common:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command == 'HEAD' or not size:
             return
-            
-        # API: Get Orders (Seller/Buyer)
-        if path == "/orders/my-orders":
-            user, error = self.get_user_from_token()
-            if error:
-                self.send_error(401, error)
+        if data is not None:
+            self.wfile.write(memoryview(data)[start:end + 1])
+        else:
+            sent = static_files.send_file_range(self.wfile, self.connection, disk_path, start, end - start + 1)
+            if metrics.ENABLED:
+                self.wfile.sent += sent
+
+    # Listing photos from the content-addressed store
+    @route('GET', '/photos/{digest}')
+    def serve_photo(self, digest, thumb=False):
+        blob = photos.open_blob(digest, thumb)
+        if not blob:
+            self.send_error(404, "Photo not found")
+            return
+        f, size, mime, is_thumb = blob
+        with f:
+            # Content-addressed, so the URL never changes meaning: cache forever. Except a
+            # thumbnail URL answered with the original, which a later PUT .../thumb replaces:
+            # that one is revalidated, by the original's ETag.
+            etag = f'"{digest}{"-t" if is_thumb else ""}"'
+            cache_control = 'no-cache' if thumb and not is_thumb else 'public, max-age=31536000, immutable'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', cache_control)
+                self.end_headers()
                 return
-            conn = sqlite3.connect(DB_FILE, timeout=10)
+            self.send_response(200)
+            self.send_header('Content-Type', mime)
+            self.send_header('Content-Length', str(size))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    # Raw image upload: the body is the image itself, streamed to the store (photos.receive).
+    # Listings then refer to it by the returned URL instead of carrying it inline.
+    @route('POST', '/photos/', auth='user', max_body=photos.MAX_PHOTO_BYTES)
+    def upload_photo(self):
+        length = self.content_length()
+        if not length:
+            raise HTTPError(400, "Send the image as the request body")
+        self._body_read = True
+        try:
+            digest = photos.receive(self.rfile, length, self.user['id'])
+        except photos.PhotoError as e:
+            # The rest of the upload is still unread
+            self.close_connection = True
+            raise HTTPError(400, str(e))
+        except Exception:
+            self.close_connection = True
+            raise
+        thumbnail = photos.has_thumbnail(digest)
+        self.send_json({"digest": digest, "url": photos.photo_url(digest),
+                        "thumbnail": photos.thumb_url(photos.photo_url(digest)) if thumbnail else None})
+
+    # Thumbnail made by the client, for when the server can't make one (no PIL). Only
+    # the user whose upload stored the photo may set it.
+    @route('PUT', '/photos/{digest}/thumb', auth='user', max_body=photos.MAX_THUMB_BYTES)
+    def upload_thumbnail(self, digest):
+        try:
+            found = photos.store_thumbnail(digest, self.read_bytes(), self.user['id'])
+        except photos.NotOwner as e:
+            raise HTTPError(403, str(e))
+        except photos.PhotoError as e:
+            raise HTTPError(400, str(e))
+        if not found:
+            raise HTTPError(404, "Unknown photo")
+        self.send_json({"thumbnail": photos.thumb_url(photos.photo_url(digest))})
+
+    @route('GET', '/photos/{digest}/thumb')
+    def serve_thumbnail(self, digest):
+        self.serve_photo(digest, thumb=True)
+
+    # Root -> Index
+    @route('GET', '/')
+    def index(self):
+        self.send_response(301)
+        self.send_header('Location', '/static/index.html')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    # API: Get Listings
+    @route('GET', '/listings/')
+    def get_listings(self):
+        # Paginated: ?limit=&offset= or ?cursor= (opaque keyset cursor from X-Next-Cursor).
+        # The body stays a plain array; paging info travels in headers. Responses are
+        # cached per query string and revalidated with strong ETags.
+        parsed = self.parsed
+        key = cache.cache_key(parsed.path, parsed.query)
+        entry = cache.listings_cache.get(key) if cache.ENABLED else None
+        if entry is None:
+            qs = parse_qs(parsed.query)
             try:
-                conn.row_factory = sqlite3.Row
-                c = conn.cursor()
-                if user['role'] == 'buyer':
-                    c.execute("SELECT * FROM orders WHERE buyer_id=? ORDER BY created_at DESC", (user['id'],))
+                query, params, limit, sort = listings.page_query(qs)
+            except listings.QueryError as e:
+                self.send_error(400, str(e))
+                return
+            generation = cache.listings_cache.generation()
+            headers = {}
+            with db.connection() as conn:
+                # The in-memory catalogue picks the page's ids when it can; SQL otherwise
+                found = catalogue.index.lookup(conn, qs, limit, sort, listings.wants_total(qs)) if catalogue.ENABLED else None
+                if found is not None:
+                    ids, total = found
+                    rows = catalogue.rows_by_id(conn, ids)
+                    if total is not None:
+                        headers['X-Total-Count'] = str(total)
                 else:
-                    c.execute("SELECT * FROM orders WHERE seller_id=? ORDER BY created_at DESC", (user['id'],))
-                orders = [dict(row) for row in c.fetchall()]
-            finally:
-                conn.close()
-            self.send_json(orders)
+                    c = conn.cursor()
+                    c.execute(query, params)
+                    rows = c.fetchall()
+                    if listings.wants_total(qs):
+                        count_sql, count_params = listings.count_query(qs)
+                        headers['X-Total-Count'] = str(conn.execute(count_sql, count_params).fetchone()[0])
+            if len(rows) > limit:
+                rows = rows[:limit]
+                headers['X-Next-Cursor'] = listings.encode_cursor(sort, rows[-1])
+            result = [listings.to_json(row) for row in rows]
+            body = json.dumps(result).encode()
+            positional = 'X-Total-Count' in headers or bool(qs.get('offset', ['0'])[0].strip('0'))
+            entry = cache.Entry(body, cache.make_etag(body), headers,
+                                frozenset(l['id'] for l in result), positional)
+            if cache.ENABLED:
+                cache.listings_cache.put(key, entry, generation)
+        self.send_cached(entry)
+
+    def send_cached(self, entry):
+        # Clients must revalidate, but a matching ETag costs no body. The gzip copy is a
+        # different representation, so it gets its own ETag.
+        use_gzip = len(entry.body) >= streaming.GZIP_MIN_SIZE and streaming.accepts_gzip(self.headers.get('Accept-Encoding'))
+        etag = entry.etag[:-1] + '-gzip"' if use_gzip else entry.etag
+        headers = dict(entry.headers, ETag=etag, Vary='Accept-Encoding')
+        headers['Cache-Control'] = 'no-cache'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
             return
-            
-        # API: Auth Me
-        if path == "/auth/me":
-            user, error = self.get_user_from_token()
-            if error:
-                self.send_error(401, error)
-                return
-            self.send_json(user)
+        if use_gzip:
+            if entry.gzip_body is None:
+                entry.gzip_body = streaming.gzip_bytes(entry.body)
+            self.send_json_bytes(entry.gzip_body, headers, content_encoding='gzip')
+        else:
+            self.send_json_bytes(entry.body, headers)
+
+    # API: Facet counts for the browse filters. Takes the same query string as /listings/;
+    # cached like it, as a positional entry, so creates and deletes drop it
+    @route('GET', '/listings/facets')
+    def get_listing_facets(self):
+        parsed = self.parsed
+        key = cache.cache_key(parsed.path, parsed.query)
+        entry = cache.listings_cache.get(key) if cache.ENABLED else None
+        if entry is None:
+            generation = cache.listings_cache.generation()
+            with db.connection() as conn:
+                result = facets.counts(conn, parse_qs(parsed.query))
+            body = json.dumps(result).encode()
+            entry = cache.Entry(body, cache.make_etag(body), {}, frozenset(), True)
+            if cache.ENABLED:
+                cache.listings_cache.put(key, entry, generation)
+        self.send_cached(entry)
+
+    # API: Live notifications (Server-Sent Events) about the caller's requests and orders
+    @route('GET', '/events/')
+    def event_stream(self):
+        qs = parse_qs(self.parsed.query)
+        user, error = self.get_user_from_token(self.bearer_token() or qs.get('token', [None])[0])
+        if error:
+            self.send_error(401, error)
             return
+        last_id = self.headers.get('Last-Event-ID') or qs.get('last_event_id', [''])[0]
+        last_id = int(last_id) if last_id.isdigit() else None
 
-        # API: Admin - Get All Users
-        if path == "/admin/users":
-            user, error = self.get_user_from_token()
-            if error:
-                self.send_error(401, error)
-                return
-            if user['role'] != 'admin':
-                self.send_error(403, "Admin access required")
-                return
-            
-            conn = sqlite3.connect(DB_FILE, timeout=10)
-            try:
-                conn.row_factory = sqlite3.Row
-                c = conn.cursor()
-                c.execute("SELECT id, name, email, role, location, phone FROM users")
-                users = [dict(row) for row in c.fetchall()]
-            finally:
-                conn.close()
-            self.send_json(users)
+        # The async server keeps the stream on its event loop; everywhere else it holds
+        # a thread for its whole life, so those are capped
+        hold = getattr(self.wfile, 'hold', None)
+        if hold is None and not events.thread_streams.acquire(blocking=False):
+            self.send_error(503, "Too many event streams", headers={'Retry-After': '30'})
             return
-            
-        # API: Admin - Get All Listings (With Profit Info)
-        if path == "/admin/listings_full":
-            user, error = self.get_user_from_token()
-            if error:
-                self.send_error(401, error)
-                return
-            if user['role'] != 'admin':
-                self.send_error(403, "Admin access required")
+        # A stream's length isn't request latency: keep it out of the profiles
+        profiler.discard()
+        sub = events.bus.subscribe(user['id'], last_id)
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('X-Accel-Buffering', 'no')
+            # No length and no chunking: the stream ends when the connection does
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+            self.end_headers()
+            self.wfile.write(f"retry: {events.RETRY_MS}\n\n".encode())
+            while True:
+                backlog = sub.poll()
+                if not backlog:
+                    break
+                self.wfile.write(backlog)
+            if hold is not None:
+                hold(sub)
+                sub = None
                 return
-            
-            conn = sqlite3.connect(DB_FILE, timeout=10)
-            try:
-                conn.row_factory = sqlite3.Row
-                c = conn.cursor()
-                c.execute("SELECT * FROM listings ORDER BY created_at DESC")
-                listings = [dict(row) for row in c.fetchall()]
-                for l in listings:
-                    l['profit'] = (l['price'] or 0) - (l['seller_price'] or (l['price'] or 0)) 
-            finally:
-                conn.close()
-            self.send_json(listings)
+            while not sub.finished():
+                data = sub.poll(heartbeat=not sub.wait(sub.heartbeat))
+                if data:
+                    self.wfile.write(data)
+        except ConnectionError:
+            pass
+        finally:
+            if sub is not None:
+                sub.close()
+            if hold is None:
+                events.thread_streams.release()
+
+    # API: Live notifications for clients that can't hold a stream open (e.g. turned away
+    # with 503 above): the events after last_event_id, and the id to send next time
+    @route('GET', '/events/poll', auth='user')
+    def event_poll(self):
+        last_id = parse_qs(self.parsed.query).get('last_event_id', [''])[0]
+        found, seen = events.bus.catch_up(self.user['id'], int(last_id) if last_id.isdigit() else None)
+        self.send_json({"events": [{"id": event_id, "type": event_type, "data": json.loads(data)}
+                                   for event_id, event_type, data in found],
+                        "last_event_id": seen})
+
+    # API: Dashboard - sent/incoming requests, own listings and orders in one round trip
+    @route('GET', '/dashboard/', auth='user')
+    def get_dashboard(self):
+        try:
+            with db.connection() as conn:
+                data = dashboard.load(conn, self.user['id'], parse_qs(self.parsed.query))
+        except dashboard.QueryError as e:
+            self.send_error(400, str(e))
             return
+        self.send_json(data)
 
-        # API: Admin - Get Sold Items
-        if path == "/admin/sold_items":
-            user, error = self.get_user_from_token()
-            if error:
-                self.send_error(401, error)
-                return
-            if user['role'] != 'admin':
-                self.send_error(403, "Admin access required")
-                return
+    # API: My Requests (As Buyer)
+    @route('GET', '/requests/my-requests', auth='user')
+    def my_requests(self):
+        with db.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT * FROM buy_requests WHERE buyer_id=?", (self.user['id'],))
+            requests = [dict(row) for row in c.fetchall()]
+        self.send_json(requests)
 
-            conn = sqlite3.connect(DB_FILE, timeout=10)
-            try:
-                conn.row_factory = sqlite3.Row
-                c = conn.cursor()
-                query = '''
-                    SELECT 
-                        l.id, l.title, l.price, l.seller_price, l.category,
-                        br.updated_at as sold_date,
-                        b.name as buyer_name, b.email as buyer_email, b.phone as buyer_phone,
-                        s.name as seller_name, s.email as seller_email, s.phone as seller_phone
-                    FROM buy_requests br
-                    JOIN listings l ON br.listing_id = l.id
-                    JOIN users b ON br.buyer_id = b.id
-                    JOIN users s ON l.seller_id = s.id
-                    WHERE br.status = 'accepted'
-                    ORDER BY br.updated_at DESC
-                '''
-                c.execute(query)
-                sold_items = [dict(row) for row in c.fetchall()]
-                for item in sold_items:
-                     item['profit'] = (item['price'] or 0) - (item['seller_price'] or (item['price'] or 0))
-            finally:
-                conn.close()
-            self.send_json(sold_items)
+    # API: Incoming Requests (As Seller)
+    @route('GET', '/requests/incoming', auth='user')
+    def incoming_requests(self):
+        with db.connection() as conn:
+            c = conn.cursor()
+            c.execute('''
+                SELECT br.*, u.name as buyer_name, u.location as buyer_location
+                FROM buy_requests br
+                JOIN users u ON br.buyer_id = u.id
+                WHERE br.seller_id=?
+            ''', (self.user['id'],))
+            # Note: REMOVED u.email, u.phone from SELECT to enforce privacy
+            requests = [dict(row) for row in c.fetchall()]
+        self.send_json(requests)
+
+    # API: Get Orders (Seller/Buyer)
+    @route('GET', '/orders/my-orders', auth='user')
+    def my_orders(self):
+        user = self.user
+        with db.connection() as conn:
+            c = conn.cursor()
+            if user['role'] == 'buyer':
+                c.execute("SELECT * FROM orders WHERE buyer_id=? ORDER BY created_at DESC", (user['id'],))
+            else:
+                c.execute("SELECT * FROM orders WHERE seller_id=? ORDER BY created_at DESC", (user['id'],))
+            orders = [dict(row) for row in c.fetchall()]
+        self.send_json(orders)
+
+    # API: Auth Me
+    @route('GET', '/auth/me', auth='user')
+    def get_me(self):
+        self.send_json(self.user)
+
+    # API: Admin - Get All Users
+    @route('GET', '/admin/users', auth='admin')
+    def admin_users(self):
+        with db.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT id, name, email, role, location, phone FROM users")
+            users = [dict(row) for row in c.fetchall()]
+        self.send_json(users)
+
+    # API: Admin - Get All Listings (With Profit Info)
+    @route('GET', '/admin/listings_full', auth='admin')
+    def admin_listings_full(self):
+        with db.connection() as conn:
+            c = conn.cursor()
+            c.execute(f"SELECT *, {rollups.PROFIT_SQL.format(t='')} AS profit FROM listings ORDER BY created_at DESC")
+            self.send_json_stream(dict(row) for row in c)
+
+    # API: Admin - Get Sold Items
+    @route('GET', '/admin/sold_items', auth='admin')
+    def admin_sold_items(self):
+        with db.connection() as conn:
+            c = conn.cursor()
+            c.execute(rollups.SOLD_ITEMS_SQL + " ORDER BY br.updated_at DESC")
+            self.send_json_stream(dict(row) for row in c)
+
+    # API: Admin - Streaming exports (?format=ndjson|csv)
+    @route('GET', '/admin/export/{kind:listings|sold_items|orders}', auth='admin')
+    def admin_export(self, kind):
+        fmt = parse_qs(self.parsed.query).get('format', ['ndjson'])[0]
+        if fmt not in bulk.FORMATS:
+            self.send_error(400, f"Unknown format: {fmt}")
             return
+        with db.connection() as conn:
+            c = conn.execute(EXPORT_QUERIES[kind])
+            if fmt == 'csv':
+                chunks = streaming.csv_lines([d[0] for d in c.description], c)
+            else:
+                chunks = streaming.ndjson_lines(dict(row) for row in c)
+            self.send_stream(bulk.FORMATS[fmt], chunks,
+                             {'Content-Disposition': f'attachment; filename="{kind}.{fmt}"'})
 
-        self.send_error(404)
+    # API: Admin - Sales and profit totals (from the rollup tables)
+    @route('GET', '/admin/stats', auth='admin')
+    def admin_stats(self):
+        qs = parse_qs(self.parsed.query)
+        try:
+            days = listings.parse_int(qs, 'days', 30, 1, 366)
+            top = listings.parse_int(qs, 'top', 10, 1, 100)
+        except listings.QueryError as e:
+            self.send_error(400, str(e))
+            return
+        with db.connection() as conn:
+            self.send_json(rollups.summary(conn, days, top))
+
+    # API: Admin - Connection pool and write queue stats
+    @route('GET', '/admin/db_stats', auth='admin')
+    def admin_db_stats(self):
+        self.send_json({**db.pool_stats(), "writer": writer.stats(), "passwords": passwords.stats(),
+                        "catalogue": catalogue.index.stats()})
 
-    def do_POST(self):
+    # API: Admin - Slow-request profiles: hotspots across the dumps of every worker
+    @route('GET', '/admin/profiles', auth='admin')
+    def admin_profiles(self):
+        if not profiler.ENABLED:
+            self.send_error(404, "Profiling is disabled (set PROFILE_EVERY or PROFILE_SLOW_MS)")
+            return
+        qs = parse_qs(self.parsed.query)
         try:
-            length = int(self.headers.get('Content-Length'))
-            body = json.loads(self.rfile.read(length))
-            parsed = urlparse(self.path)
-            path = parsed.path
-
-            # API: Login
-            if path == "/auth/login":
-                conn = sqlite3.connect(DB_FILE, timeout=10)
-                try:
-                    conn.row_factory = sqlite3.Row
-                    c = conn.cursor()
-                    pwd_hash = hashlib.sha256(body['password'].encode()).hexdigest()
-                    c.execute("SELECT * FROM users WHERE email=? AND password_hash=?", (body['email'], pwd_hash))
-                    user = c.fetchone()
-                finally:
-                    conn.close()
-                
-                if user:
-                    token = f"{user['id']}:{secrets.token_hex(16)}"
-                    user_dict = dict(user)
-                    del user_dict['password_hash']
-                    self.send_json({"access_token": token, "user": user_dict})
-                else:
-                    self.send_error(401, "Invalid credentials")
-                return
+            top = listings.parse_int(qs, 'top', profiler.TOP, 1, 200)
+        except listings.QueryError as e:
+            self.send_error(400, str(e))
+            return
+        self.send_json({"process": profiler.stats(),
+                        **profiler.report(route=qs.get('route', [None])[0], top=top)})
 
-            # API: Register
-            if path == "/auth/register":
-                conn = sqlite3.connect(DB_FILE, timeout=10)
-                try:
-                    c = conn.cursor()
-                    pwd_hash = hashlib.sha256(body['password'].encode()).hexdigest()
-                    try:
-                        c.execute("INSERT INTO users (name, email, password_hash, role, location, phone) VALUES (?, ?, ?, ?, ?, ?)",
-                                  (body['name'], body['email'], pwd_hash, body['role'], body['location'], body.get('phone', '')))
-                        conn.commit()
-                        user_id = c.lastrowid
-                        token = f"{user_id}:{secrets.token_hex(16)}"
-                        self.send_json({"access_token": token, "user": {**body, "id": user_id, "password": ""}})
-                    except sqlite3.IntegrityError:
-                        self.send_error(400, "Email already exists")
-                    except Exception as e:
-                        print(f"Registration Error: {e}")
-                        self.send_error(500, f"Registration failed: {str(e)}")
-                finally:
-                    conn.close()
-                return
+    # API: Admin - Prometheus metrics
+    @route('GET', '/metrics', auth='admin')
+    def get_metrics(self):
+        if not metrics.ENABLED:
+            self.send_error(404, "Metrics are disabled (METRICS=0)")
+            return
+        pool = db.pool_stats()
+        queue = writer.stats()
+        body = metrics.render([
+            ("sqlite_pool_connections_open", "Connections the pool has open", pool['open']),
+            ("sqlite_pool_connections_in_use", "Connections checked out right now", pool['in_use']),
+            ("sqlite_write_queue_depth", "Writes waiting for the writer thread", queue['queued']),
+            ("response_cache_entries", "Entries in the listings response cache",
+             cache.listings_cache.stats()['entries']),
+            ("event_subscribers", "Open event streams", events.bus.subscriber_count()),
+            ("password_hash_pending", "Password hashes running or queued", passwords.pool.pending),
+        ])
+        self.send_response(200)
+        self.send_header('Content-Type', metrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-            # API: Create Listing
-            if path == "/listings/":
-                user, error = self.get_user_from_token()
-                if error: 
-                    self.send_error(401, error)
-                    return
-                conn = sqlite3.connect(DB_FILE, timeout=10)
-                try:
-                    seller_price = float(body['price']) # The input 'price' is what the seller WANTS
-                    # Markup Logic: +10% + 20 flat fee
-                    display_price = (seller_price * 1.10) + 20 
-                    # Rounding
-                    display_price = round(display_price, 2)
-                    
-                    c = conn.cursor()
-                    c.execute('''INSERT INTO listings (seller_id, title, category, brand, model, condition, seller_price, price, location, description, working_parts, photos)
-                                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                              (user['id'], body['title'], body['category'], body['brand'], body['model'], 
-                               body['condition'], seller_price, display_price, body['location'], body['description'], 
-                               body['working_parts'], json.dumps(body['photos'])))
-                    conn.commit()
-                    lid = c.lastrowid
-                    self.send_json({"id": lid, "status": "active", "price": display_price})
-                finally:
-                    conn.close()
-                return
+    # API: Login
+    @route('POST', '/auth/login')
+    def login(self):
+        body = self.read_json()
+        if not isinstance(body['email'], str) or not isinstance(body['password'], str):
+            raise HTTPError(400, "email and password must be strings")
+        if not self.throttle(body['email']):
+            return
+        with db.connection() as conn:
+            c = conn.cursor()
+            c.execute("SELECT * FROM users WHERE email=?", (body['email'],))
+            user = c.fetchone()
+        # An unknown email is checked against a dummy hash, so it takes as long as a wrong password
+        ok, rehash = passwords.verify_async(body['password'], user['password_hash'] if user else None)
+        if not (user and ok):
+            self.send_error(401, "Invalid credentials")
+            return
 
-            # API: Create Request
-            if path == "/requests/":
-                user, error = self.get_user_from_token()
-                if error:
-                    self.send_error(401, error)
-                    return
-                conn = sqlite3.connect(DB_FILE, timeout=10)
-                try:
-                    c = conn.cursor()
-                    
-                    # CHECK LIMIT: Check if user already has a PENDING request for this listing
-                    c.execute("SELECT id FROM buy_requests WHERE listing_id=? AND buyer_id=? AND status='pending'", (body['listing_id'], user['id']))
-                    existing = c.fetchone()
-                    if existing:
-                         # Use 400 Bad Request
-                         self.send_error(400, "You already have a pending request for this item.")
-                         return
-
-                    c.execute("SELECT seller_id FROM listings WHERE id=?", (body['listing_id'],))
-                    listing = c.fetchone()
-                    if not listing:
-                        self.send_error(404, "Listing not found")
-                        return 
-                    
-                    c.execute("INSERT INTO buy_requests (listing_id, buyer_id, seller_id) VALUES (?, ?, ?)",
-                              (body['listing_id'], user['id'], listing[0]))
-                    conn.commit()
-                    rid = c.lastrowid
-                    self.send_json({"id": rid, "status": "pending"})
-                finally:
-                    conn.close()
-                return
+        new_hash = None
+        if rehash:
+            # Upgrade a legacy or weaker hash now that we know the password. If the pool is
+            # busy it can wait for the next login.
+            try:
+                new_hash = passwords.hash_async(body['password'])
+            except passwords.PasswordBusy:
+                pass
 
-                return
+        def op(conn):
+            if new_hash:
+                conn.execute("UPDATE users SET password_hash=? WHERE id=? AND password_hash=?",
+                             (new_hash, user['id'], user['password_hash']))
+            return sessions.create(conn, user['id'])
 
-            # API: Create Order (Checkout)
-            if path == "/orders/":
-                user, error = self.get_user_from_token()
-                if error:
-                    self.send_error(401, error)
-                    return
-                conn = sqlite3.connect(DB_FILE, timeout=10)
-                try:
-                    conn.row_factory = sqlite3.Row
-                    c = conn.cursor()
-                    # Verify request is accepted
-                    c.execute("SELECT * FROM buy_requests WHERE id=? AND buyer_id=? AND status='accepted'", (body['request_id'], user['id']))
-                    req = c.fetchone()
-                    if not req:
-                        self.send_error(400, "Invalid request or not accepted yet.")
-                        return
-
-                    # Create Order
-                    c.execute('''INSERT INTO orders 
-                        (request_id, listing_id, buyer_id, seller_id, shipping_name, shipping_address, shipping_phone, shipping_email, shipping_pincode, payment_method)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                        (req['id'], req['listing_id'], req['buyer_id'], req['seller_id'], 
-                         body['shipping_name'], body['shipping_address'], body['shipping_phone'], body['shipping_email'], body['shipping_pincode'], body['payment_method']))
-                    
-                    # Mark request as completed (optional, or just keep as accepted)
-                    c.execute("UPDATE buy_requests SET status='completed' WHERE id=?", (req['id'],))
-                    
-                    conn.commit()
-                    oid = c.lastrowid
-                    self.send_json({"id": oid, "status": "paid"})
-                finally:
-                    conn.close()
-                return
+        token = writer.run(op)
+        user_dict = dict(user)
+        del user_dict['password_hash']
+        self.send_json({"access_token": token, "user": user_dict})
+
+    def throttle(self, email=None):
+        # Login and register attempts per client IP (and per email); False after sending 429
+        wait = passwords.throttle(self.client_ip(), email)
+        if wait:
+            self.send_error(429, "Too many attempts, try again later", headers={'Retry-After': str(math.ceil(wait))})
+            return False
+        return True
+
+    # API: Logout (revokes the session behind the bearer token)
+    @route('POST', '/auth/logout')
+    def logout(self):
+        token = self.bearer_token()
+        if token:
+            writer.run(sessions.revoke, token)
+            sessions.forget(token)
+        self.send_json({"status": "logged out"})
 
+    # API: Register
+    @route('POST', '/auth/register')
+    def register(self):
+        body = self.read_json()
+        if not isinstance(body['password'], str):
+            raise HTTPError(400, "password must be a string")
+        if not self.throttle():
+            return
+        pwd_hash = passwords.hash_async(body['password'])
+
+        def op(conn):
+            c = conn.cursor()
+            c.execute("INSERT INTO users (name, email, password_hash, role, location, phone) VALUES (?, ?, ?, ?, ?, ?)",
+                      (body['name'], body['email'], pwd_hash, body['role'], body['location'], body.get('phone', '')))
+            user_id = c.lastrowid
+            return user_id, sessions.create(conn, user_id)
+
+        try:
+            user_id, token = writer.run(op)
+        except sqlite3.IntegrityError:
+            self.send_error(400, "Email already exists")
+            return
         except Exception as e:
-            print(f"Server Error: {e}")
-            self.send_error(500, str(e))
+            print(f"Registration Error: {e}")
+            self.send_error(500, f"Registration failed: {str(e)}")
+            return
+        self.send_json({"access_token": token, "user": {**body, "id": user_id, "password": ""}})
 
-    def do_PUT(self):
+    # API: Create Listing
+    @route('POST', '/listings/', auth='user', max_body=photos.MAX_INLINE_BODY)
+    def create_listing(self):
+        body = self.read_json()
         try:
-            length = int(self.headers.get('Content-Length'))
-            body = json.loads(self.rfile.read(length))
-            parsed = urlparse(self.path)
-            path = parsed.path
+            seller_price = float(body['price']) # The input 'price' is what the seller WANTS
+        except (TypeError, ValueError):
+            raise HTTPError(400, "Invalid price")
+        display_price = listings.display_price(seller_price)
+        # Read every field before the photos go to disk, so a bad request leaves no files behind
+        fields = (body['title'], body['category'], body['brand'], body['model'], body['condition'],
+                  body['location'], body['description'], body['working_parts'])
+        try:
+            photo_urls = photos.store_uploads(body.get('photos', []), body.get('thumbnails'), self.user['id'])
+        except photos.PhotoError as e:
+            self.send_error(400, str(e))
+            return
+        title, category, brand, model, condition, location, description, working_parts = fields
+
+        def op(conn):
+            c = conn.cursor()
+            c.execute('''INSERT INTO listings (seller_id, title, category, brand, model, condition, seller_price, price, location, description, working_parts, photos)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                      (self.user['id'], title, category, brand, model, condition, seller_price,
+                       display_price, location, description, working_parts, json.dumps(photo_urls)))
+            return c.lastrowid
+
+        lid = writer.run(op)
+        cache.listings_cache.invalidate_all()
+        self.send_json({"id": lid, "status": "active", "price": display_price})
+
+    # API: Bulk Import Listings (NDJSON or CSV body, see bulk.py)
+    @route('POST', '/listings/import', auth='user', max_body=bulk.MAX_IMPORT_BYTES)
+    def import_listings(self):
+        fmt = bulk.import_format(self.headers.get('Content-Type'))
+        if fmt is None:
+            self.send_error(415, "Send text/csv or application/x-ndjson")
+            return
+        length = self.content_length()
+        importer = bulk.Importer(self.user['id'], fmt, lambda rows: writer.run(bulk.insert_batch, rows))
+        self._body_read = True
+        lines = bulk.read_lines(self.rfile, length)
+        try:
+            result = importer.run(lines)
+        except bulk.BulkError as e:
+            # Drain what's left so the connection stays usable
+            for _ in lines:
+                pass
+            self.send_error(400, str(e))
+            return
+        except Exception:
+            # The body is only partly read, so this connection can't carry another request
+            self.close_connection = True
+            raise
+        finally:
+            if importer.imported:
+                cache.listings_cache.invalidate_all()
+        self.send_json(result)
+
+    # API: Create Request
+    @route('POST', '/requests/', auth='user')
+    def create_request(self):
+        body = self.read_json()
+        buyer_id = self.user['id']
+
+        def op(conn):
+            c = conn.cursor()
             
-            # API: Update User Profile
-            if path == "/auth/me":
-                user, error = self.get_user_from_token()
-                if error:
-                    self.send_error(401, error)
-                    return
-                
-                conn = sqlite3.connect(DB_FILE, timeout=10)
-                try:
-                    c = conn.cursor()
-                    
-                    # Updates
-                    update_fields = []
-                    params = []
-                    
-                    if 'name' in body:
-                        update_fields.append("name=?")
-                        params.append(body['name'])
-                    if 'location' in body:
-                        update_fields.append("location=?")
-                        params.append(body['location'])
-                    if 'phone' in body:
-                        update_fields.append("phone=?")
-                        params.append(body['phone'])
-                        
-                    # Password change
-                    if 'password' in body and body['password']:
-                        pwd_hash = hashlib.sha256(body['password'].encode()).hexdigest()
-                        update_fields.append("password_hash=?")
-                        params.append(pwd_hash)
-                    
-                    if not update_fields:
-                        self.send_json({"status": "no changes"})
-                        return
-
-                    params.append(user['id'])
-                    c.execute(f"UPDATE users SET {', '.join(update_fields)} WHERE id=?", params)
-                    conn.commit()
-                    
-                    # Return updated user
-                    c.execute("SELECT id, name, email, role, location, phone FROM users WHERE id=?", (user['id'],))
-                    updated_user = dict(c.fetchone())
-                    self.send_json(updated_user)
-                finally:
-                    conn.close()
-                return
+            # CHECK LIMIT: Check if user already has a PENDING request for this listing
+            c.execute("SELECT id FROM buy_requests WHERE listing_id=? AND buyer_id=? AND status='pending'", (body['listing_id'], buyer_id))
+            if c.fetchone():
+                 # Use 400 Bad Request
+                 raise HTTPError(400, "You already have a pending request for this item.")
 
-            # API: Accept/Reject Request
-            if path.startswith("/requests/"):
-                user, error = self.get_user_from_token()
-                if error:
-                    self.send_error(401, error)
-                    return
-                parts = path.strip("/").split("/")
-                req_id = int(parts[1])
-                action = parts[2] # accept/reject
-                
-                status = "accepted" if action == "accept" else "rejected"
-                
-                conn = sqlite3.connect(DB_FILE, timeout=10)
-                try:
-                    c = conn.cursor()
-                    if status == 'accepted':
-                        c.execute("UPDATE buy_requests SET status=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (status, req_id))
-                        # Mark listing as SOLD
-                        c.execute("UPDATE listings SET status='sold' WHERE id=(SELECT listing_id FROM buy_requests WHERE id=?)", (req_id,))
-                    else:
-                        c.execute("UPDATE buy_requests SET status=? WHERE id=?", (status, req_id))
-                    conn.commit()
-                finally:
-                    conn.close()
-                self.send_json({"id": req_id, "status": status})
-                return
+            c.execute("SELECT seller_id, status FROM listings WHERE id=?", (body['listing_id'],))
+            listing = c.fetchone()
+            if not listing:
+                raise HTTPError(404, "Listing not found")
+            if listing['status'] != 'active':
+                raise HTTPError(409, "Listing is no longer available")
 
-        except Exception as e:
-            print(f"PUT Error: {e}")
-            self.send_error(500, str(e))
+            c.execute("INSERT INTO buy_requests (listing_id, buyer_id, seller_id) VALUES (?, ?, ?)",
+                      (body['listing_id'], buyer_id, listing[0]))
+            rid = c.lastrowid
+            events.record(conn, [buyer_id, listing[0]], 'request.created', request_event(c, rid))
+            return rid
 
-    def do_DELETE(self):
-        parsed = urlparse(self.path)
-        path = parsed.path
+        rid = writer.run(op)
+        events.bus.pull()
+        self.send_json({"id": rid, "status": "pending"})
+
+    # API: Create Order (Checkout)
+    @route('POST', '/orders/', auth='user')
+    def create_order(self):
+        body = self.read_json()
+        buyer_id = self.user['id']
+
+        def op(conn):
+            # Returns (order id, whether it was created now)
+            c = conn.cursor()
+            # Claim the accepted request (accepted -> completed). Only one checkout can; a
+            # repeat of one that already went through gets the order it made.
+            c.execute("UPDATE buy_requests SET status='completed' WHERE id=? AND buyer_id=? AND status='accepted' "
+                      "RETURNING id, listing_id, buyer_id, seller_id", (body['request_id'], buyer_id))
+            req = c.fetchone()
+            if not req:
+                done = c.execute("SELECT o.id FROM orders o JOIN buy_requests br ON br.id = o.request_id "
+                                 "WHERE br.id=? AND br.buyer_id=? AND br.status='completed' ORDER BY o.id LIMIT 1",
+                                 (body['request_id'], buyer_id)).fetchone()
+                if done:
+                    return done[0], False
+                raise HTTPError(400, "Invalid request or not accepted yet.")
+
+            # Create Order
+            c.execute('''INSERT INTO orders 
+                (request_id, listing_id, buyer_id, seller_id, shipping_name, shipping_address, shipping_phone, shipping_email, shipping_pincode, payment_method)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (req['id'], req['listing_id'], req['buyer_id'], req['seller_id'], 
+                 body['shipping_name'], body['shipping_address'], body['shipping_phone'], body['shipping_email'], body['shipping_pincode'], body['payment_method']))
+            
+            oid = c.lastrowid
+
+            # The request went accepted -> completed above: still a sale on the same day, so
+            # only the order counters move
+            rollups.apply(conn, rollups.orders(conn, "o.id=?", (oid,)))
+            order = dict(c.execute("SELECT * FROM orders WHERE id=?", (oid,)).fetchone())
+            events.record(conn, [req['buyer_id'], req['seller_id']], 'order.created', order)
+            return oid, True
+
+        oid, created = writer.run(op)
+        if created:
+            events.bus.pull()
+        self.send_json({"id": oid, "status": "paid"})
+
+    # API: Update User Profile
+    @route('PUT', '/auth/me', auth='user')
+    def update_me(self):
+        body = self.read_json()
+        user = self.user
+            
+        # Updates
+        update_fields = []
+        params = []
         
-        user, error = self.get_user_from_token()
-        if error:
-            self.send_error(401, error)
-            return
+        if 'name' in body:
+            update_fields.append("name=?")
+            params.append(body['name'])
+        if 'location' in body:
+            update_fields.append("location=?")
+            params.append(body['location'])
+        if 'phone' in body:
+            update_fields.append("phone=?")
+            params.append(body['phone'])
             
-        if user['role'] != 'admin':
-            self.send_error(403, "Admin access required")
+        # Password change
+        if 'password' in body and body['password']:
+            pwd_hash = passwords.hash_async(body['password'])
+            update_fields.append("password_hash=?")
+            params.append(pwd_hash)
+        
+        if not update_fields:
+            self.send_json({"status": "no changes"})
             return
 
-        try:
-            # API: Admin - Delete User
-            if path.startswith("/admin/users/"):
-                parts = path.strip("/").split("/")
-                user_id_to_delete = int(parts[2])
-                
-                if user_id_to_delete == user['id']:
-                    self.send_error(400, "Cannot delete yourself")
-                    return
+        params.append(user['id'])
+        keep_token = self.bearer_token()
 
-                conn = sqlite3.connect(DB_FILE, timeout=10)
-                try:
-                    c = conn.cursor()
-                    # Cascade delete (simple approach: manual delete related items)
-                    c.execute("DELETE FROM listings WHERE seller_id=?", (user_id_to_delete,))
-                    c.execute("DELETE FROM buy_requests WHERE buyer_id=? OR seller_id=?", (user_id_to_delete, user_id_to_delete))
-                    c.execute("DELETE FROM users WHERE id=?", (user_id_to_delete,))
-                    conn.commit()
-                    self.send_json({"status": "deleted", "id": user_id_to_delete})
-                finally:
-                    conn.close()
-                return
+        def op(conn):
+            c = conn.cursor()
+            c.execute(f"UPDATE users SET {', '.join(update_fields)} WHERE id=?", params)
+            if 'password' in body and body['password']:
+                # Sign out every other device; this one keeps its session
+                sessions.revoke_user(conn, user['id'], keep_token=keep_token)
+            # Return updated user
+            c.execute("SELECT id, name, email, role, location, phone FROM users WHERE id=?", (user['id'],))
+            return dict(c.fetchone())
 
-            # API: Admin - Delete Listing
-            if path.startswith("/admin/listings/"):
-                parts = path.strip("/").split("/")
-                listing_id = int(parts[2])
-                
-                conn = sqlite3.connect(DB_FILE, timeout=10)
-                try:
-                    c = conn.cursor()
-                    c.execute("DELETE FROM buy_requests WHERE listing_id=?", (listing_id,))
-                    c.execute("DELETE FROM listings WHERE id=?", (listing_id,))
-                    conn.commit()
-                    self.send_json({"status": "deleted", "id": listing_id})
-                finally:
-                    conn.close()
-                return
+        updated_user = writer.run(op)
+        sessions.forget_user(user['id'])
+        self.send_json(updated_user)
 
-            self.send_error(404, "Endpoint not found")
+    # API: Accept/Reject Request
+    # Only the seller can decide, and only on a pending request. Accepting is a
+    # compare-and-set on the listing (active -> sold) and the request (pending -> accepted);
+    # whoever gets there first wins and every other pending request for the listing is
+    # rejected in the same transaction. Repeating a decision that already stands is a no-op.
+    @route('PUT', '/requests/{req_id:int}/{action:accept|reject}', auth='user')
+    def update_request(self, req_id, action):
+        status = "accepted" if action == "accept" else "rejected"
+        seller_id = self.user['id']
+
+        def op(conn):
+            # Returns (listing sold, request status now, whether anything changed)
+            c = conn.cursor()
+            req = c.execute("SELECT id, listing_id, seller_id, status FROM buy_requests WHERE id=?", (req_id,)).fetchone()
+            if not req:
+                raise HTTPError(404, "Request not found")
+            if req['seller_id'] != seller_id:
+                raise HTTPError(403, "Only the seller can accept or reject this request")
+            if req['status'] in (('accepted', 'completed') if status == 'accepted' else ('rejected',)):
+                return None, req['status'], False
+            if req['status'] != 'pending':
+                raise HTTPError(409, f"Request is already {req['status']}")
+
+            sold = None
+            changed = [req_id]
+            if status == 'accepted':
+                if c.execute("UPDATE listings SET status='sold' WHERE id=? AND status='active'",
+                             (req['listing_id'],)).rowcount != 1:
+                    raise HTTPError(409, "Listing is no longer available")
+                sold = req['listing_id']
+            c.execute("UPDATE buy_requests SET status=?, updated_at=CURRENT_TIMESTAMP WHERE id=? AND status='pending'",
+                      (status, req_id))
+            if sold is not None:
+                # Rejections aren't sales, so only the accepted request moves the rollups
+                rollups.apply(conn, rollups.sales(conn, "br.id=?", (req_id,)))
+                changed += [r[0] for r in c.execute(
+                    "UPDATE buy_requests SET status='rejected', updated_at=CURRENT_TIMESTAMP "
+                    "WHERE listing_id=? AND status='pending' RETURNING id", (sold,)).fetchall()]
+            for rid in changed:
+                updated = request_event(c, rid)
+                events.record(conn, [updated['buyer_id'], updated['seller_id']], 'request.updated', updated)
+            return sold, status, True
+
+        sold, current, changed = writer.run(op)
+        if sold is not None:
+            cache.listings_cache.invalidate_listings([sold])
+        if changed:
+            events.bus.pull()
+        self.send_json({"id": req_id, "status": current})
+
+    # API: Admin - Delete User
+    @route('DELETE', '/admin/users/{user_id:int}', auth='admin')
+    def delete_user(self, user_id):
+        if user_id == self.user['id']:
+            self.send_error(400, "Cannot delete yourself")
+            return
+
+        def op(conn):
+            c = conn.cursor()
+            # Take what's about to disappear out of the sales rollups: the user's requests,
+            # and the orders of their listings
+            rollups.apply(conn, rollups.sales(conn, "br.buyer_id=? OR br.seller_id=? OR l.seller_id=?",
+                                              (user_id, user_id, user_id)), -1)
+            rollups.apply(conn, rollups.orders(conn, "l.seller_id=?", (user_id,)), -1)
+            # Cascade delete (simple approach: manual delete related items)
+            c.execute("DELETE FROM listings WHERE seller_id=?", (user_id,))
+            c.execute("DELETE FROM buy_requests WHERE buyer_id=? OR seller_id=?", (user_id, user_id))
+            c.execute("DELETE FROM users WHERE id=?", (user_id,))
+            sessions.revoke_user(conn, user_id)
+
+        writer.run(op)
+        sessions.forget_user(user_id)
+        cache.listings_cache.invalidate_all()
+        self.send_json({"status": "deleted", "id": user_id})
+
+    # API: Admin - Delete Listing
+    @route('DELETE', '/admin/listings/{listing_id:int}', auth='admin')
+    def delete_listing(self, listing_id):
+        def op(conn):
+            c = conn.cursor()
+            rollups.apply(conn, rollups.sales(conn, "br.listing_id=?", (listing_id,)), -1)
+            rollups.apply(conn, rollups.orders(conn, "o.listing_id=?", (listing_id,)), -1)
+            c.execute("DELETE FROM buy_requests WHERE listing_id=?", (listing_id,))
+            c.execute("DELETE FROM listings WHERE id=?", (listing_id,))
+
+        writer.run(op)
+        cache.listings_cache.invalidate_listings([listing_id], positional=True)
+        self.send_json({"status": "deleted", "id": listing_id})
 
-        except Exception as e:
-            print(f"Delete Error: {e}")
-            self.send_error(500, str(e))
 
-    def send_json(self, data):
+    def send_json(self, data, headers=None):
+        body = json.dumps(data).encode()
+        if len(body) >= streaming.GZIP_MIN_SIZE:
+            headers = dict(headers or {}, Vary='Accept-Encoding')
+            if streaming.accepts_gzip(self.headers.get('Accept-Encoding')):
+                self.send_json_bytes(streaming.gzip_bytes(body), headers, content_encoding='gzip')
+                return
+        self.send_json_bytes(body, headers)
+
+    def send_json_bytes(self, body, headers=None, content_encoding=None):
         self.send_response(200)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if content_encoding:
+            self.send_header('Content-Encoding', content_encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
 
-    def get_user_from_token(self):
+    def send_json_stream(self, items, headers=None):
+        # Write a JSON array as items are produced (typically straight off a cursor), so
+        # peak memory is one chunk regardless of how many rows there are
+        self.send_stream('application/json', streaming.json_array(items), headers)
+
+    def send_stream(self, content_type, chunks, headers=None):
+        chunked = self.request_version == 'HTTP/1.1' and self.protocol_version == 'HTTP/1.1'
+        use_gzip = streaming.accepts_gzip(self.headers.get('Accept-Encoding'))
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            # No length up front, so the end of the body is the end of the connection
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        out = streaming.ChunkedWriter(self.wfile) if chunked else streaming.RawWriter(self.wfile)
+        if use_gzip:
+            out = streaming.GzipWriter(out)
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+            out.close()
+        except Exception as e:
+            # Too late for an error status: cut the connection so the client sees a truncated body
+            print(f"Stream Error: {e}")
+            self.close_connection = True
+
+    def client_ip(self):
+        # The caller's address. Behind TRUSTED_PROXIES proxies it's the one the outermost
+        # of them saw: each appends the address it got the request from to X-Forwarded-For,
+        # so entries further left are whatever the client chose to send.
+        if TRUSTED_PROXIES:
+            hops = [h.strip() for h in ",".join(self.headers.get_all('X-Forwarded-For') or []).split(",")]
+            hops = [h for h in hops if h]
+            if len(hops) >= TRUSTED_PROXIES:
+                return hops[-TRUSTED_PROXIES]
+        return self.client_address[0]
+
+    def bearer_token(self):
         auth_header = self.headers.get('Authorization')
         if not auth_header or not auth_header.startswith("Bearer "):
+            return None
+        return auth_header[len("Bearer "):].strip() or None
+
+    def get_user_from_token(self, token=None):
+        token = token or self.bearer_token()
+        if not token:
             return None, "Unauthorized"
-        token = auth_header.split(" ")[1]
-        try:
-            user_id = int(token.split(":")[0])
-            conn = sqlite3.connect(DB_FILE, timeout=10)
-            try:
-                conn.row_factory = sqlite3.Row
-                c = conn.cursor()
-                c.execute("SELECT * FROM users WHERE id=?", (user_id,))
-                user = c.fetchone()
-            finally:
-                conn.close()
-            if not user:
-                 return None, "Invalid User"
-            return dict(user), None
-        except:
+        user = sessions.lookup(db.connection, token)
+        if not user:
             return None, "Invalid Token"
+        return user, None
 
 if __name__ == "__main__":
     init_db()
-    server = socketserver.TCPServer(("", PORT), MarketplaceHandler)
-    print(f"Serving at http://localhost:{PORT}")
-    server.serve_forever()
+    if catalogue.ENABLED:
+        with db.connection() as conn:
+            catalogue.warm(conn)
+    router.compile()
+    serving.on_stop(events.bus.close)
+    serving.serve(MarketplaceHandler, PORT)
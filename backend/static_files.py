@@ -0,0 +1,217 @@
+import errno
+import gzip
+import mimetypes
+import os
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+
+# Static file serving for /static/. File contents and metadata are cached in memory
+# (re-validated against the file's mtime and size), compressible files get a gzip
+# variant computed once, and large files are streamed with os.sendfile().
+INLINE_MAX = int(os.environ.get("STATIC_INLINE_MAX", 1024 * 1024))
+CACHE_MAX_BYTES = int(os.environ.get("STATIC_CACHE_BYTES", 32 * 1024 * 1024))
+# Assets aren't fingerprinted, so code must be revalidated; everything else may be reused a while
+MAX_AGE = int(os.environ.get("STATIC_MAX_AGE", 86400))
+REVALIDATE_TYPES = ("text/html", "application/javascript", "text/css")
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+MIN_COMPRESS = 512
+
+MIME_OVERRIDES = {
+    ".js": "application/javascript",
+    ".mjs": "application/javascript",
+    ".css": "text/css",
+    ".html": "text/html",
+    ".json": "application/json",
+    ".svg": "image/svg+xml",
+    ".webp": "image/webp",
+    ".ico": "image/x-icon",
+    ".woff2": "font/woff2",
+}
+
+
+def guess_type(path):
+    ext = os.path.splitext(path)[1].lower()
+    mime = MIME_OVERRIDES.get(ext) or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if mime.startswith("text/") or mime in ("application/javascript", "application/json"):
+        mime += "; charset=utf-8"
+    return mime
+
+
+class StaticFile:
+    __slots__ = ("path", "mtime", "size", "mime", "etag", "last_modified", "cache_control",
+                 "content", "variants")
+
+    def __init__(self, path, st):
+        self.path = path
+        self.mtime = st.st_mtime_ns
+        self.size = st.st_size
+        self.mime = guess_type(path)
+        self.etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        base = self.mime.split(";")[0]
+        self.cache_control = "no-cache" if base in REVALIDATE_TYPES else f"public, max-age={MAX_AGE}"
+        self.content = None
+        # encoding -> (bytes or None, path on disk or None)
+        self.variants = {}
+
+
+def parse_accept_encoding(header):
+    accepted = {}
+    for part in (header or "").split(","):
+        pieces = part.strip().split(";")
+        name = pieces[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in pieces[1:]:
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def parse_range(header, size):
+    # Returns (start, end) inclusive for a single satisfiable byte range, None to ignore
+    # the header, or False when the range can't be satisfied.
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[6:].strip().partition("-")
+    try:
+        if start == "":
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+class StaticFiles:
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self._files = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def resolve(self, relative):
+        path = os.path.realpath(os.path.join(self.root, relative))
+        # Keep ../ out of the rest of the filesystem
+        if not path.startswith(self.root + os.sep):
+            return None
+        return path
+
+    def lookup(self, relative):
+        path = self.resolve(relative)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        with self._lock:
+            entry = self._files.get(path)
+            if entry is not None and entry.mtime == st.st_mtime_ns and entry.size == st.st_size:
+                return entry
+        entry = StaticFile(path, st)
+        if entry.size <= INLINE_MAX:
+            with open(path, "rb") as f:
+                entry.content = f.read()
+            if entry.mime.startswith(COMPRESSIBLE) and entry.size >= MIN_COMPRESS:
+                compressed = gzip.compress(entry.content, compresslevel=9, mtime=0)
+                if len(compressed) < entry.size:
+                    entry.variants["gzip"] = (compressed, None)
+        # Precompressed siblings built ahead of time (app.js.br, app.js.gz) win over ours
+        for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+            try:
+                if os.stat(path + suffix).st_mtime_ns >= entry.mtime:
+                    entry.variants[encoding] = (None, path + suffix)
+            except OSError:
+                pass
+        with self._lock:
+            old = self._files.pop(path, None)
+            if old is not None:
+                self._bytes -= self._footprint(old)
+            if self._bytes + self._footprint(entry) <= CACHE_MAX_BYTES:
+                self._files[path] = entry
+                self._bytes += self._footprint(entry)
+        return entry
+
+    @staticmethod
+    def _footprint(entry):
+        return len(entry.content or b"") + sum(len(v[0] or b"") for v in entry.variants.values())
+
+    def choose_encoding(self, entry, accept_encoding):
+        if not entry.variants:
+            return None
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ("br", "gzip"):
+            if encoding in entry.variants and accepted.get(encoding, 0) > 0:
+                return encoding
+        return None
+
+
+def variant_etag(entry, encoding):
+    # Each encoding is its own representation with its own bytes, so its own strong ETag
+    return entry.etag[:-1] + f'-{encoding}"' if encoding else entry.etag
+
+
+def not_modified(entry, headers, etag=None):
+    # etag: the ETag of the variant being sent (the identity one by default)
+    etag = etag or entry.etag
+    inm = headers.get("If-None-Match")
+    if inm is not None:
+        tags = [t.strip() for t in inm.split(",")]
+        return "*" in tags or etag in tags or ("W/" + etag) in tags
+    ims = headers.get("If-Modified-Since")
+    if ims:
+        try:
+            return int(entry.mtime // 1_000_000_000) <= parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def send_file_range(wfile, connection, path, offset, count):
+    # Stream part of a file to the client, with sendfile() where the socket allows it.
+    # Returns how many bytes went out through sendfile(), i.e. around wfile.
+    sent_direct = 0
+    with open(path, "rb") as f:
+        try:
+            sock_fd = connection.fileno()
+        except (AttributeError, OSError):
+            sock_fd = None
+        if sock_fd is not None and hasattr(os, "sendfile"):
+            wfile.flush()
+            try:
+                while count > 0:
+                    sent = os.sendfile(sock_fd, f.fileno(), offset, count)
+                    if sent == 0:
+                        break
+                    offset += sent
+                    count -= sent
+                    sent_direct += sent
+                return sent_direct
+            except OSError as e:
+                # Unsupported on this socket type: fall through to a plain copy of the rest
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+        f.seek(offset)
+        while count > 0:
+            chunk = f.read(min(count, 64 * 1024))
+            if not chunk:
+                break
+            wfile.write(chunk)
+            count -= len(chunk)
+    return sent_direct
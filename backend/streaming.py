@@ -0,0 +1,130 @@
+import csv
+import io
+import json
+import os
+import zlib
+
+# Streaming response bodies: JSON arrays, NDJSON or CSV written row by row as rows come
+# off a cursor, optionally gzip-compressed and sent with chunked transfer encoding, so the
+# memory a response needs doesn't grow with the size of the table behind it.
+CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 64 * 1024))
+# Buffered bodies smaller than this aren't worth compressing
+GZIP_MIN_SIZE = int(os.environ.get("GZIP_MIN_SIZE", 4096))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+
+_encoder = json.JSONEncoder()
+
+
+def accepts_gzip(accept_encoding):
+    for part in (accept_encoding or "").split(","):
+        pieces = part.strip().split(";")
+        if pieces[0].strip().lower() in ("gzip", "*"):
+            for param in pieces[1:]:
+                key, _, value = param.strip().partition("=")
+                if key == "q":
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+
+def gzip_bytes(body):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def json_array(items):
+    # Yield the JSON encoding of an iterable of dicts in chunks of about CHUNK_SIZE bytes
+    buffer = ["["]
+    size = 1
+    first = True
+    for item in items:
+        piece = _encoder.encode(item)
+        if not first:
+            buffer.append(",")
+            size += 1
+        buffer.append(piece)
+        size += len(piece)
+        first = False
+        if size >= CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer = []
+            size = 0
+    buffer.append("]")
+    yield "".join(buffer).encode()
+
+
+def ndjson_lines(items):
+    # One JSON object per line, in chunks of about CHUNK_SIZE bytes
+    buffer = []
+    size = 0
+    for item in items:
+        piece = _encoder.encode(item)
+        buffer.append(piece)
+        buffer.append("\n")
+        size += len(piece) + 1
+        if size >= CHUNK_SIZE:
+            yield "".join(buffer).encode()
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
+def csv_lines(columns, rows):
+    # A header line, then one line per row (sequences in column order), in chunks
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\r\n")
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        if out.tell() >= CHUNK_SIZE:
+            yield out.getvalue().encode()
+            out.seek(0)
+            out.truncate()
+    if out.tell():
+        yield out.getvalue().encode()
+
+
+class ChunkedWriter:
+    # HTTP/1.1 chunked transfer coding over a file-like socket writer
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+
+    def close(self):
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class RawWriter:
+    # Body delimited by closing the connection (HTTP/1.0 clients)
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write(data)
+
+    def close(self):
+        pass
+
+
+class GzipWriter:
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def write(self, data):
+        self.inner.write(self.compressor.compress(data))
+
+    def close(self):
+        self.inner.write(self.compressor.flush())
+        self.inner.close()
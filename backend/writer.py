@@ -0,0 +1,228 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import db
+import metrics
+import profiler
+
+# All writes from this process go through one thread that owns the only write connection.
+# Request threads queue an operation - a function taking the connection - and wait for its
+# result. The writer takes whatever has queued up (up to MAX_BATCH), runs each operation in
+# its own savepoint inside one BEGIN IMMEDIATE transaction and commits once, so a burst of
+# writes costs one lock acquisition and one WAL sync instead of one each.
+#
+# Operations must not commit or roll back themselves. An exception rolls back only that
+# operation and is raised to its caller; the rest of the batch still commits. Results are
+# handed back only after the commit, so a caller never reports a write that could still be
+# lost. Pre-fork workers each have their own writer; busy_timeout covers the contention
+# between those few connections.
+QUEUE_SIZE = int(os.environ.get("WRITE_QUEUE_SIZE", 256))
+# How long a request waits for room in a full queue before it is turned away with a 503
+QUEUE_TIMEOUT = float(os.environ.get("WRITE_QUEUE_TIMEOUT", 5))
+MAX_BATCH = int(os.environ.get("WRITE_MAX_BATCH", 64))
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class WriterBusy(Exception):
+    pass
+
+
+class _Op:
+    __slots__ = ("fn", "args", "future", "queued_at", "trace")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+        self.trace = None  # the profiler trace of the request waiting for this write
+
+
+class Writer:
+
+    def __init__(self, path, queue_size=QUEUE_SIZE, max_batch=MAX_BATCH):
+        self.path = path
+        self.max_batch = max_batch
+        self.pid = os.getpid()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._batches = 0
+        self._ops = 0
+        self._errors = 0
+        self._failed_commits = 0
+        self._rejected = 0
+        self._batch_max = 0
+        self._histogram = dict.fromkeys(BATCH_BUCKETS, 0)
+        self._commit_time = 0.0
+        self._commit_max = 0.0
+        self._wait_time = 0.0
+        self._wait_max = 0.0
+        self._thread.start()
+
+    def submit(self, fn, *args):
+        # Queue fn(conn, *args); returns a Future with its result once committed
+        return self._put(_Op(fn, args))
+
+    def run(self, fn, *args):
+        op = _Op(fn, args)
+        if profiler.ENABLED:
+            # The caller waits for this one, so its SQL and waits go on the caller's trace
+            op.trace = profiler.current()
+        return self._put(op).result()
+
+    def _put(self, op):
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("Write operations cannot queue further writes")
+        try:
+            self._queue.put(op, timeout=QUEUE_TIMEOUT)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            if metrics.ENABLED:
+                metrics.WRITE_RESULTS.inc("rejected")
+            raise WriterBusy(f"Write queue full ({self._queue.maxsize} pending)")
+        return op.future
+
+    def close(self):
+        # Finish what is queued, then stop the thread
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        conn = db.open_connection(self.path)
+        conn.isolation_level = None  # transactions are managed explicitly below
+        try:
+            while True:
+                op = self._queue.get()
+                if op is None:
+                    return
+                batch = [op]
+                while len(batch) < self.max_batch:
+                    try:
+                        op = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if op is None:
+                        self._queue.put(None)
+                        break
+                    batch.append(op)
+                self._commit(conn, batch)
+        finally:
+            conn.close()
+
+    def _commit(self, conn, batch):
+        started = time.perf_counter()
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            locked = time.perf_counter()
+            for op in batch:
+                conn.execute("SAVEPOINT op")
+                try:
+                    if op.trace is None:
+                        result = op.fn(conn, *op.args)
+                    else:
+                        result = profiler.call(op.trace, op.fn, conn, *op.args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op")
+                    conn.execute("RELEASE op")
+                    results.append((op, None, e))
+                else:
+                    conn.execute("RELEASE op")
+                    results.append((op, result, None))
+            conn.execute("COMMIT")
+        except Exception as e:
+            # The transaction itself failed (lock timeout, disk full, ...): nothing committed
+            print(f"Write batch of {len(batch)} failed: {e}")
+            if conn.in_transaction:
+                try:
+                    conn.execute("ROLLBACK")
+                except sqlite3.Error:
+                    pass
+            with self._lock:
+                self._failed_commits += 1
+                self._errors += len(batch)
+            if metrics.ENABLED:
+                metrics.WRITE_RESULTS.inc("failed_commit", amount=len(batch))
+            for op in batch:
+                op.future.set_exception(e)
+            return
+        elapsed = time.perf_counter() - started
+        if metrics.ENABLED:
+            metrics.LOCK_WAIT.observe(locked - started)
+            metrics.COMMIT_TIME.observe(elapsed)
+            metrics.BATCH_SIZE.observe(len(batch))
+            for op, _, error in results:
+                metrics.QUEUE_WAIT.observe(started - op.queued_at)
+                metrics.WRITE_RESULTS.inc("ok" if error is None else "error")
+        for op, _, _ in results:
+            if op.trace is not None:
+                profiler.add_waits(op.trace, write_queue=started - op.queued_at, write_lock=locked - started,
+                                   write_batch=elapsed - (locked - started))
+        with self._lock:
+            self._batches += 1
+            self._ops += len(batch)
+            self._batch_max = max(self._batch_max, len(batch))
+            self._histogram[next((b for b in BATCH_BUCKETS if len(batch) <= b), BATCH_BUCKETS[-1])] += 1
+            self._commit_time += elapsed
+            self._commit_max = max(self._commit_max, elapsed)
+            for op, _, error in results:
+                waited = started - op.queued_at
+                self._wait_time += waited
+                self._wait_max = max(self._wait_max, waited)
+                if error is not None:
+                    self._errors += 1
+        for op, result, error in results:
+            if error is not None:
+                op.future.set_exception(error)
+            else:
+                op.future.set_result(result)
+
+    def stats(self):
+        with self._lock:
+            ops = self._ops
+            return {
+                "queue_size": self._queue.maxsize,
+                "queued": self._queue.qsize(),
+                "batches": self._batches,
+                "ops": ops,
+                "errors": self._errors,
+                "failed_commits": self._failed_commits,
+                "rejected": self._rejected,
+                "batch_avg": round(ops / self._batches, 2) if self._batches else 0.0,
+                "batch_max": self._batch_max,
+                "batch_sizes": {f"<={b}": n for b, n in self._histogram.items()},
+                "commit_avg_ms": round(self._commit_time / self._batches * 1000, 3) if self._batches else 0.0,
+                "commit_max_ms": round(self._commit_max * 1000, 3),
+                "queue_wait_avg_ms": round(self._wait_time / ops * 1000, 3) if ops else 0.0,
+                "queue_wait_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    writer = _writer
+    # The writer thread doesn't survive fork(); each pre-fork worker starts its own
+    if writer is None or writer.pid != os.getpid() or writer.path != db.database_path():
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid() or _writer.path != db.database_path():
+                _writer = Writer(db.database_path())
+            writer = _writer
+    return writer
+
+
+def run(fn, *args):
+    return get_writer().run(fn, *args)
+
+
+def stats():
+    return get_writer().stats()
@@ -0,0 +1,94 @@
+"""Time GET /listings/ pages from the in-memory catalogue against the SQL path.
+
+Builds throwaway databases of synthetic listings at each scale (facet_bench's
+generator, real schema and triggers), loads the catalogue and reports its size,
+then times each feed query both ways: the SQL path is listings.page_query (plus
+the COUNT for ?count=1), the catalogue path is Catalogue.lookup plus fetching the
+page's rows by id. Every query's ids are checked to match between the two.
+
+    python bench/catalogue_bench.py --scales 10000,100000,1000000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+import catalogue  # noqa: E402
+import listings  # noqa: E402
+from facet_bench import best_of, build  # noqa: E402
+
+QUERIES = [
+    ("newest", {}),
+    ("newest, category", {'category': ['Phone']}),
+    ("newest, category+condition", {'category': ['Laptop'], 'condition': ['broken']}),
+    ("newest, price range", {'min_price': ['120'], 'max_price': ['480']}),
+    ("newest, narrow", {'category': ['Camera'], 'condition': ['new'], 'min_price': ['400'], 'max_price': ['450']}),
+    ("price_low", {'sort': ['price_low']}),
+    ("price_high, price range", {'sort': ['price_high'], 'min_price': ['120'], 'max_price': ['480']}),
+    ("newest, offset 3000", {'offset': ['3000']}),
+    ("newest, page 2 (cursor)", {'cursor': None}),
+    ("newest, category, count", {'category': ['Phone'], 'count': ['1']}),
+]
+
+
+def sql_page(conn, qs):
+    query, params, limit, sort = listings.page_query(qs)
+    rows = conn.execute(query, params).fetchall()
+    total = None
+    if listings.wants_total(qs):
+        count_sql, count_params = listings.count_query(qs)
+        total = conn.execute(count_sql, count_params).fetchone()[0]
+    return [row['id'] for row in rows], total
+
+
+def catalogue_page(conn, index, qs):
+    _, _, limit, sort = listings.page_query(qs)
+    ids, total = index.lookup(conn, qs, limit, sort, listings.wants_total(qs))
+    return [row['id'] for row in catalogue.rows_by_id(conn, ids)], total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    for n in (int(x) for x in args.scales.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            conn, insert_s = build(os.path.join(tmp, "bench.db"), n)
+            conn.row_factory = sqlite3.Row
+            index = catalogue.Catalogue()
+            start = time.perf_counter()
+            index.load(conn)
+            load_s = time.perf_counter() - start
+            # Again under tracemalloc (which slows it down) for the memory peak
+            tracemalloc.start()
+            catalogue.Catalogue().load(conn)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            stats = index.stats()
+            print(f"\n{n:,} listings: insert {n / insert_s:,.0f} rows/s with triggers; catalogue load "
+                  f"{load_s * 1000:,.0f} ms, {stats['bytes'] / 1e6:.2f} MB of columns "
+                  f"({stats['bytes'] / n * 100_000 / 1e6:.2f} MB per 100k listings), "
+                  f"{peak / 1e6:.1f} MB peak while loading, {stats['groups']} groups")
+            print(f"{'query':<28} {'SQL ms':>9} {'catalogue ms':>13} {'speedup':>8}")
+            first = sql_page(conn, {})[0]
+            for name, qs in QUERIES:
+                if 'cursor' in qs:
+                    row = conn.execute("SELECT created_at, id FROM listings WHERE id=?", (first[59],)).fetchone()
+                    qs = {'cursor': [listings.encode_cursor('newest', row)]}
+                expected = sql_page(conn, qs)
+                if catalogue_page(conn, index, qs) != expected:
+                    sys.exit(f"Mismatch for {name}")
+                sql_ms = best_of(lambda: sql_page(conn, qs), args.repeat)
+                cat_ms = best_of(lambda: catalogue_page(conn, index, qs), args.repeat)
+                print(f"{name:<28} {sql_ms:>9.2f} {cat_ms:>13.2f} {sql_ms / cat_ms:>7.1f}x")
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Time facet counts from the listing_facets cube against GROUP BY over listings.
+
+Builds throwaway databases of synthetic listings at each scale, with the real
+schema (so the facet triggers run on every insert), and times
+GET /listings/facets for a few filter sets both ways. The GROUP BY side is what
+the endpoint would cost without the cube: one grouped query per facet with the
+other filters applied, plus the total.
+
+    python bench/facet_bench.py --scales 10000,100000,1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+import facets  # noqa: E402
+import listings  # noqa: E402
+import migrations  # noqa: E402
+
+BRANDS = ["Samsung", "Apple", "Xiaomi", "OnePlus", "Dell", "HP", "Lenovo", "Asus", "Sony", "LG", "Nokia", "Realme"]
+CATEGORIES = ["Phone", "Laptop", "Tablet", "TV", "Audio", "Camera", "Console", "Accessories"]
+CONDITIONS = ["broken", "for_parts", "used", "new"]
+FILTERS = [
+    ("no filters", {}),
+    ("category", {'category': ['Phone']}),
+    ("category+condition", {'category': ['Laptop'], 'condition': ['broken']}),
+    ("price on edges", {'min_price': ['100'], 'max_price': ['500']}),
+    ("price off edges", {'min_price': ['120'], 'max_price': ['480']}),
+    ("everything", {'category': ['Phone'], 'condition': ['used'], 'min_price': ['60'], 'max_price': ['333']}),
+    ("search", {'q': ['samsung']}),
+]
+
+
+def build(path, n, seed=1):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    migrations.migrate(conn)
+
+    def rows():
+        for i in range(n):
+            brand, category = rng.choice(BRANDS), rng.choice(CATEGORIES)
+            seller_price = round(rng.lognormvariate(4.4, 1.0) + 5, 2)
+            yield (rng.randint(1, 1000), f"{brand} {category}", category, brand, f"M{rng.randint(1, 999)}",
+                   rng.choice(CONDITIONS), seller_price, listings.display_price(seller_price), "City",
+                   "Sold as is", rng.choice(["active"] * 9 + ["sold"]), "", "[]")
+
+    start = time.perf_counter()
+    conn.executemany('''INSERT INTO listings (seller_id, title, category, brand, model, condition, seller_price,
+                        price, location, description, status, working_parts, photos)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows())
+    conn.commit()
+    insert_s = time.perf_counter() - start
+    listings.setup_fts(conn)
+    conn.commit()
+    conn.execute("ANALYZE")
+    return conn, insert_s
+
+
+def group_by(conn, qs):
+    # The same answer as facets.counts(), the expensive way
+    def grouped(drop, expr):
+        source, where, params = listings.build_filters({k: v for k, v in qs.items() if k not in drop})
+        return conn.execute(f"SELECT {expr}, COUNT(*) FROM {source} WHERE {' AND '.join(where)} GROUP BY 1",
+                            params).fetchall()
+    sql, params = listings.count_query(qs)
+    conn.execute(sql, params).fetchone()
+    grouped(('category',), "l.category")
+    grouped(('condition',), "l.condition")
+    grouped(('min_price', 'max_price'), facets.bucket_sql("l.price"))
+
+
+def best_of(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'listings':>9} {'filters':<20} {'GROUP BY ms':>12} {'facets ms':>10} {'speedup':>8}  source")
+    for n in (int(x) for x in args.scales.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            conn, insert_s = build(os.path.join(tmp, "bench.db"), n)
+            listings.FTS_ENABLED = True
+            for name, qs in FILTERS:
+                naive_ms = best_of(lambda: group_by(conn, qs), args.repeat)
+                cube_ms = best_of(lambda: facets.counts(conn, qs), args.repeat)
+                source = facets.counts(conn, qs)["source"]
+                print(f"{n:>9} {name:<20} {naive_ms:>12.2f} {cube_ms:>10.2f} {naive_ms / cube_ms:>7.1f}x  {source}")
+            cube_rows = conn.execute("SELECT COUNT(*) FROM listing_facets").fetchone()[0]
+            print(f"{n:>9} insert with facet triggers: {n / insert_s:,.0f} rows/s, {cube_rows} cube rows")
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
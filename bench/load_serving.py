@@ -0,0 +1,123 @@
+"""Load test for the serving modes in backend/serving.py.
+
+Starts backend/simple_server.py against a throwaway database for each
+(mode, workers) combination, hammers it from several client processes and
+prints requests/second, so throughput can be compared as workers are added.
+
+    python bench/load_serving.py --modes single,thread,prefork,async --workers 1,2,4
+
+--keep-alive reuses one connection per client; --idle opens that many extra
+connections that never send a request, to show what parked keep-alive
+clients cost each mode.
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER = os.path.join(ROOT, "backend", "simple_server.py")
+SEED_DB = os.path.join(ROOT, "backend", "marketplace.db")
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def client(args):
+    port, path, duration, think_ms, keep_alive = args
+    done = errors = 0
+    conn = None
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            resp.read()
+            if not keep_alive or resp.will_close:
+                conn.close()
+                conn = None
+            if resp.status == 200:
+                done += 1
+            else:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn = None
+        if think_ms:
+            time.sleep(think_ms / 1000)
+    return done, errors
+
+
+def run_case(mode, workers, threads, port, clients, duration, path, think_ms, keep_alive, idle):
+    tmp = tempfile.mkdtemp(prefix="electro-bench-")
+    db = os.path.join(tmp, "marketplace.db")
+    if os.path.exists(SEED_DB):
+        shutil.copy(SEED_DB, db)
+    env = dict(os.environ, PORT=str(port), DB_FILE=db, SERVER_MODE=mode,
+               WORKERS=str(workers), THREADS=str(threads), ASYNC_THREADS=str(threads))
+    proc = subprocess.Popen([sys.executable, SERVER], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    parked = []
+    try:
+        if not wait_for_port(port):
+            raise RuntimeError(f"server did not start for mode={mode}")
+        for _ in range(idle):
+            parked.append(socket.create_connection(("127.0.0.1", port)))
+        with multiprocessing.Pool(clients) as pool:
+            start = time.monotonic()
+            results = pool.map(client, [(port, path, duration, think_ms, keep_alive)] * clients)
+            elapsed = time.monotonic() - start
+    finally:
+        for sock in parked:
+            sock.close()
+        proc.terminate()
+        proc.wait(timeout=30)
+        shutil.rmtree(tmp, ignore_errors=True)
+    done = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    return done / elapsed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", default="single,thread,prefork,async")
+    parser.add_argument("--workers", default="1,2,4", help="process counts tried in prefork mode")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--path", default="/listings/")
+    parser.add_argument("--think-ms", type=float, default=0,
+                        help="per-request client delay; >0 simulates slow clients")
+    parser.add_argument("--keep-alive", action="store_true", help="reuse one connection per client")
+    parser.add_argument("--idle", type=int, default=0, help="extra connections held open without requests")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'workers':>7} {'threads':>7} {'req/s':>10} {'errors':>7}")
+    for mode in args.modes.split(","):
+        worker_counts = [int(w) for w in args.workers.split(",")] if mode == "prefork" else [1]
+        for workers in worker_counts:
+            threads = 1 if mode == "single" else args.threads
+            rps, errors = run_case(mode, workers, threads, args.port, args.clients,
+                                   args.duration, args.path, args.think_ms, args.keep_alive, args.idle)
+            print(f"{mode:<8} {workers:>7} {threads:>7} {rps:>10.1f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""Reproducible end-to-end benchmark for the marketplace server.
+
+    python -m bench.marketbench generate --scale 1 --out /tmp/mb
+    python -m bench.marketbench run --data /tmp/mb --duration 30 --json run.json
+    python -m bench.marketbench compare before.json after.json
+    python -m bench.marketbench contend --data /tmp/mb --clients 8
+    python -m bench.marketbench flood --data /tmp/mb --attackers 8
+
+generate  builds a seeded synthetic marketplace (users, listings with photo
+          blobs, buy requests, orders) - the same seed always gives the same data
+run       starts backend/simple_server.py on a copy of that data and replays a
+          weighted mix of browsing, seller dashboard and purchase flows from
+          several client processes, then reports throughput and p50/p95/p99
+          latency per endpoint
+compare   puts two JSON reports side by side
+contend   races client processes to accept and check out the same listings
+          and checks that each one sold exactly once (exit status 1 if not)
+flood     browse latency alone and then while other processes flood /auth/login
+"""
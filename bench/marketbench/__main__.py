@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import sys
+
+from . import __doc__ as DOC
+from . import contention, datagen, driver, flood, report
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.marketbench", description=DOC.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=DOC)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    gen = commands.add_parser("generate", help="build a synthetic dataset")
+    gen.add_argument("--out", required=True, help="directory for marketplace.db, photos/ and manifest.json")
+    gen.add_argument("--scale", type=float, default=1.0,
+                     help=f"1 = {datagen.USERS} users, {datagen.LISTINGS} listings, {datagen.REQUESTS} requests")
+    gen.add_argument("--seed", type=int, default=1)
+    gen.add_argument("--users", type=int)
+    gen.add_argument("--listings", type=int)
+    gen.add_argument("--requests", type=int)
+    gen.add_argument("--photos", type=int, help="distinct photos shared by the listings")
+    gen.add_argument("--photo-kb", type=int, default=180, help="typical photo size")
+
+    run = commands.add_parser("run", help="start the server on a copy of a dataset and load it")
+    run.add_argument("--data", required=True, help="directory written by generate")
+    run.add_argument("--clients", type=int, default=8, help="client processes")
+    run.add_argument("--duration", type=float, default=20, help="measured seconds")
+    run.add_argument("--warmup", type=float, default=3, help="seconds run but not measured")
+    run.add_argument("--mix", default=driver.DEFAULT_MIX, help="journey weights, e.g. browse=80,purchase=20")
+    run.add_argument("--seed", type=int, default=1)
+    run.add_argument("--photo-kb", type=int, default=180, help="typical size of uploaded photos")
+    run.add_argument("--port", type=int, default=8766)
+    run.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                     help="server environment, e.g. --env SERVER_MODE=async (repeatable)")
+    run.add_argument("--json", help="also write the report here")
+
+    contend = commands.add_parser("contend", help="race clients to accept and check out the same listings",
+                                  description=contention.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    contend.add_argument("--data", required=True, help="directory written by generate")
+    contend.add_argument("--clients", type=int, default=8, help="client processes")
+    contend.add_argument("--listings", type=int, default=200, help="listings to fight over")
+    contend.add_argument("--bidders", type=int, default=8, help="buy requests per listing")
+    contend.add_argument("--seed", type=int, default=1)
+    contend.add_argument("--port", type=int, default=8766)
+    contend.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                         help="server environment, e.g. --env SERVER_MODE=prefork (repeatable)")
+    contend.add_argument("--json", help="also write the report here")
+
+    fl = commands.add_parser("flood", help="browse latency while attackers flood /auth/login",
+                             description=flood.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    fl.add_argument("--data", required=True, help="directory written by generate")
+    fl.add_argument("--clients", type=int, default=4, help="browsing client processes")
+    fl.add_argument("--attackers", type=int, default=8, help="login flooding processes")
+    fl.add_argument("--duration", type=float, default=10, help="measured seconds per phase")
+    fl.add_argument("--warmup", type=float, default=2, help="seconds run but not measured")
+    fl.add_argument("--seed", type=int, default=1)
+    fl.add_argument("--port", type=int, default=8766)
+    fl.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                    help="server environment, e.g. --env PASSWORD_HASH_THREADS=2 (repeatable)")
+    fl.add_argument("--json", help="also write both reports here")
+
+    cmp = commands.add_parser("compare", help="compare two JSON reports")
+    cmp.add_argument("before")
+    cmp.add_argument("after")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        manifest = datagen.generate(args.out, args.scale, args.seed, args.photo_kb, args.users, args.listings,
+                                    args.requests, args.photos)
+        print(json.dumps(manifest, indent=2))
+    elif args.command == "run":
+        if not os.path.exists(os.path.join(args.data, "marketplace.db")):
+            sys.exit(f"{args.data} has no marketplace.db; run generate first")
+        server_env = dict(item.split("=", 1) for item in args.env)
+        samples, statuses, elapsed = driver.run(args.data, args.port, args.clients, args.duration, args.warmup,
+                                                args.mix, args.seed, args.photo_kb, server_env)
+        manifest_path = os.path.join(args.data, "manifest.json")
+        dataset = report.load(manifest_path) if os.path.exists(manifest_path) else {}
+        result = report.build(samples, statuses, elapsed, {
+            "clients": args.clients, "duration_s": args.duration, "warmup_s": args.warmup, "mix": args.mix,
+            "seed": args.seed, "server_env": server_env, "dataset": dataset})
+        report.print_table(result)
+        if args.json:
+            report.save(result, args.json)
+    elif args.command == "contend":
+        if not os.path.exists(os.path.join(args.data, "marketplace.db")):
+            sys.exit(f"{args.data} has no marketplace.db; run generate first")
+        result, problems = contention.run(args.data, args.port, args.clients, args.listings, args.bidders,
+                                          args.seed, dict(item.split("=", 1) for item in args.env))
+        report.print_table(result)
+        if args.json:
+            report.save(result, args.json)
+        for problem in problems[:20]:
+            print(problem)
+        listings = result["meta"]["listings"]
+        print(f"{listings - len(problems)}/{listings} checks passed" if problems else
+              f"OK: each of {listings} listings sold exactly once, with one order")
+        sys.exit(1 if problems else 0)
+    elif args.command == "flood":
+        if not os.path.exists(os.path.join(args.data, "marketplace.db")):
+            sys.exit(f"{args.data} has no marketplace.db; run generate first")
+        reports = flood.run(args.data, args.port, args.clients, args.attackers, args.duration, args.warmup,
+                            args.seed, dict(item.split("=", 1) for item in args.env))
+        for phase, result in reports.items():
+            print(f"\n{phase}")
+            report.print_table(result)
+        print()
+        flood.summary(reports)
+        if args.json:
+            report.save(reports, args.json)
+    else:
+        report.compare(report.load(args.before), report.load(args.after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Contention test for accept and checkout: many processes race to sell the same listings.
+
+Picks --listings active listings and has --bidders buyers request each one.
+Then every client process walks all of those requests in its own random
+order, with the same start time for all. For each request it accepts it as the
+seller and, if that succeeds, checks it out as the buyer. Processes therefore
+keep colliding on one listing, on one request and on one checkout.
+
+Afterwards the database must show, for every listing:
+
+    exactly one accepted/completed request, no pending ones, exactly one order
+
+Sales rollups and facet counts must also still match their base tables.
+"""
+import multiprocessing
+import random
+import sqlite3
+import time
+
+from . import driver, report
+import facets  # noqa: E402  (backend/ is put on sys.path by datagen)
+import rollups  # noqa: E402
+
+ACCEPT = "PUT /requests/{id}/accept"
+CHECKOUT = "POST /orders/"
+
+
+def shipping(buyer):
+    return {"shipping_name": f"User {buyer}", "shipping_address": "1 Bench Street", "shipping_phone": "9000000000",
+            "shipping_email": f"user{buyer}@bench.test", "shipping_pincode": "560001", "payment_method": "upi"}
+
+
+def place_requests(args):
+    port, bids = args
+    client = driver.Client(port, None, 0, 0, 0)
+    placed = []
+    for listing_id, seller, buyer in bids:
+        token = client.login(buyer)
+        status, body, _ = client.request("POST /requests/", "POST", "/requests/", {"listing_id": listing_id},
+                                         token=token)
+        if status == 200:
+            placed.append((listing_id, seller, buyer, body["id"]))
+    return placed
+
+
+_barrier = None
+
+
+def _init(barrier):
+    global _barrier
+    _barrier = barrier
+
+
+def race(args):
+    port, placed, seed = args
+    client = driver.Client(port, None, seed, float("inf"), 0)
+    order = list(placed)
+    client.rng.shuffle(order)
+    # Log everyone in before the start line so the race is only accepts and checkouts
+    for _, seller, buyer, _ in order:
+        client.login(seller)
+        client.login(buyer)
+    client.record_after = 0
+    _barrier.wait()
+    started = time.perf_counter()
+    for _, seller, buyer, request_id in order:
+        status, body, _ = client.request(ACCEPT, "PUT", f"/requests/{request_id}/accept",
+                                         token=client.login(seller))
+        if status == 200 and body["status"] in ("accepted", "completed"):
+            client.request(CHECKOUT, "POST", "/orders/", dict(shipping(buyer), request_id=request_id),
+                           token=client.login(buyer))
+    return client.samples, client.statuses, time.perf_counter() - started
+
+
+def check(db_path, listing_ids):
+    # Returns a list of problems; empty when every listing has exactly one winner
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        marks = ", ".join("?" * len(listing_ids))
+        rows = conn.execute(f'''
+            SELECT l.id, l.status,
+                   (SELECT COUNT(*) FROM buy_requests br WHERE br.listing_id = l.id
+                    AND br.status IN ('accepted', 'completed')) AS winners,
+                   (SELECT COUNT(*) FROM buy_requests br WHERE br.listing_id = l.id AND br.status = 'pending') AS pending,
+                   (SELECT COUNT(*) FROM orders o WHERE o.listing_id = l.id) AS orders
+            FROM listings l WHERE l.id IN ({marks})''', listing_ids).fetchall()
+        problems = [f"listing {r['id']}: status {r['status']}, {r['winners']} winners, {r['pending']} pending, "
+                    f"{r['orders']} orders" for r in rows
+                    if (r['status'], r['winners'], r['pending'], r['orders']) != ('sold', 1, 0, 1)]
+        problems += [f"rollup {dim}={key!r} differs" for dim, key, _, _ in rollups.verify(conn)]
+        problems += [f"facet {key!r} differs" for key, _, _ in facets.verify(conn)]
+        return problems
+    finally:
+        conn.close()
+
+
+def run(data_dir, port=8766, clients=8, listings=200, bidders=8, seed=1, server_env=None):
+    # Returns (report, problems)
+    rng = random.Random(seed)
+    with driver.serve(data_dir, port, server_env) as (db_path, data):
+        targets = rng.sample(data["active"], min(listings, len(data["active"])))
+        bids = [(listing_id, seller, buyer) for listing_id, seller in targets
+                for buyer in rng.sample(data["buyers"], min(bidders, len(data["buyers"])))]
+        with multiprocessing.Pool(clients) as pool:
+            placed = [p for chunk in pool.map(place_requests, [(port, bids[i::clients]) for i in range(clients)])
+                      for p in chunk]
+
+        barrier = multiprocessing.Barrier(clients)
+        with multiprocessing.Pool(clients, initializer=_init, initargs=(barrier,)) as pool:
+            results = pool.map(race, [(port, placed, seed * 1000 + i) for i in range(clients)])
+        problems = check(db_path, [listing_id for listing_id, _ in targets])
+
+    samples, statuses = driver.merge((r[0], r[1]) for r in results)
+    elapsed = max(r[2] for r in results)
+    result = report.build(samples, statuses, elapsed, {
+        "clients": clients, "listings": len(targets), "bidders": bidders, "requests": len(placed),
+        "seed": seed, "server_env": server_env or {}, "problems": len(problems)})
+    return result, problems
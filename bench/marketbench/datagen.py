@@ -0,0 +1,192 @@
+"""Seeded synthetic marketplace data.
+
+Everything is drawn from one random.Random(seed), and dates count back from a
+fixed day rather than from now, so a (seed, scale) pair always produces the
+same database. Output directory layout:
+
+    marketplace.db   schema from backend/migrations.py, FTS index and rollups built
+    photos/          content-addressed photo store (PHOTO_DIR for the server)
+    manifest.json    seed, row counts and the password every generated user has
+"""
+import datetime
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+
+BACKEND = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "backend")
+sys.path.insert(0, BACKEND)
+import listings  # noqa: E402
+import migrations  # noqa: E402
+import passwords  # noqa: E402
+import photos  # noqa: E402
+import rollups  # noqa: E402
+
+PASSWORD = "bench-password"
+ADMIN_EMAIL = "admin@bench.test"
+BASE_DAY = datetime.datetime(2025, 6, 1)
+HISTORY_DAYS = 180
+
+# Per unit of --scale
+USERS = 1000
+LISTINGS = 10000
+REQUESTS = 20000
+PHOTOS = 300
+
+SELLER_SHARE = 0.3
+CATEGORIES = ["Phone", "Laptop", "Tablet", "TV", "Audio", "Camera", "Console", "Accessories"]
+CATEGORY_WEIGHTS = [30, 20, 10, 8, 10, 7, 8, 7]
+CONDITIONS = ["broken", "for_parts", "used", "new"]
+CONDITION_WEIGHTS = [45, 30, 20, 5]
+BRANDS = ["Samsung", "Apple", "Xiaomi", "OnePlus", "Dell", "HP", "Lenovo", "Asus", "Sony", "LG", "Nokia", "Realme"]
+CITIES = ["Mumbai", "Delhi", "Bengaluru", "Chennai", "Kolkata", "Pune", "Hyderabad", "Jaipur", "Lucknow", "Kochi"]
+FAULTS = ("cracked screen", "dead battery", "no power", "water damage", "boot loop", "broken hinge",
+          "faulty charging port", "no display", "dead pixels", "overheating", "speaker not working",
+          "touch not responding", "camera blurry", "keyboard missing keys", "fan noise")
+PARTS = ("battery", "screen", "motherboard", "camera", "speaker", "charger", "keyboard", "housing", "ram", "storage")
+# Request outcomes; accepted and completed requests mark their listing sold, completed
+# ones also have an order
+REQUEST_STATUSES = ["pending", "rejected", "accepted", "completed"]
+REQUEST_WEIGHTS = [50, 20, 10, 20]
+
+
+def timestamp(rng, days=HISTORY_DAYS, after=None):
+    start = after or BASE_DAY - datetime.timedelta(days=days)
+    span = (BASE_DAY - start).total_seconds()
+    return start + datetime.timedelta(seconds=rng.random() * span)
+
+
+def fmt(moment):
+    return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def fake_jpeg(rng, size):
+    # JPEG markers around incompressible bytes: sniffs as image/jpeg and has the size
+    # and entropy of a real phone photo, without needing an image library
+    header = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    return header + rng.randbytes(max(0, size - len(header) - 2)) + b"\xff\xd9"
+
+
+def photo_size(rng, mean_kb):
+    # Log-normal around mean_kb: most photos near it, a few several times larger
+    return int(min(photos.MAX_PHOTO_BYTES, rng.lognormvariate(math.log(mean_kb * 1024) - 0.18, 0.6)))
+
+
+def generate(out, scale=1.0, seed=1, photo_kb=180, users=None, listings_count=None, requests=None, photo_count=None):
+    n_users = users or max(10, int(USERS * scale))
+    n_listings = listings_count or max(10, int(LISTINGS * scale))
+    n_requests = requests if requests is not None else int(REQUESTS * scale)
+    n_photos = photo_count or max(5, int(PHOTOS * min(scale, 1)))
+    rng = random.Random(seed)
+    started = time.perf_counter()
+
+    os.makedirs(out, exist_ok=True)
+    path = os.path.join(out, "marketplace.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    photos.PHOTO_DIR = os.path.join(out, "photos")
+
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    migrations.migrate(conn)
+
+    # Photos: a shared pool, since sellers reuse stock shots and the store dedupes
+    pool = []
+    for _ in range(n_photos):
+        data = fake_jpeg(rng, photo_size(rng, photo_kb))
+        thumb = fake_jpeg(rng, max(4096, len(data) // 12))
+        pool.append(photos.photo_url(photos.store(data, thumb)))
+    photo_weights = [1 / (i + 1) ** 0.7 for i in range(len(pool))]
+
+    conn.execute("BEGIN")
+    # One salted hash shared by every user: fine for a benchmark, and a KDF per user would
+    # make generating a large dataset take minutes
+    hashed = passwords.hash_password(PASSWORD)
+    user_rows = [(1, "Bench Admin", ADMIN_EMAIL, hashed, "admin", "HQ", "0000000000")]
+    sellers, buyers = [], []
+    for uid in range(2, n_users + 1):
+        role = "seller" if rng.random() < SELLER_SHARE else "buyer"
+        (sellers if role == "seller" else buyers).append(uid)
+        user_rows.append((uid, f"User {uid}", f"user{uid}@bench.test", hashed, role, rng.choice(CITIES),
+                          f"9{rng.randrange(10 ** 9):09d}"))
+    if not sellers:
+        sellers.append(buyers.pop())
+    conn.executemany("INSERT INTO users (id, name, email, password_hash, role, location, phone) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     user_rows)
+
+    # A few sellers list a lot, most list a little
+    seller_weights = [1 / (i + 1) ** 0.8 for i in range(len(sellers))]
+    listing_rows = []
+    created = {}
+    for lid in range(1, n_listings + 1):
+        brand = rng.choice(BRANDS)
+        category = rng.choices(CATEGORIES, CATEGORY_WEIGHTS)[0]
+        model = f"{brand[:2].upper()}{rng.randint(1, 99)}"
+        faults = rng.sample(FAULTS, rng.randint(1, 3))
+        seller_price = round(rng.lognormvariate(math.log(80), 1.0) + 5, 2)
+        at = timestamp(rng)
+        created[lid] = at
+        listing_rows.append((
+            lid, rng.choices(sellers, seller_weights)[0], f"{brand} {model} {category} - {faults[0]}",
+            category, brand, model, rng.choices(CONDITIONS, CONDITION_WEIGHTS)[0], seller_price,
+            listings.display_price(seller_price), rng.choice(CITIES),
+            f"{brand} {model} with {', '.join(faults)}. " + rng.choice((
+                "Sold as is.", "No returns.", "Powers on sometimes.", "Original box included.",
+                "Good for parts or repair.")),
+            ", ".join(rng.sample(PARTS, rng.randint(0, 4))),
+            json.dumps(rng.choices(pool, photo_weights, k=rng.randint(1, 4))),
+            "active", fmt(at)))
+    conn.executemany('''INSERT INTO listings (id, seller_id, title, category, brand, model, condition, seller_price, price,
+                        location, description, working_parts, photos, status, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', listing_rows)
+    seller_of = {row[0]: row[1] for row in listing_rows}
+
+    request_rows, order_rows, sold = [], [], set()
+    buyers = buyers or sellers
+    for rid in range(1, n_requests + 1):
+        lid = rng.randint(1, n_listings)
+        buyer = rng.choice(buyers)
+        status = rng.choices(REQUEST_STATUSES, REQUEST_WEIGHTS)[0]
+        if lid in sold and status in ("accepted", "completed"):
+            status = "rejected"
+        at = timestamp(rng, after=created[lid])
+        updated = timestamp(rng, after=at) if status != "pending" else at
+        request_rows.append((rid, lid, buyer, seller_of[lid], status, fmt(at), fmt(updated)))
+        if status in ("accepted", "completed"):
+            sold.add(lid)
+        if status == "completed":
+            order_rows.append((len(order_rows) + 1, rid, lid, buyer, seller_of[lid], f"User {buyer}",
+                               f"{rng.randint(1, 999)} Main Road, {rng.choice(CITIES)}", f"9{rng.randrange(10 ** 9):09d}",
+                               f"user{buyer}@bench.test", f"{rng.randint(110000, 859999)}",
+                               rng.choice(("card", "upi", "cod")), fmt(updated)))
+    conn.executemany('''INSERT INTO buy_requests (id, listing_id, buyer_id, seller_id, status, created_at, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)''', request_rows)
+    conn.executemany('''INSERT INTO orders (id, request_id, listing_id, buyer_id, seller_id, shipping_name, shipping_address,
+                        shipping_phone, shipping_email, shipping_pincode, payment_method, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', order_rows)
+    conn.executemany("UPDATE listings SET status='sold' WHERE id=?", [(lid,) for lid in sorted(sold)])
+    rollups.rebuild(conn)
+    conn.commit()
+
+    listings.setup_fts(conn)  # created after the bulk insert, so it is built in one pass
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+    manifest = {
+        "seed": seed, "scale": scale, "password": PASSWORD, "admin": ADMIN_EMAIL,
+        "users": n_users, "sellers": len(sellers), "buyers": len(buyers), "listings": n_listings,
+        "sold": len(sold), "requests": n_requests, "orders": len(order_rows), "photos": n_photos,
+        "photo_bytes": sum(os.path.getsize(photos.blob_path(u[len(photos.URL_PREFIX):])) for u in pool),
+        "generated_in_s": round(time.perf_counter() - started, 2),
+    }
+    with open(os.path.join(out, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
@@ -0,0 +1,285 @@
+"""Load driver: replays a weighted mix of user journeys against a local server.
+
+Journeys (--mix names):
+
+    browse     anonymous: feed pages, search, filters, next-page cursors, thumbnails
+    dashboard  a seller logs in and loads their dashboard and incoming requests
+    purchase   buyer requests a listing, seller accepts, buyer checks out
+    sell       a seller posts a listing with a photo upload
+
+Each client process keeps one keep-alive connection and its own seeded RNG, and
+times every request under a stable endpoint name. Samples from the warm-up
+period are dropped.
+"""
+import base64
+import contextlib
+import gzip
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote, urlencode
+
+from . import datagen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SERVER = os.path.join(ROOT, "backend", "simple_server.py")
+DEFAULT_MIX = "browse=70,dashboard=15,purchase=10,sell=5"
+SEARCH_TERMS = [b.lower() for b in datagen.BRANDS] + ["screen", "battery", "water damage", "boot loop",
+                                                      "charging", "no display", "hinge", "cracked"]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in JOURNEYS:
+            raise ValueError(f"unknown journey {name!r}; choose from {', '.join(JOURNEYS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class Client:
+
+    def __init__(self, port, data, seed, record_after, photo_upload):
+        self.port = port
+        self.data = data
+        self.rng = random.Random(seed)
+        self.record_after = record_after
+        self.photo_upload = photo_upload
+        self.conn = None
+        self.tokens = {}
+        self.samples = {}   # endpoint -> [latency ms]
+        self.statuses = {}  # endpoint -> {status: count}
+
+    def request(self, name, method, path, body=None, token=None):
+        headers = {"Accept-Encoding": "gzip"}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            self.conn.request(method, path, body=payload, headers=headers)
+            resp = self.conn.getresponse()
+            data = resp.read()
+            status = resp.status
+            if resp.will_close:
+                self.conn.close()
+                self.conn = None
+        except (OSError, http.client.HTTPException):
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            resp, data, status = None, b"", "error"
+        elapsed = (time.perf_counter() - start) * 1000
+        if time.monotonic() >= self.record_after:
+            self.samples.setdefault(name, []).append(elapsed)
+            counts = self.statuses.setdefault(name, {})
+            counts[status] = counts.get(status, 0) + 1
+        if resp is None or status >= 400 or not data:
+            return status, None, resp
+        if resp.getheader("Content-Type", "").startswith("application/json"):
+            if resp.getheader("Content-Encoding") == "gzip":
+                data = gzip.decompress(data)
+            return status, json.loads(data), resp
+        return status, data, resp
+
+    def login(self, user_id):
+        token = self.tokens.get(user_id)
+        if token is None:
+            email = datagen.ADMIN_EMAIL if user_id == 1 else f"user{user_id}@bench.test"
+            status, body, _ = self.request("POST /auth/login", "POST", "/auth/login",
+                                           {"email": email, "password": datagen.PASSWORD})
+            if status != 200:
+                return None
+            token = self.tokens[user_id] = body["access_token"]
+        return token
+
+
+def browse(client):
+    rng = client.rng
+    for _ in range(rng.randint(1, 5)):
+        kind = rng.choices(("feed", "search", "filter"), (40, 35, 25))[0]
+        params = {"limit": "24"}
+        if kind == "search":
+            params["q"] = rng.choice(SEARCH_TERMS)
+            params["sort"] = rng.choice(("relevance", "relevance", "price_low", "newest"))
+        elif kind == "filter":
+            if rng.random() < 0.7:
+                params["category"] = rng.choice(datagen.CATEGORIES)
+            if rng.random() < 0.5:
+                params["condition"] = rng.choice(datagen.CONDITIONS)
+            if rng.random() < 0.5:
+                low = rng.choice((0, 50, 100, 200))
+                params["min_price"], params["max_price"] = str(low), str(low + rng.choice((100, 300, 1000)))
+            params["sort"] = rng.choice(("newest", "price_low", "price_high"))
+        query = urlencode(params)
+        name = {"feed": "GET /listings/", "search": "GET /listings/?q", "filter": "GET /listings/?filters"}[kind]
+        status, page, resp = client.request(name, "GET", "/listings/?" + query)
+        if status != 200 or not page:
+            continue
+        # Some people page on
+        cursor = resp.getheader("X-Next-Cursor")
+        if cursor and rng.random() < 0.3:
+            client.request("GET /listings/?cursor", "GET", f"/listings/?{query}&cursor={quote(cursor)}")
+        # The browser fetches the thumbnails in view; some listings get opened
+        for item in rng.sample(page, min(len(page), rng.randint(2, 6))):
+            photo = (item.get("photos") or [None])[0]
+            if photo:
+                client.request("GET /photos/{digest}/thumb", "GET", photo + "/thumb")
+        if rng.random() < 0.2:
+            photo = (rng.choice(page).get("photos") or [None])[0]
+            if photo:
+                client.request("GET /photos/{digest}", "GET", photo)
+
+
+def dashboard(client):
+    seller = client.rng.choice(client.data["sellers"])
+    token = client.login(seller)
+    if token:
+        client.request("GET /dashboard/", "GET", "/dashboard/", token=token)
+        if client.rng.random() < 0.5:
+            client.request("GET /requests/incoming", "GET", "/requests/incoming", token=token)
+
+
+def purchase(client):
+    rng = client.rng
+    listing_id, seller = rng.choice(client.data["active"])
+    buyer = rng.choice(client.data["buyers"])
+    buyer_token = client.login(buyer)
+    if not buyer_token:
+        return
+    status, created, _ = client.request("POST /requests/", "POST", "/requests/", {"listing_id": listing_id},
+                                        token=buyer_token)
+    if status != 200:
+        return
+    seller_token = client.login(seller)
+    if not seller_token:
+        return
+    status, _, _ = client.request("PUT /requests/{id}/accept", "PUT", f"/requests/{created['id']}/accept",
+                                  token=seller_token)
+    if status != 200:
+        return
+    client.request("POST /orders/", "POST", "/orders/", {
+        "request_id": created["id"], "shipping_name": f"User {buyer}", "shipping_address": "1 Bench Street",
+        "shipping_phone": "9000000000", "shipping_email": f"user{buyer}@bench.test",
+        "shipping_pincode": "560001", "payment_method": "upi"}, token=buyer_token)
+
+
+def sell(client):
+    rng = client.rng
+    seller = rng.choice(client.data["sellers"])
+    token = client.login(seller)
+    if not token:
+        return
+    brand, category = rng.choice(datagen.BRANDS), rng.choice(datagen.CATEGORIES)
+    photo = datagen.fake_jpeg(rng, datagen.photo_size(rng, client.photo_upload))
+    client.request("POST /listings/", "POST", "/listings/", {
+        "title": f"{brand} {category} - {rng.choice(datagen.FAULTS)}", "category": category, "brand": brand,
+        "model": f"{brand[:2].upper()}{rng.randint(1, 99)}", "condition": rng.choice(datagen.CONDITIONS),
+        "price": round(rng.uniform(10, 500), 2), "location": rng.choice(datagen.CITIES),
+        "description": ", ".join(rng.sample(datagen.FAULTS, 2)), "working_parts": rng.choice(datagen.PARTS),
+        "photos": ["data:image/jpeg;base64," + base64.b64encode(photo).decode()]}, token=token)
+
+
+JOURNEYS = {"browse": browse, "dashboard": dashboard, "purchase": purchase, "sell": sell}
+
+
+def run_client(args):
+    port, data, mix, seed, warmup, duration, photo_upload = args
+    now = time.monotonic()
+    client = Client(port, data, seed, now + warmup, photo_upload)
+    names, weights = list(mix), list(mix.values())
+    deadline = now + warmup + duration
+    while time.monotonic() < deadline:
+        JOURNEYS[client.rng.choices(names, weights)[0]](client)
+    return client.samples, client.statuses
+
+
+def load_data(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        roles = conn.execute("SELECT id, role FROM users").fetchall()
+        active = conn.execute("SELECT id, seller_id FROM listings WHERE status='active'").fetchall()
+    finally:
+        conn.close()
+    return {"sellers": [u for u, r in roles if r == "seller"], "buyers": [u for u, r in roles if r == "buyer"],
+            "active": active}
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+@contextlib.contextmanager
+def serve(data_dir, port=8766, server_env=None):
+    # Start the server on a throwaway copy of a dataset (runs write to it); yields the
+    # path of the copied database and load_data() of it
+    tmp = tempfile.mkdtemp(prefix="marketbench-")
+    try:
+        db_path = os.path.join(tmp, "marketplace.db")
+        shutil.copy(os.path.join(data_dir, "marketplace.db"), db_path)
+        shutil.copytree(os.path.join(data_dir, "photos"), os.path.join(tmp, "photos"))
+        data = load_data(db_path)
+        # Every client comes from 127.0.0.1, so the per-IP login limit is off unless asked for
+        env = dict(os.environ, PORT=str(port), DB_FILE=db_path, PHOTO_DIR=os.path.join(tmp, "photos"),
+                   LOGIN_IP_BURST="0")
+        env.update(server_env or {})
+        log = open(os.path.join(tmp, "server.log"), "w")
+        proc = subprocess.Popen([sys.executable, SERVER], env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            if not wait_for_port(port) or proc.poll() is not None:
+                with open(log.name) as f:
+                    raise RuntimeError("server did not start:\n" + f.read()[-2000:])
+            yield db_path, data
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+            log.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def run(data_dir, port=8766, clients=8, duration=20, warmup=3, mix=DEFAULT_MIX, seed=1, photo_upload=180,
+        server_env=None):
+    # Returns (samples, statuses, elapsed seconds of the measured window)
+    mix = parse_mix(mix)
+    with serve(data_dir, port, server_env) as (_, data):
+        with multiprocessing.Pool(clients) as pool:
+            results = pool.map(run_client, [(port, data, mix, seed * 1000 + i, warmup, duration, photo_upload)
+                                            for i in range(clients)])
+    samples, statuses = merge(results)
+    return samples, statuses, duration
+
+
+def merge(results):
+    # Combine the (samples, statuses) of each client
+    samples, statuses = {}, {}
+    for client_samples, client_statuses in results:
+        for name, values in client_samples.items():
+            samples.setdefault(name, []).extend(values)
+        for name, counts in client_statuses.items():
+            merged = statuses.setdefault(name, {})
+            for status, n in counts.items():
+                merged[status] = merged.get(status, 0) + n
+    return samples, statuses
@@ -0,0 +1,74 @@
+"""Login flood: browse latency with and without attackers hammering /auth/login.
+
+Runs the browse journey from --clients processes twice on the same server:
+once alone (baseline), then again while --attackers processes send wrong
+passwords for real accounts as fast as they can. Each failed login costs a
+full password hash, so this measures whether hashing work leaks into the feed.
+
+The server is started with the per-IP login limit off (every client comes from
+127.0.0.1), so by default the per-email limiter is all that stands in front of
+the hashing pool. --env LOGIN_EMAIL_BURST=0 sends the whole flood to the pool;
+--env LOGIN_IP_BURST=20 shows the per-IP limiter shedding it instead.
+
+    python -m bench.marketbench flood --data /tmp/mb --env LOGIN_EMAIL_BURST=0
+"""
+import multiprocessing
+import time
+
+from . import driver, report
+
+LOGIN = "POST /auth/login"
+
+
+def attack(args):
+    port, data, seed, warmup, duration = args
+    now = time.monotonic()
+    client = driver.Client(port, data, seed, now + warmup, 0)
+    deadline = now + warmup + duration
+    while time.monotonic() < deadline:
+        buyer = client.rng.choice(data["buyers"])
+        client.request(LOGIN, "POST", "/auth/login", {"email": f"user{buyer}@bench.test", "password": "wrong"})
+    return client.samples, client.statuses
+
+
+def run(data_dir, port=8766, clients=4, attackers=8, duration=10, warmup=2, seed=1, server_env=None):
+    # Returns {"baseline": report, "attack": report}
+    reports = {}
+    with driver.serve(data_dir, port, server_env) as (_, data):
+        with multiprocessing.Pool(clients + attackers) as pool:
+            browse = [(port, data, {"browse": 1}, seed * 1000 + i, warmup, duration, 0) for i in range(clients)]
+            results = pool.map(driver.run_client, browse)
+            reports["baseline"] = _report(results, duration, clients, 0, seed, server_env)
+
+            flood = pool.map_async(attack, [(port, data, seed * 2000 + i, warmup, duration)
+                                            for i in range(attackers)])
+            results = pool.map(driver.run_client, browse)
+            results += flood.get()
+            reports["attack"] = _report(results, duration, clients, attackers, seed, server_env)
+    return reports
+
+
+def _report(results, duration, clients, attackers, seed, server_env):
+    samples, statuses = driver.merge(results)
+    result = report.build(samples, statuses, duration, {
+        "clients": clients, "attackers": attackers, "duration_s": duration, "seed": seed,
+        "server_env": server_env or {}})
+    # Every browse endpoint together: what a shopper sees while the flood is on
+    browse = [name for name in samples if name != LOGIN]
+    merged = {}
+    for name in browse:
+        for status, n in statuses[name].items():
+            merged[status] = merged.get(status, 0) + n
+    result["browse"] = report.summarize([v for name in browse for v in samples[name]], merged, duration)
+    return result
+
+
+def summary(reports):
+    for phase, result in reports.items():
+        browse = result["browse"]
+        line = (f"{phase:<9} browse {browse['rps']:>8.1f} req/s  p50 {browse['p50_ms']:>7.2f} ms  "
+                f"p99 {browse['p99_ms']:>7.2f} ms")
+        login = result["endpoints"].get(LOGIN)
+        if login:
+            line += f"   logins {login['rps']:>7.1f}/s  " + " ".join(f"{k}:{v}" for k, v in login["statuses"].items())
+        print(line)
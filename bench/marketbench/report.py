@@ -0,0 +1,105 @@
+"""Throughput and latency percentiles per endpoint, as a table or JSON.
+
+JSON reports look like
+
+    {"meta": {...run settings, git commit, versions...},
+     "total": {"requests": ..., "rps": ..., "errors": ..., "p50_ms": ..., ...},
+     "endpoints": {"GET /listings/?q": {same keys, plus "statuses": {"200": n}}, ...}}
+
+so two runs can be diffed with `compare`.
+"""
+import json
+import platform
+import sqlite3
+import subprocess
+import time
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return 0.0
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(values, statuses, elapsed):
+    ordered = sorted(values)
+    errors = sum(n for status, n in statuses.items() if status == "error" or int(status) >= 500)
+    rejected = sum(n for status, n in statuses.items() if status != "error" and 400 <= int(status) < 500)
+    stats = {
+        "requests": len(ordered),
+        "rps": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        "errors": errors,
+        "rejected": rejected,
+        "mean_ms": round(sum(ordered) / len(ordered), 3) if ordered else 0.0,
+        "max_ms": round(ordered[-1], 3) if ordered else 0.0,
+    }
+    for p in PERCENTILES:
+        stats[f"p{p}_ms"] = round(percentile(ordered, p), 3)
+    return stats
+
+
+def build(samples, statuses, elapsed, meta):
+    endpoints = {}
+    for name in sorted(samples):
+        endpoints[name] = summarize(samples[name], statuses.get(name, {}), elapsed)
+        endpoints[name]["statuses"] = {str(k): v for k, v in sorted(statuses.get(name, {}).items(), key=str)}
+    everything = [v for values in samples.values() for v in values]
+    merged = {}
+    for counts in statuses.values():
+        for status, n in counts.items():
+            merged[status] = merged.get(status, 0) + n
+    return {"meta": dict(meta, **environment()), "total": summarize(everything, merged, elapsed),
+            "endpoints": endpoints}
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                timeout=5).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"git_commit": commit, "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(), "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def print_table(report):
+    header = f"{'endpoint':<30} {'reqs':>8} {'req/s':>8} {'err':>5} {'4xx':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    print(header)
+    print("-" * len(header))
+    rows = list(report["endpoints"].items()) + [("TOTAL", report["total"])]
+    for name, s in rows:
+        print(f"{name:<30} {s['requests']:>8} {s['rps']:>8.1f} {s['errors']:>5} {s['rejected']:>5} "
+              f"{s['p50_ms']:>8.2f} {s['p95_ms']:>8.2f} {s['p99_ms']:>8.2f}")
+
+
+def compare(before, after):
+    # Side by side: req/s and p50/p99 of each endpoint, with the change in percent
+    def change(old, new):
+        return f"{(new - old) / old * 100:+.0f}%" if old else "n/a"
+
+    print(f"{'endpoint':<30} " + " ".join(f"{label:^25}" for label in ("req/s", "p50 ms", "p99 ms")))
+    names = sorted(set(before["endpoints"]) | set(after["endpoints"])) + ["TOTAL"]
+    for name in names:
+        a = before["total"] if name == "TOTAL" else before["endpoints"].get(name)
+        b = after["total"] if name == "TOTAL" else after["endpoints"].get(name)
+        if a is None or b is None:
+            print(f"{name:<30} {'only in ' + ('after' if a is None else 'before'):>17}")
+            continue
+        cells = []
+        for key in ("rps", "p50_ms", "p99_ms"):
+            cells.append(f"{a[key]:>8.1f}->{b[key]:<8.1f} {change(a[key], b[key]):>6}")
+        print(f"{name:<30} " + " ".join(cells))
+
+
+def save(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,94 @@
+"""Compare listing search through the FTS5 index with the old LIKE scan.
+
+Builds throwaway databases of synthetic listings at each scale and times
+the first page of GET /listings/?q=... both ways.
+
+    python bench/search_bench.py --scales 10000,100000,1000000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+import listings  # noqa: E402
+
+BRANDS = ["Samsung", "Apple", "Xiaomi", "OnePlus", "Dell", "HP", "Lenovo", "Asus", "Sony", "LG", "Nokia", "Realme"]
+CATEGORIES = ["Mobile", "Laptop", "Tablet", "TV", "Audio", "Camera", "Console", "Accessories"]
+CONDITIONS = ["Broken", "Dead", "Partially Working", "Screen Damage", "Water Damage"]
+WORDS = ("cracked screen battery dead motherboard charging port speaker camera lens keyboard hinge "
+         "display flicker water damage boot loop touch panel fan overheating adapter speaker mic "
+         "housing scratches backlight ram storage sensor button volume power").split()
+# Long-tail vocabulary so word frequencies look like real descriptions rather than
+# every listing containing every word
+FILLER = [f"w{i}" for i in range(5000)]
+ZIPF = [1 / (i + 1) for i in range(len(FILLER))]
+QUERIES = ["samsung", "cracked screen", "batt", "motherboard dead", "xiaomi charging port", "nothingmatches"]
+
+
+def build(path, n, seed=1):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        PRAGMA journal_mode=WAL; PRAGMA synchronous=OFF;
+        CREATE TABLE listings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, seller_id INTEGER, title TEXT, category TEXT,
+            brand TEXT, model TEXT, condition TEXT, seller_price REAL, price REAL, location TEXT,
+            description TEXT, status TEXT DEFAULT 'active', working_parts TEXT, photos TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    listings.setup_fts(conn)
+
+    def rows():
+        for i in range(n):
+            brand = rng.choice(BRANDS)
+            category = rng.choice(CATEGORIES)
+            price = round(rng.uniform(10, 2000), 2)
+            yield (rng.randint(1, 1000), f"{brand} {category} {rng.choice(WORDS)}", category, brand,
+                   f"M{rng.randint(1, 999)}", rng.choice(CONDITIONS), price, round(price * 1.1 + 20, 2),
+                   "City", " ".join(rng.choices(WORDS, k=3) + rng.choices(FILLER, weights=ZIPF, k=22)),
+                   rng.choice(["active"] * 9 + ["sold"]), "", "[]", f"2024-01-01 00:00:{i:010d}")
+
+    conn.executemany('''INSERT INTO listings (seller_id, title, category, brand, model, condition, seller_price,
+                        price, location, description, status, working_parts, photos, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows())
+    conn.commit()
+    return conn
+
+
+def time_query(conn, qs, repeat):
+    sql, params, _, _ = listings.page_query(qs)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'listings':>9} {'query':<22} {'LIKE ms':>9} {'FTS ms':>9} {'speedup':>8}")
+    for n in (int(x) for x in args.scales.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = build(os.path.join(tmp, "bench.db"), n)
+            for q in QUERIES:
+                qs = {'q': [q], 'sort': ['newest'], 'limit': ['60']}
+                listings.FTS_ENABLED = False
+                like_ms = time_query(conn, qs, args.repeat)
+                listings.FTS_ENABLED = True
+                fts_ms = time_query(conn, qs, args.repeat)
+                print(f"{n:>9} {q:<22} {like_ms:>9.2f} {fts_ms:>9.2f} {like_ms / fts_ms:>7.1f}x")
+            conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,111 @@ api.interceptors.request.use((config) => {
     return config;
 });
 
+// Downscale an uploaded photo for the listings grid (server stores it as the photo's thumbnail)
+const makeThumbnail = (src, maxSize = 480) => new Promise((resolve) => {
+    const img = new Image();
+    img.onload = () => {
+        const scale = Math.min(1, maxSize / Math.max(img.width, img.height));
+        const canvas = document.createElement('canvas');
+        canvas.width = Math.round(img.width * scale);
+        canvas.height = Math.round(img.height * scale);
+        canvas.getContext('2d').drawImage(img, 0, 0, canvas.width, canvas.height);
+        canvas.toBlob(resolve, 'image/jpeg', 0.8);
+    };
+    img.onerror = () => resolve(null);
+    img.src = src;
+});
+
+// Send a photo as a raw body (streamed to the store server-side) and return its URL.
+// The server makes the thumbnail when it can; otherwise we send one made here.
+const uploadPhoto = async ({ file, preview }) => {
+    const { data } = await api.post('/photos/', file, {
+        headers: { 'Content-Type': file.type || 'application/octet-stream' }
+    });
+    if (!data.thumbnail) {
+        const thumbnail = await makeThumbnail(preview);
+        if (thumbnail) {
+            await api.put(`/photos/${data.digest}/thumb`, thumbnail, {
+                headers: { 'Content-Type': 'image/jpeg' }
+            }).catch(() => {});
+        }
+    }
+    return data.url;
+};
+
+// --- Live Updates (Server-Sent Events) ---
+// One EventSource per signed-in tab; components subscribe with useLiveEvents instead of polling
+const LIVE_EVENT_TYPES = ['request.created', 'request.updated', 'order.created'];
+const liveListeners = new Set();
+
+const useLiveEvents = (onEvent) => {
+    useEffect(() => {
+        liveListeners.add(onEvent);
+        return () => liveListeners.delete(onEvent);
+    }, [onEvent]);
+};
+
+const LIVE_POLL_MS = 10000;
+const LIVE_STREAM_RETRY_MS = 60000;
+
+const openLiveEvents = (token) => {
+    let source = null;
+    let retryTimer = null;
+    let pollTimer = null;
+    let polling = false;
+    let lastEventId = null;
+    const emit = (type, data) => liveListeners.forEach(listener => listener(type, data));
+
+    // While the server can't take another stream, ask for what happened every few seconds
+    const poll = async () => {
+        try {
+            const { data } = await api.get('/events/poll', {
+                params: lastEventId === null ? {} : { last_event_id: lastEventId }
+            });
+            data.events.forEach(e => emit(e.type, e.data));
+            lastEventId = data.last_event_id;
+        } catch (err) {
+            console.error(err);
+        }
+        if (polling) pollTimer = setTimeout(poll, LIVE_POLL_MS);
+    };
+    const startPolling = () => {
+        if (!polling) {
+            polling = true;
+            poll();
+        }
+    };
+    const stopPolling = () => {
+        polling = false;
+        clearTimeout(pollTimer);
+    };
+
+    const connect = () => {
+        // EventSource can't send an Authorization header, so the token goes in the query
+        const query = `token=${encodeURIComponent(token)}` + (lastEventId === null ? '' : `&last_event_id=${lastEventId}`);
+        source = new EventSource(`/events/?${query}`);
+        source.onopen = stopPolling;
+        LIVE_EVENT_TYPES.forEach(type => source.addEventListener(type, (e) => {
+            lastEventId = Number(e.lastEventId);
+            emit(type, JSON.parse(e.data));
+        }));
+        source.onerror = () => {
+            // The browser retries dropped streams itself; a refused one (e.g. 503) is closed
+            // for good, so poll meanwhile and try streaming again later
+            if (source.readyState === EventSource.CLOSED) {
+                startPolling();
+                retryTimer = setTimeout(connect, LIVE_STREAM_RETRY_MS);
+            }
+        };
+    };
+    connect();
+    return () => {
+        clearTimeout(retryTimer);
+        stopPolling();
+        if (source) source.close();
+    };
+};
+
 // --- Auth Context ---
 const AuthContext = createContext(null);
 
@@ -38,6 +143,11 @@ const AuthProvider = ({ children }) => {
         checkAuth();
     }, []);
 
+    useEffect(() => {
+        const token = localStorage.getItem('token');
+        if (user && token && window.EventSource) return openLiveEvents(token);
+    }, [user]);
+
     const login = async (email, password) => {
         const res = await api.post('/auth/login', { email, password });
         localStorage.setItem('token', res.data.access_token);
@@ -51,6 +161,7 @@ const AuthProvider = ({ children }) => {
     };
 
     const logout = () => {
+        api.post('/auth/logout', {}).catch(() => { });
         localStorage.removeItem('token');
         setUser(null);
     };
@@ -181,6 +292,12 @@ const ProductDetailsModal = ({ listing, onClose, onRequest }) => {
         }
     }, [user, listing]);
 
+    useLiveEvents((type, data) => {
+        if (user && listing && type.startsWith('request.') && data.listing_id === listing.id && data.buyer_id === user.id) {
+            setHasRequested(data.status === 'pending');
+        }
+    });
+
     if (!listing) return null;
 
     const photos = listing.photos && listing.photos.length > 0 ? listing.photos : [];
@@ -326,7 +443,7 @@ const ListingCard = ({ listing, onView }) => {
         >
             <div className="h-56 bg-dark-950/50 flex items-center justify-center relative overflow-hidden group-hover:bg-dark-900/80 transition-colors">
                 {listing.photos && listing.photos.length > 0 ? (
-                    <img src={listing.photos[0]} alt={listing.title} className="h-full w-full object-cover transition-transform duration-700 group-hover:scale-110 opacity-90 group-hover:opacity-100" />
+                    <img src={listing.thumbnail || listing.photos[0]} loading="lazy" alt={listing.title} className="h-full w-full object-cover transition-transform duration-700 group-hover:scale-110 opacity-90 group-hover:opacity-100" />
                 ) : (
                     <div className="text-slate-600 flex flex-col items-center">
                         <span className="text-5xl mb-2 opacity-30 group-hover:opacity-50 transition-opacity">📷</span>
@@ -510,6 +627,8 @@ const HomePage = ({ setPage }) => {
     const [debouncedSearch, setDebouncedSearch] = useState('');
     const [sortBy, setSortBy] = useState('newest');
     const [selectedListing, setSelectedListing] = useState(null);
+    const [nextCursor, setNextCursor] = useState(null);
+    const [facets, setFacets] = useState(null);
 
     // Debounce Search
     useEffect(() => {
@@ -524,18 +643,44 @@ const HomePage = ({ setPage }) => {
         fetchListings();
     }, [filters, debouncedSearch, sortBy]);
 
-    const fetchListings = async () => {
+    // Facet counts don't depend on the sort order
+    useEffect(() => {
+        fetchFacets();
+    }, [filters, debouncedSearch]);
+
+    const filterParams = () => {
+        const params = {};
+        if (debouncedSearch) params.q = debouncedSearch;
+        if (filters.category) params.category = filters.category;
+        if (filters.condition) params.condition = filters.condition;
+        if (filters.minPrice) params.min_price = filters.minPrice;
+        if (filters.maxPrice) params.max_price = filters.maxPrice;
+        return params;
+    };
+
+    const fetchFacets = async () => {
         try {
-            const params = {};
-            if (debouncedSearch) params.q = debouncedSearch;
-            if (filters.category) params.category = filters.category;
-            if (filters.condition) params.condition = filters.condition;
-            if (filters.minPrice) params.min_price = filters.minPrice;
-            if (filters.maxPrice) params.max_price = filters.maxPrice;
+            const res = await api.get('/listings/facets', { params: filterParams() });
+            setFacets(res.data);
+        } catch (err) {
+            setFacets(null);
+        }
+    };
+
+    const facetCount = (name, value) => {
+        const match = facets?.[name]?.find(f => f.value === value);
+        return match ? match.count : 0;
+    };
+
+    const fetchListings = async (cursor = null) => {
+        try {
+            const params = filterParams();
+            if (cursor) params.cursor = cursor;
             params.sort = sortBy;
 
             const res = await api.get('/listings/', { params });
-            setListings(res.data);
+            setListings(prev => cursor ? [...prev, ...res.data] : res.data);
+            setNextCursor(res.headers['x-next-cursor'] || null);
         } catch (err) {
             console.error("Failed to fetch listings", err);
         }
@@ -584,6 +729,7 @@ const HomePage = ({ setPage }) => {
                                 <option value="newest">Latest Arrivals</option>
                                 <option value="price_low">Price: Low to High</option>
                                 <option value="price_high">Price: High to Low</option>
+                                <option value="relevance">Best Match</option>
                             </select>
                         </div>
                     </div>
@@ -620,6 +766,19 @@ const HomePage = ({ setPage }) => {
                                     onChange={e => setFilters({ ...filters, maxPrice: e.target.value })}
                                 />
                             </div>
+                            {facets && facets.price.length > 0 && (
+                                <div className="flex flex-wrap gap-1 mt-3">
+                                    {facets.price.map(bucket => (
+                                        <button
+                                            key={`${bucket.min}-${bucket.max}`}
+                                            onClick={() => setFilters({ ...filters, minPrice: bucket.min ?? '', maxPrice: bucket.max ?? '' })}
+                                            className="text-xs px-2 py-1 rounded-lg bg-white/5 text-slate-400 hover:bg-primary/20 hover:text-white transition-colors"
+                                        >
+                                            {bucket.max == null ? `${bucket.min}+` : `${bucket.min ?? 0}–${bucket.max}`} <span className="text-slate-500">({bucket.count})</span>
+                                        </button>
+                                    ))}
+                                </div>
+                            )}
                         </div>
 
                         <div className="mb-8">
@@ -631,6 +790,19 @@ const HomePage = ({ setPage }) => {
                                 value={filters.category}
                                 onChange={e => setFilters({ ...filters, category: e.target.value })}
                             />
+                            {facets && facets.category.length > 0 && (
+                                <div className="flex flex-wrap gap-1 mt-3">
+                                    {facets.category.slice(0, 10).map(({ value, count }) => (
+                                        <button
+                                            key={value}
+                                            onClick={() => setFilters({ ...filters, category: filters.category === value ? '' : value })}
+                                            className={`text-xs px-2 py-1 rounded-lg transition-colors ${filters.category === value ? 'bg-primary/30 text-white' : 'bg-white/5 text-slate-400 hover:bg-primary/20 hover:text-white'}`}
+                                        >
+                                            {value} <span className="text-slate-500">({count})</span>
+                                        </button>
+                                    ))}
+                                </div>
+                            )}
                         </div>
 
                         <div>
@@ -652,6 +824,9 @@ const HomePage = ({ setPage }) => {
                                         <span className={`text-sm font-medium ${filters.condition === cond ? 'text-white' : 'text-slate-400'}`}>
                                             {cond === '' ? 'All' : cond.replace('_', ' ').replace(/\b\w/g, l => l.toUpperCase())}
                                         </span>
+                                        {facets && cond !== '' && (
+                                            <span className="ml-auto text-xs text-slate-500">{facetCount('condition', cond)}</span>
+                                        )}
                                     </label>
                                 ))}
                             </div>
@@ -670,6 +845,11 @@ const HomePage = ({ setPage }) => {
                             />
                         ))}
                     </div>
+                    {nextCursor && (
+                        <div className="text-center mt-8">
+                            <button onClick={() => fetchListings(nextCursor)} className="px-6 py-3 rounded-xl bg-slate-800 text-white font-bold hover:bg-slate-700 transition-colors">Load More</button>
+                        </div>
+                    )}
                     {listings.length === 0 && (
                         <div className="glass-panel text-center py-24 rounded-3xl border border-dashed border-slate-700 mt-4">
                             <div className="bg-slate-800/50 w-24 h-24 rounded-full flex items-center justify-center mx-auto mb-6">
@@ -841,26 +1021,16 @@ const CreateListingPage = ({ setPage }) => {
             return;
         }
 
-        const newPhotos = [];
-        let processedCount = 0;
-
-        files.forEach(file => {
-            const reader = new FileReader();
-            reader.onloadend = () => {
-                newPhotos.push(reader.result);
-                processedCount++;
-                if (processedCount === files.length) {
-                    setFormData(prev => ({
-                        ...prev,
-                        photos: [...prev.photos, ...newPhotos]
-                    }));
-                }
-            };
-            reader.readAsDataURL(file);
-        });
+        // Keep the files themselves; they are only read when the listing is submitted
+        const newPhotos = files.map(file => ({ file, preview: URL.createObjectURL(file) }));
+        setFormData(prev => ({
+            ...prev,
+            photos: [...prev.photos, ...newPhotos]
+        }));
     };
 
     const removePhoto = (index) => {
+        URL.revokeObjectURL(formData.photos[index].preview);
         setFormData(prev => ({
             ...prev,
             photos: prev.photos.filter((_, i) => i !== index)
@@ -871,8 +1041,10 @@ const CreateListingPage = ({ setPage }) => {
         e.preventDefault();
         setLoading(true);
         try {
+            const photos = await Promise.all(formData.photos.map(uploadPhoto));
             await api.post('/listings/', {
                 ...formData,
+                photos,
                 price: parseFloat(formData.price) // Sends expected Seller Price
             });
             alert('Listing created! Admin will review shortly.');
@@ -893,7 +1065,7 @@ const CreateListingPage = ({ setPage }) => {
                     <div className="flex flex-wrap gap-4 items-start">
                         {formData.photos.map((photo, idx) => (
                             <div key={idx} className="relative w-28 h-28 rounded-2xl overflow-hidden border border-white/20 group shadow-md">
-                                <img src={photo} alt="Preview" className="w-full h-full object-cover" />
+                                <img src={photo.preview} alt="Preview" className="w-full h-full object-cover" />
                                 <button
                                     type="button"
                                     onClick={() => removePhoto(idx)}
@@ -1012,35 +1184,56 @@ const DashboardPage = () => {
 
     const loadDashboardData = async () => {
         try {
-            const reqSent = await api.get('/requests/my-requests');
-            setSentRequests(reqSent.data);
-            const reqInc = await api.get('/requests/incoming');
-            setIncomingRequests(reqInc.data);
-            const listRes = await api.get('/listings/?limit=100');
-            setMyListings(listRes.data.filter(l => l.seller_id === user.id));
-
-            // Allow fetch orders if endpoint exists (ignoring error if not yet ready)
-            try {
-                const ordersRes = await api.get('/orders/my-orders');
-                setMyOrders(ordersRes.data);
-            } catch (e) { }
-
+            // One round trip; each request comes back with its order (if any) attached
+            const include = user.role === 'buyer' ? 'sent' : 'sent,incoming,listings';
+            const res = await api.get(`/dashboard/?include=${include}`
+                + '&fields[listings]=id,title,status,seller_price');
+            const sent = res.data.sent || [];
+            const incoming = res.data.incoming || [];
+            setSentRequests(sent);
+            setIncomingRequests(incoming);
+            setMyListings(res.data.listings || []);
+            setMyOrders([...sent, ...incoming].map(r => r.order).filter(Boolean));
         } catch (err) {
             console.error(err);
         }
     };
 
+    // Merge pushed changes into the lists instead of re-fetching everything
+    const upsert = (items, item) => items.some(i => i.id === item.id)
+        ? items.map(i => i.id === item.id ? { ...i, ...item } : i)
+        : [...items, item];
+
+    useLiveEvents((type, data) => {
+        if (!user) return;
+        if (type === 'request.created' || type === 'request.updated') {
+            if (data.buyer_id === user.id) setSentRequests(items => upsert(items, data));
+            if (data.seller_id === user.id) setIncomingRequests(items => upsert(items, data));
+            if (type === 'request.updated' && data.status === 'accepted') {
+                setMyListings(items => items.map(l => l.id === data.listing_id ? { ...l, status: 'sold' } : l));
+            }
+        }
+        if (type === 'order.created') {
+            setMyOrders(items => upsert(items, data));
+            const completed = { id: data.request_id, status: 'completed' };
+            setSentRequests(items => items.some(i => i.id === completed.id) ? upsert(items, completed) : items);
+            setIncomingRequests(items => items.some(i => i.id === completed.id) ? upsert(items, completed) : items);
+        }
+    });
+
     const handleUpdateStatus = async (reqId, status) => {
         try {
             if (status === 'accept') await api.put(`/requests/${reqId}/accept`);
             if (status === 'reject') await api.put(`/requests/${reqId}/reject`);
             loadDashboardData();
         } catch (err) {
-            alert("Action failed");
+            alert(err.response?.data?.detail || "Action failed");
+            // Someone else's request may have been accepted first
+            if (err.response?.status === 409) loadDashboardData();
         }
     };
 
-    // Helper to find order for a request
+    // Orders pushed over the live stream arrive after the request rows that embed theirs
     const getOrderForRequest = (reqId) => myOrders.find(o => o.request_id === reqId);
 
     return (
@@ -1059,7 +1252,7 @@ const DashboardPage = () => {
                             <div key={req.id} className="glass-panel p-6 rounded-2xl flex items-center justify-between border border-white/5">
                                 <div>
                                     <div className="text-xs text-slate-400 mb-1">Request #{req.id}</div>
-                                    <div className="font-bold text-lg text-white">Listing ID: {req.listing_id}</div>
+                                    <div className="font-bold text-lg text-white">{req.listing_title || `Listing ID: ${req.listing_id}`}</div>
                                     <div className="text-sm text-slate-500">Status: <span className={`uppercase font-bold ${req.status === 'accepted' ? 'text-emerald-400' : (req.status === 'rejected' ? 'text-red-400' : 'text-yellow-400')}`}>{isCompleted ? 'PURCHASED' : req.status}</span></div>
                                 </div>
 
@@ -1093,7 +1286,7 @@ const DashboardPage = () => {
                                 <div key={req.id} className="glass-panel p-6 rounded-2xl border border-white/5">
                                     <div className="flex justify-between items-start mb-4">
                                         <div>
-                                            <div className="font-bold text-lg text-white">Item ID: {req.listing_id}</div>
+                                            <div className="font-bold text-lg text-white">{req.listing_title || `Item ID: ${req.listing_id}`}</div>
                                             <div className="text-sm text-slate-400">Buyer: {req.buyer_name} ({req.buyer_location})</div>
                                         </div>
                                         <div className={`px-3 py-1 rounded-full text-xs font-bold uppercase ${req.status === 'accepted' || req.status === 'completed' ? 'bg-emerald-500/20 text-emerald-400' : 'bg-yellow-500/20 text-yellow-400'}`}>
@@ -1167,6 +1360,7 @@ const AdminPage = () => {
     const { user } = useAuth();
     const [users, setUsers] = useState([]);
     const [listings, setListings] = useState([]);
+    const [stats, setStats] = useState(null);
     const [loading, setLoading] = useState(true);
 
     useEffect(() => {
@@ -1176,12 +1370,14 @@ const AdminPage = () => {
     const fetchAdminData = async () => {
         try {
             setLoading(true);
-            const [usersRes, listingsRes] = await Promise.all([
+            const [usersRes, listingsRes, statsRes] = await Promise.all([
                 api.get('/admin/users'),
-                api.get('/admin/listings_full') // New endpoint with profit info
+                api.get('/admin/listings_full'), // New endpoint with profit info
+                api.get('/admin/stats')
             ]);
             setUsers(usersRes.data);
             setListings(listingsRes.data);
+            setStats(statsRes.data);
         } catch (err) {
             console.error("Admin Access Error", err);
             alert("Failed to load admin data");
@@ -1220,7 +1416,7 @@ const AdminPage = () => {
             <h1 className="text-3xl font-bold mb-8 text-white">Admin Dashboard</h1>
 
             {/* Stats Cards */}
-            <div className="grid grid-cols-1 md:grid-cols-3 gap-6 mb-8">
+            <div className="grid grid-cols-1 md:grid-cols-4 gap-6 mb-8">
                 <div className="glass-panel p-6 rounded-2xl border border-white/5 bg-gradient-to-br from-slate-800 to-slate-900">
                     <h3 className="text-slate-400 text-sm font-bold uppercase mb-2">Total Users</h3>
                     <p className="text-3xl font-bold text-white">{users.length}</p>
@@ -1230,6 +1426,11 @@ const AdminPage = () => {
                     <p className="text-3xl font-bold text-white">₹{potentialProfit.toLocaleString('en-IN')}</p>
                     <p className="text-xs text-slate-500 mt-1">Projected Platform Profit</p>
                 </div>
+                <div className="glass-panel p-6 rounded-2xl border border-white/5 bg-gradient-to-br from-emerald-900/40 to-slate-900">
+                    <h3 className="text-emerald-400 text-sm font-bold uppercase mb-2">Realized Profit</h3>
+                    <p className="text-3xl font-bold text-white">₹{(stats?.total.profit || 0).toLocaleString('en-IN')}</p>
+                    <p className="text-xs text-slate-500 mt-1">{stats?.total.sold || 0} sold • {stats?.total.orders || 0} paid</p>
+                </div>
                 <div className="glass-panel p-6 rounded-2xl border border-white/5 bg-gradient-to-br from-primary/20 to-slate-900">
                     <h3 className="text-primary-light text-sm font-bold uppercase mb-2">Total Listings</h3>
                     <p className="text-3xl font-bold text-white">{listings.length}</p>
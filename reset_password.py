@@ -1,20 +1,32 @@
+import os
 import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+import passwords  # noqa: E402
+
+# python reset_password.py [email] [new password]
+email = sys.argv[1] if len(sys.argv) > 1 else 'smax06388@gmail.com'
+new_password = sys.argv[2] if len(sys.argv) > 2 else '123456'
 
 try:
-    conn = sqlite3.connect('backend/marketplace.db')
+    conn = sqlite3.connect(os.environ.get('DB_FILE', 'backend/marketplace.db'))
     c = conn.cursor()
-    # Hash for '123456'
-    new_hash = '8d969eef6ecad3c29a3a629280e686cf0c3f5d5a86aff3ca12020c923adc6c92'
-    email = 'smax06388@gmail.com'
-    
+    new_hash = passwords.hash_password(new_password)
+
     c.execute("UPDATE users SET password_hash=? WHERE email=?", (new_hash, email))
+    found = c.rowcount > 0
+    # A new password signs the user out everywhere, as changing it through the app does.
+    # A database the server hasn't migrated yet has no sessions table, and so no sessions.
+    if c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='sessions'").fetchone():
+        c.execute("DELETE FROM sessions WHERE user_id=(SELECT id FROM users WHERE email=?)", (email,))
     conn.commit()
-    
-    if c.rowcount > 0:
+
+    if found:
         print(f"Successfully reset password for {email}")
     else:
         print(f"User {email} not found")
-        
+
     conn.close()
 except Exception as e:
     print(f"Error: {e}")